@@ -4,73 +4,96 @@ Not a general optimizer! But works for our specific use.
 """
 import torch
 import torch.distributed as dist
-from torch import Tensor
+
+from nanochat.grad_buckets import GradBuckets
+
+
+@torch.compile
+@torch.no_grad()
+def adamw_update_(p_slice, g_slice, exp_avg, exp_avg_sq, t, lr, weight_decay, beta1: float, beta2: float, eps: float):
+    """
+    The AdamW update of a shard of a param, in place, compiled into a few fused kernels.
+    t (the step), lr and weight_decay (lr * wd, already) are 0-d tensors, so the lr schedule doesn't recompile.
+    """
+    # weight decay
+    p_slice.mul_(1 - weight_decay)
+    # update running averages
+    exp_avg.mul_(beta1).add_(g_slice, alpha=1 - beta1)
+    exp_avg_sq.mul_(beta2).addcmul_(g_slice, g_slice, value=1 - beta2)
+    # bias corrections
+    bias1 = 1 - beta1 ** t
+    bias2 = 1 - beta2 ** t
+    # compute step
+    denom = exp_avg_sq.sqrt().add_(eps)
+    step_size = lr * (torch.sqrt(bias2) / bias1)
+    update = exp_avg.div(denom).mul_(step_size)
+    p_slice.add_(other=update, alpha=-1.0)
 
 
 class DistAdamW(torch.optim.Optimizer):
     """
     Distributed AdamW optimizer.
-    In the style of ZeRO-2, i.e. sharded optimizer states and gradient reduction
+    In the style of ZeRO-2, i.e. sharded optimizer states and gradient reduction.
+    The gradients are reduce scattered in buckets (see nanochat/grad_buckets.py), optionally
+    launched from inside the last backward (call overlap_next_backward() right before it, eager mode only).
+    The grads are views into the buckets: zero them with zero_grad() of the optimizer.
     """
-    def __init__(self, param_groups, lr: float = 1e-3, betas: tuple[float, float] = (0.9, 0.999), eps: float = 1e-8, weight_decay: float = 0.01):
+    def __init__(self, param_groups, lr: float = 1e-3, betas: tuple[float, float] = (0.9, 0.999), eps: float = 1e-8, weight_decay: float = 0.01, bucket_size_mb: float = 32):
         defaults = dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay)
         super().__init__(param_groups, defaults)
+        world_size = dist.get_world_size()
+        params = [p for group in self.param_groups for p in group["params"]][::-1] # in the order their grads become ready
+        assert all(p.shape[0] % world_size == 0 for p in params), "the first dim of every param must be divisible by world_size"
+        self.group_of = {p: group for group in self.param_groups for p in group["params"]}
+        self.scalars = {} # param -> (lr, weight decay) as 0-d tensors
+        self.grad_buckets = GradBuckets(GradBuckets.plan(params, world_size, bucket_size_mb, sharded=True), world_size, dist.get_rank())
+
+    def overlap_next_backward(self):
+        """Launch the gradient reduce scatters from inside the next backward pass, as the grads become ready."""
+        self.grad_buckets.arm()
+
+    def zero_grad(self, set_to_none=True):
+        """Zero the grads in place, they stay views into the gradient buckets (set_to_none is ignored)."""
+        self.grad_buckets.zero_grad()
 
-    @torch.compile
     @torch.no_grad()
     def step(self):
         rank = dist.get_rank()
         world_size = dist.get_world_size()
-        reduce_scatter_futures: list[torch.Future] = []
-        all_reduce_futures: list[torch.Future] = []
-        grad_slices = []
-        for group in self.param_groups:
-            params: list[Tensor] = group["params"]
-            for base_i in range(len(params)):
-                grad = params[base_i].grad
-                rank_size = grad.shape[0] // world_size
-                grad_slice = torch.empty_like(grad[:rank_size])
-                reduce_scatter_futures.append(dist.reduce_scatter_tensor(grad_slice, grad, op=dist.ReduceOp.AVG, async_op=True).get_future())
-                grad_slices.append(grad_slice)
-
-        idx = 0
-        for group in self.param_groups:
-            beta1, beta2 = group['betas']
-            eps = group['eps']
-            wd = group['weight_decay']
-            params = group['params']
-            for base in range(len(params)):
-                reduce_scatter_futures[idx].wait()
-                p = params[base]
+        all_gather_futures: list[torch.Future] = []
+        # Process the buckets of gradients in the order their reduce scatters complete
+        # (the all_gathers go out in bucket order, the same on every rank)
+        for b in self.grad_buckets.completed():
+            for p, _, offset, length in self.grad_buckets.slots[b]:
+                group = self.group_of[p]
+                beta1, beta2 = group['betas']
                 rank_size = p.shape[0] // world_size
                 p_slice = p[rank * rank_size:(rank + 1) * rank_size]
+                g_slice = self.grad_buckets.shard(b, offset, length).view_as(p_slice)
                 lr = group['lr'] * getattr(p, "lr_mul", 1.0)
                 state = self.state[p]
-                g_slice = grad_slices[idx]
                 # State init
                 if not state:
                     state['step'] = torch.tensor(0, dtype=torch.int64, device=p.device)
                     state['exp_avg'] = torch.zeros_like(p_slice)
                     state['exp_avg_sq'] = torch.zeros_like(p_slice)
-                exp_avg = state['exp_avg']
-                exp_avg_sq = state['exp_avg_sq']
                 state['step'] += 1
-                t = state['step']
-                # weight decay
-                if wd != 0:
-                    eff_weight_decay = lr * wd * getattr(p, "wd_mul", 1.0)
-                    p_slice.mul_(1 - eff_weight_decay)
-                # update running averages
-                exp_avg.mul_(beta1).add_(g_slice, alpha=1 - beta1)
-                exp_avg_sq.mul_(beta2).addcmul_(g_slice, g_slice, value=1 - beta2)
-                # bias corrections
-                bias1 = 1 - beta1 ** t
-                bias2 = 1 - beta2 ** t
-                # compute step
-                denom = exp_avg_sq.sqrt().add_(eps)
-                step_size = lr * (torch.sqrt(bias2) / bias1)
-                update = exp_avg.div(denom).mul_(step_size)
-                p_slice.add_(other=update, alpha=-1.0)
-                idx += 1
-                all_reduce_futures.append(dist.all_gather_into_tensor(p, p_slice, async_op=True).get_future())
-        torch.futures.collect_all(all_reduce_futures).wait()
+                # the scalars that change over training go in as 0-d device tensors, filled without a sync, see adamw_update_
+                if p not in self.scalars:
+                    self.scalars[p] = (torch.zeros((), device=p.device), torch.zeros((), device=p.device))
+                lr_t, wd_t = self.scalars[p]
+                lr_t.fill_(lr)
+                wd_t.fill_(lr * group['weight_decay'] * getattr(p, "wd_mul", 1.0))
+                adamw_update_(p_slice, g_slice, state['exp_avg'], state['exp_avg_sq'], state['step'], lr_t, wd_t, beta1, beta2, group['eps'])
+            for ready in self.grad_buckets.ready_in_order(b):
+                for p, _, _, _ in self.grad_buckets.slots[ready]:
+                    rank_size = p.shape[0] // world_size
+                    all_gather_futures.append(all_gather_shards(p, p[rank * rank_size:(rank + 1) * rank_size], world_size))
+        torch.futures.collect_all(all_gather_futures).wait()
+
+
+def all_gather_shards(p, p_slice, world_size):
+    """Replicate the dim 0 shards of p across ranks (all_gather_into_tensor where supported, e.g. not on gloo)."""
+    if dist.get_backend() == "nccl":
+        return dist.all_gather_into_tensor(p, p_slice, async_op=True).get_future()
+    return dist.all_gather(list(p.chunk(world_size)), p_slice.clone(), async_op=True).get_future()
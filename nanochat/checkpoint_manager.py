@@ -1,16 +1,32 @@
 """
 Utilities for saving and loading model/optim/state checkpoints.
+
+Next to every model_<step>.pt there is a model_<step>.safetensors with the same tensors in the
+flat safetensors layout (a json header, then the raw bytes of every tensor back to back). It is
+what build_model loads: the file is memory-mapped and the tensors are views into it, so loading
+costs (about) one read of the weights, and nothing is unpickled, allocated twice or initialized.
+
+Every file is written to a temporary file and renamed, and manifest_<step>.json is written last:
+only the steps with a manifest are complete checkpoints, the loaders ignore the others (e.g. a
+background save that was interrupted). The steps saved before manifests (the ones before the
+first manifest of the directory) are complete if their model file is there.
 """
 import glob
 import json
 import logging
 import os
 import re
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
 
 import torch
+import torch.distributed as dist
 
 from nanochat.common import get_base_dir, setup_default_logging
 from nanochat.gpt import GPT, GPTConfig
+from nanochat.quantize import quantize_model
 from nanochat.tokenizer import get_tokenizer
 
 # Set up logging
@@ -20,33 +36,118 @@ def log0(message):
     if int(os.environ.get('RANK', 0)) == 0:
         logger.info(message)
 
-def save_checkpoint(checkpoint_dir, step, model_data, optimizer_data, meta_data):
+# dtype names of the safetensors format
+SAFETENSORS_DTYPES = {
+    torch.float64: "F64", torch.float32: "F32", torch.float16: "F16", torch.bfloat16: "BF16",
+    torch.int64: "I64", torch.int32: "I32", torch.int16: "I16", torch.int8: "I8", torch.uint8: "U8", torch.bool: "BOOL",
+}
+
+def save_flat_state_dict(path, state_dict):
+    """Write a state_dict of tensors in the safetensors layout (written to a temporary file, then renamed)."""
+    # larger elements first, so that every tensor's offset is a multiple of its element size (the header is padded to 8 bytes)
+    names = sorted(state_dict, key=lambda name: -state_dict[name].element_size())
+    header, offset = {}, 0
+    for name in names:
+        tensor = state_dict[name]
+        nbytes = tensor.numel() * tensor.element_size()
+        header[name] = {"dtype": SAFETENSORS_DTYPES[tensor.dtype], "shape": list(tensor.shape), "data_offsets": [offset, offset + nbytes]}
+        offset += nbytes
+    header_bytes = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    header_bytes += b" " * (-len(header_bytes) % 8)
+    tmp_path = path + f".tmp{os.getpid()}"
+    with open(tmp_path, "wb") as f:
+        f.write(struct.pack("<Q", len(header_bytes)))
+        f.write(header_bytes)
+        for name in names:
+            tensor = state_dict[name].detach().contiguous().cpu()
+            f.write(tensor.view(-1).view(torch.uint8).numpy())
+    os.replace(tmp_path, path)
+
+def load_flat_state_dict(path, device):
+    """Memory-map a file written by save_flat_state_dict. On CPU the tensors are (copy-on-write) views into the file."""
+    with open(path, "rb") as f:
+        header_size = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_size))
+    header.pop("__metadata__", None)
+    data_start = 8 + header_size
+    buffer = torch.from_file(path, shared=False, size=os.path.getsize(path), dtype=torch.uint8)
+    dtypes = {name: dtype for dtype, name in SAFETENSORS_DTYPES.items()}
+    state_dict = {}
+    for name, info in header.items():
+        start, end = info["data_offsets"]
+        tensor = buffer[data_start + start:data_start + end].view(dtypes[info["dtype"]]).view(info["shape"])
+        state_dict[name] = tensor if torch.device(device).type == "cpu" else tensor.to(device)
+    return state_dict
+
+def atomic_torch_save(obj, path):
+    """torch.save to a temporary file, then rename: path is either complete or not there."""
+    tmp_path = path + f".tmp{os.getpid()}"
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+def write_manifest(checkpoint_dir, step, files, world_size=1):
+    """The last file of a checkpoint: lists the others, its presence means they are all complete."""
+    manifest_path = os.path.join(checkpoint_dir, f"manifest_{step:06d}.json")
+    tmp_path = manifest_path + f".tmp{os.getpid()}"
+    with open(tmp_path, "w") as f:
+        json.dump({"step": step, "world_size": world_size, "files": files}, f, indent=2)
+    os.replace(tmp_path, manifest_path)
+    return manifest_path
+
+def save_checkpoint(checkpoint_dir, step, model_data, optimizer_data, meta_data, manifest=True):
+    """manifest=False leaves the checkpoint incomplete, for the caller to write the manifest (see AsyncCheckpointer)."""
     assert int(os.environ.get('RANK', 0)) == 0 # prevent footguns for now
     os.makedirs(checkpoint_dir, exist_ok=True)
     # Save the model state (parameters)
     model_path = os.path.join(checkpoint_dir, f"model_{step:06d}.pt")
-    torch.save(model_data, model_path)
+    atomic_torch_save(model_data, model_path)
     log0(f"Saved model file to: {model_path}")
+    # ...and again in the flat format, which is what build_model loads (fast, memory-mapped)
+    flat_path = os.path.join(checkpoint_dir, f"model_{step:06d}.safetensors")
+    save_flat_state_dict(flat_path, strip_compile_prefix(model_data))
+    log0(f"Saved flat model file to: {flat_path}")
     # Save the optimizer state (useful for SFT or any other fine-tuning)
+    files = [f"model_{step:06d}.pt", f"model_{step:06d}.safetensors", f"meta_{step:06d}.json"]
     if optimizer_data is not None:
         optimizer_path = os.path.join(checkpoint_dir, f"optim_{step:06d}.pt")
-        torch.save(optimizer_data, optimizer_path)
+        atomic_torch_save(optimizer_data, optimizer_path)
         log0(f"Saved optimizer file to: {optimizer_path}")
+        files.append(f"optim_{step:06d}.pt")
     # Save the metadata dict as json
     meta_path = os.path.join(checkpoint_dir, f"meta_{step:06d}.json")
-    with open(meta_path, "w") as f:
+    with open(meta_path + f".tmp{os.getpid()}", "w") as f:
         json.dump(meta_data, f, indent=2)
+    os.replace(meta_path + f".tmp{os.getpid()}", meta_path)
     log0(f"Saved metadata file to: {meta_path}")
+    if manifest:
+        write_manifest(checkpoint_dir, step, files)
+    return files
+
+
+def checkpoint_steps(checkpoint_dir):
+    """The steps of the complete checkpoints in checkpoint_dir (sorted), see the module docstring."""
+    step_of = lambda f: int(os.path.basename(f).split("_")[-1].split(".")[0])
+    steps = {step_of(f) for f in glob.glob(os.path.join(checkpoint_dir, "manifest_*.json"))}
+    # the steps from before manifests: every model file counts
+    first_manifest = min(steps, default=float("inf"))
+    steps.update(s for s in map(step_of, glob.glob(os.path.join(checkpoint_dir, "model_*.pt"))) if s < first_manifest)
+    return sorted(steps)
 
 
-def load_checkpoint(checkpoint_dir, step, device, load_optimizer=False):
+def load_checkpoint(checkpoint_dir, step, device, load_optimizer=False, load_model=True):
+    if step not in checkpoint_steps(checkpoint_dir):
+        raise FileNotFoundError(f"No complete checkpoint of step {step} in {checkpoint_dir} (no manifest_{step:06d}.json)")
     # Load the model state
-    model_path = os.path.join(checkpoint_dir, f"model_{step:06d}.pt")
-    model_data = torch.load(model_path, map_location=device)
+    model_data = None
+    if load_model:
+        model_path = os.path.join(checkpoint_dir, f"model_{step:06d}.pt")
+        model_data = torch.load(model_path, map_location=device)
     # Load the optimizer state if requested
     optimizer_data = None
     if load_optimizer:
-        optimizer_path = os.path.join(checkpoint_dir, f"optim_{step:06d}.pt")
+        # the optimizer states of DistAdamW/DistMuon are sharded by rank, see AsyncCheckpointer
+        shard_path = os.path.join(checkpoint_dir, f"optim_{step:06d}_rank{int(os.environ.get('RANK', 0))}.pt")
+        optimizer_path = shard_path if os.path.exists(shard_path) else os.path.join(checkpoint_dir, f"optim_{step:06d}.pt")
         optimizer_data = torch.load(optimizer_path, map_location=device)
     # Load the metadata
     meta_path = os.path.join(checkpoint_dir, f"meta_{step:06d}.json")
@@ -55,27 +156,155 @@ def load_checkpoint(checkpoint_dir, step, device, load_optimizer=False):
     return model_data, optimizer_data, meta_data
 
 
-def build_model(checkpoint_dir, step, device, phase):
+class AsyncCheckpointer:
+    """
+    Saves checkpoints in a background thread: training only stalls for the copy of the tensors
+    to (pinned, reused across saves) CPU memory, the files are written while it carries on.
+    save() is called on every rank: rank 0 writes the model and the meta data, and every rank
+    writes its own optimizer shard optim_<step>_rank<r>.pt (the DistAdamW/DistMuon states are
+    sharded by rank). Once every rank has written its files, which the background threads agree
+    on with a collective (on a gloo group of their own, so the training collectives are not
+    involved), rank 0 writes manifest_<step>.json: a checkpoint without its manifest is incomplete.
+    The ranks don't need to share a filesystem to save, but every rank loads from checkpoint_dir.
+    Only one save is in flight at a time. A save with optimizer shards must be made by all ranks
+    (a save without, e.g. chat_rl's, only by rank 0). If a rank fails to write its shard, or does
+    not get there within shard_timeout seconds (e.g. it died), the save fails on every rank, and
+    the error is raised by the next save() or wait().
+    Construct it on every rank (the gloo group is created then).
+    """
+
+    def __init__(self, shard_timeout=600):
+        self.shard_timeout = shard_timeout
+        distributed = dist.is_available() and dist.is_initialized()
+        self.rank = dist.get_rank() if distributed else 0
+        self.world_size = dist.get_world_size() if distributed else 1
+        self.group = dist.new_group(backend="gloo", timeout=timedelta(seconds=shard_timeout)) if self.world_size > 1 else None
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.future = None
+        self.buffers = {} # pinned CPU copies of the tensors, by their path in the saved structure
+
+    def _snapshot(self, obj, path=""):
+        if isinstance(obj, torch.Tensor):
+            if obj.device.type == "cpu":
+                return obj.detach().clone()
+            buffer = self.buffers.get(path)
+            if buffer is None or buffer.shape != obj.shape or buffer.dtype != obj.dtype:
+                buffer = torch.empty(obj.shape, dtype=obj.dtype, pin_memory=obj.device.type == "cuda")
+                self.buffers[path] = buffer
+            buffer.copy_(obj.detach(), non_blocking=True)
+            return buffer
+        if isinstance(obj, dict):
+            return {k: self._snapshot(v, f"{path}/{k}") for k, v in obj.items()}
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(self._snapshot(v, f"{path}/{i}") for i, v in enumerate(obj))
+        return obj
+
+    def save(self, checkpoint_dir, step, model_data, optimizer_data, meta_data):
+        """Snapshot the state (model_data is only used on rank 0) and write it in the background."""
+        self.wait() # the previous save owns the pinned buffers until it's written
+        t0 = time.time()
+        model_data = self._snapshot(model_data, "model") if self.rank == 0 else None
+        optimizer_data = self._snapshot(optimizer_data, "optim") if optimizer_data is not None else None
+        if torch.cuda.is_available():
+            torch.cuda.synchronize() # the non_blocking copies are done
+        log0(f"Checkpoint snapshot of step {step} took {time.time() - t0:.2f}s, writing in the background")
+        self.future = self.executor.submit(self._write, checkpoint_dir, step, model_data, optimizer_data, meta_data)
+
+    def _write(self, checkpoint_dir, step, model_data, optimizer_data, meta_data):
+        error, files = None, []
+        try:
+            os.makedirs(checkpoint_dir, exist_ok=True)
+            if optimizer_data is not None:
+                atomic_torch_save(optimizer_data, os.path.join(checkpoint_dir, f"optim_{step:06d}_rank{self.rank}.pt"))
+            if self.rank == 0:
+                files = save_checkpoint(checkpoint_dir, step, model_data, None, meta_data, manifest=False)
+        except Exception as e:
+            error = e # still take part in the collective below, so that the other ranks learn about it
+        if optimizer_data is not None:
+            files += [f"optim_{step:06d}_rank{r}.pt" for r in range(self.world_size)]
+            if self.group is not None:
+                # every rank says whether its files are written (raises after shard_timeout if a rank never shows up)
+                written = torch.tensor([int(error is None)], dtype=torch.int32)
+                dist.all_reduce(written, op=dist.ReduceOp.MIN, group=self.group)
+                if error is None and written.item() == 0:
+                    error = RuntimeError(f"Checkpoint of step {step} incomplete: another rank failed to write its files")
+        if error is not None:
+            raise error
+        if self.rank != 0:
+            return
+        manifest_path = write_manifest(checkpoint_dir, step, files, self.world_size)
+        log0(f"Checkpoint of step {step} complete: {manifest_path}")
+
+    def wait(self):
+        """Block until the last save is written (re-raises its error, if any)."""
+        if self.future is not None:
+            future, self.future = self.future, None
+            future.result()
+
+
+def strip_compile_prefix(state_dict):
+    # torch.compile'd modules prepend all keys with _orig_mod.
+    return {k.removeprefix("_orig_mod."): v for k, v in state_dict.items()}
+
+
+def load_model_data(checkpoint_dir, step, device):
+    """The model state_dict of a checkpoint, from the flat file if there is one (else it's written now, for next time)."""
+    flat_path = os.path.join(checkpoint_dir, f"model_{step:06d}.safetensors")
+    if os.path.exists(flat_path):
+        return load_flat_state_dict(flat_path, device)
+    model_path = os.path.join(checkpoint_dir, f"model_{step:06d}.pt")
+    model_data = strip_compile_prefix(torch.load(model_path, map_location=device))
+    if int(os.environ.get('RANK', 0)) == 0:
+        try:
+            save_flat_state_dict(flat_path, model_data)
+            log0(f"Wrote flat model file for faster loading next time: {flat_path}")
+        except OSError:
+            pass # read-only checkpoint dir, fine, we'll just load the .pt again next time
+    return model_data
+
+
+def save_quantized_checkpoint(checkpoint_dir, step, model):
+    # The int8 weights live next to the float checkpoint they came from, and share its meta file
+    path = os.path.join(checkpoint_dir, f"int8_{step:06d}.pt")
+    torch.save(model.state_dict(), path)
+    log0(f"Saved int8 model file to: {path}")
+    return path
+
+
+def build_model(checkpoint_dir, step, device, phase, quantize=False):
     """
     A bunch of repetitive code to build a model from a given checkpoint.
+    With quantize=True the model gets int8 weights (see nanochat/quantize.py), loaded from the
+    exported int8 checkpoint if there is one, else quantized on the fly from the float one.
     Returns:
     - base model - uncompiled, not wrapped in DDP
     - tokenizer
     - meta data saved during base model training
     """
     assert phase in ["train", "eval"], f"Invalid phase: {phase}"
-    model_data, optimizer_data, meta_data = load_checkpoint(checkpoint_dir, step, device, load_optimizer=False)
-    # Hack: fix torch compile issue, which prepends all keys with _orig_mod.
-    model_data = {k.lstrip("_orig_mod."): v for k, v in model_data.items()}
+    assert not (quantize and phase == "train"), "int8 models are for inference only"
+    int8_path = os.path.join(checkpoint_dir, f"int8_{step:06d}.pt")
+    load_int8 = quantize and os.path.exists(int8_path)
+    _, _, meta_data = load_checkpoint(checkpoint_dir, step, device, load_optimizer=False, load_model=False)
+    if load_int8:
+        log0(f"Loading int8 model file: {int8_path}")
+        model_data = strip_compile_prefix(torch.load(int8_path, map_location=device))
+    else:
+        model_data = load_model_data(checkpoint_dir, step, device)
     model_config_kwargs = meta_data["model_config"]
     log0(f"Building model with config: {model_config_kwargs}")
     model_config = GPTConfig(**model_config_kwargs)
     with torch.device("meta"):
         model = GPT(model_config)
-    # Load the model state
-    model.to_empty(device=device)
-    model.init_weights() # note: this is dumb, but we need to init the rotary embeddings. TODO: fix model re-init
+        if load_int8:
+            quantize_model(model)
+    # Load the model state: the loaded tensors become the parameters (no allocation, no init),
+    # only the non-persistent buffers (the rotary embeddings) are computed
     model.load_state_dict(model_data, strict=True, assign=True)
+    model.init_rotary()
+    if quantize and not load_int8:
+        log0("No int8 checkpoint found, quantizing the float weights")
+        quantize_model(model)
     # Put the model in the right training phase / mode
     if phase == "eval":
         model.eval()
@@ -109,17 +338,16 @@ def find_largest_model(checkpoint_dir):
 
 
 def find_last_step(checkpoint_dir):
-    # Look into checkpoint_dir and find model_<step>.pt with the highest step
-    checkpoint_files = glob.glob(os.path.join(checkpoint_dir, "model_*.pt"))
-    if not checkpoint_files:
+    # Look into checkpoint_dir and find the complete checkpoint with the highest step
+    steps = checkpoint_steps(checkpoint_dir)
+    if not steps:
         raise FileNotFoundError(f"No checkpoints found in {checkpoint_dir}")
-    last_step = int(max(os.path.basename(f).split("_")[-1].split(".")[0] for f in checkpoint_files))
-    return last_step
+    return steps[-1]
 
 # -----------------------------------------------------------------------------
 # convenience functions that take into account nanochat's directory structure
 
-def load_model_from_dir(checkpoints_dir, device, phase, model_tag=None, step=None):
+def load_model_from_dir(checkpoints_dir, device, phase, model_tag=None, step=None, quantize=False):
     if model_tag is None:
         # guess the model tag by defaulting to the largest model
         model_tag = find_largest_model(checkpoints_dir)
@@ -131,10 +359,10 @@ def load_model_from_dir(checkpoints_dir, device, phase, model_tag=None, step=Non
     assert step is not None, f"No checkpoints found in {checkpoint_dir}"
     # build the model
     log0(f"Loading model from {checkpoint_dir} with step {step}")
-    model, tokenizer, meta_data = build_model(checkpoint_dir, step, device, phase)
+    model, tokenizer, meta_data = build_model(checkpoint_dir, step, device, phase, quantize=quantize)
     return model, tokenizer, meta_data
 
-def load_model(source, *args, **kwargs):
+def get_checkpoints_dir(source):
     model_dir = {
         "base": "base_checkpoints",
         "mid": "mid_checkpoints",
@@ -142,5 +370,8 @@ def load_model(source, *args, **kwargs):
         "rl": "chatrl_checkpoints",
     }[source]
     base_dir = get_base_dir()
-    checkpoints_dir = os.path.join(base_dir, model_dir)
+    return os.path.join(base_dir, model_dir)
+
+def load_model(source, *args, **kwargs):
+    checkpoints_dir = get_checkpoints_dir(source)
     return load_model_from_dir(checkpoints_dir, *args, **kwargs)
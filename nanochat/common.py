@@ -191,6 +191,48 @@ def compute_cleanup():
     if is_ddp():
         dist.destroy_process_group()
 
+def length_bucketed_batches(lengths, max_tokens, sizes=None):
+    """
+    Group items of similar length into batches, to waste little compute on padding.
+    - lengths[i]: the length item i gets padded to (its longest row)
+    - sizes[i]: the number of rows item i contributes to a batch (default 1)
+    Items are sorted by length and packed greedily while (number of rows) x (longest length)
+    stays within max_tokens. An item that does not fit on its own gets a batch to itself.
+    Returns a list of batches, each a list of item indices (in ascending length order).
+    """
+    sizes = sizes if sizes is not None else [1] * len(lengths)
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    batches, batch, num_rows = [], [], 0
+    for i in order:
+        # sorted ascending, so item i is the longest one of the batch if added
+        if batch and (num_rows + sizes[i]) * lengths[i] > max_tokens:
+            batches.append(batch)
+            batch, num_rows = [], 0
+        batch.append(i)
+        num_rows += sizes[i]
+    if batch:
+        batches.append(batch)
+    return batches
+
+def pack_sequences(lengths, capacity):
+    """
+    Pack sequences into rows of at most capacity tokens (first fit, longest first), so that
+    short sequences share a row instead of each being padded to the longest one.
+    Every length must be <= capacity. Returns a list of rows, each a list of sequence indices.
+    """
+    assert all(length <= capacity for length in lengths), "a sequence is longer than a row"
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+    rows, free = [], []
+    for i in order:
+        r = next((r for r, space in enumerate(free) if lengths[i] <= space), None)
+        if r is None:
+            rows.append([])
+            free.append(capacity)
+            r = len(rows) - 1
+        rows[r].append(i)
+        free[r] -= lengths[i]
+    return rows
+
 class DummyWandb:
     """Useful if we wish to not use wandb but have all the same signatures"""
     def __init__(self):
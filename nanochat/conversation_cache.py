@@ -0,0 +1,110 @@
+"""
+On-disk cache of Tasks (or TaskMixtures) rendered to tokens, for SFT and midtraining.
+
+Rendering conversations with tokenizer.render_conversation is slow Python, and the training
+loops used to do it for every conversation, every epoch, on the main thread. Instead, a Task
+is rendered once into three flat arrays:
+- ids.bin: the tokens of all conversations back to back (uint32)
+- mask.bin: the matching training mask (uint8, 1 = train on this token)
+- offsets.npy: conversation i is [offsets[i], offsets[i+1]) in the two arrays above
+which are memory-mapped by every rank (and every later run with the same mixture).
+
+The cache key covers the task (recursively for mixtures: classes, slicing, configs, and the
+fingerprints of the underlying HuggingFace datasets / data), the tokenizer, and the code of
+render_conversation, so a stale cache is never picked up.
+
+Example:
+    rendered = render_task(train_ds, tokenizer, "sft_train")
+    ids, mask = rendered[i] # numpy arrays
+"""
+
+import hashlib
+import inspect
+import os
+import time
+
+import numpy as np
+import torch.distributed as dist
+
+from nanochat.common import get_base_dir, print0
+from nanochat.prompt_cache import cache_key, data_fingerprint, tokenizer_fingerprint
+
+
+def task_fingerprint(task):
+    """A json-able description of everything the conversations of a task depend on."""
+    parts = {"class": type(task).__name__, "len": len(task)}
+    for name, value in sorted(vars(task).items()):
+        if name == "tasks": # TaskMixture / TaskSequence
+            parts[name] = [task_fingerprint(t) for t in value]
+        elif isinstance(value, (int, float, str, bool, type(None))):
+            parts[name] = value
+        elif hasattr(value, "_fingerprint"): # a HuggingFace dataset, its fingerprint covers the data and any shuffle/map
+            parts[name] = value._fingerprint
+        elif isinstance(value, np.ndarray):
+            parts[name] = hashlib.sha256(value.tobytes()).hexdigest()
+        elif isinstance(value, (list, tuple, dict)):
+            parts[name] = data_fingerprint(value)
+        else:
+            raise ValueError(f"Don't know how to fingerprint {type(task).__name__}.{name} of type {type(value)}")
+    return parts
+
+
+class RenderedTask:
+    """A rendered Task, memory-mapped. rendered[i] -> (ids, mask) of conversation i, as numpy arrays."""
+
+    def __init__(self, path):
+        self.offsets = np.load(os.path.join(path, "offsets.npy"))
+        num_tokens = int(self.offsets[-1])
+        if num_tokens > 0:
+            self.ids = np.memmap(os.path.join(path, "ids.bin"), dtype=np.uint32, mode="r", shape=(num_tokens,))
+            self.mask = np.memmap(os.path.join(path, "mask.bin"), dtype=np.uint8, mode="r", shape=(num_tokens,))
+        else:
+            self.ids, self.mask = np.zeros(0, dtype=np.uint32), np.zeros(0, dtype=np.uint8) # can't mmap an empty file
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        start, end = self.offsets[index], self.offsets[index + 1]
+        return self.ids[start:end], self.mask[start:end]
+
+
+def build_rendered_task(task, tokenizer, path):
+    """Render all the conversations of task into path (written to a temporary directory first, then renamed)."""
+    tmp_path = path + f".tmp{os.getpid()}"
+    os.makedirs(tmp_path, exist_ok=True)
+    offsets = np.zeros(len(task) + 1, dtype=np.int64)
+    t0 = time.time()
+    with open(os.path.join(tmp_path, "ids.bin"), "wb") as f_ids, open(os.path.join(tmp_path, "mask.bin"), "wb") as f_mask:
+        for i in range(len(task)):
+            ids, mask = tokenizer.render_conversation(task[i])
+            np.asarray(ids, dtype=np.uint32).tofile(f_ids)
+            np.asarray(mask, dtype=np.uint8).tofile(f_mask)
+            offsets[i + 1] = offsets[i] + len(ids)
+            if (i + 1) % 50_000 == 0:
+                print0(f"Rendered {i + 1:,}/{len(task):,} conversations ({time.time() - t0:.0f}s)")
+    np.save(os.path.join(tmp_path, "offsets.npy"), offsets)
+    os.replace(tmp_path, path)
+
+
+def render_task(task, tokenizer, name):
+    """
+    The RenderedTask of task, built on first use. In DDP rank 0 builds it while the other ranks
+    wait for it to appear (polling the filesystem, rendering a big mixture can outlast a collective's timeout).
+    """
+    key = cache_key(
+        task=task_fingerprint(task),
+        tokenizer=tokenizer_fingerprint(tokenizer),
+        render=hashlib.sha256(inspect.getsource(type(tokenizer).render_conversation).encode("utf-8")).hexdigest(),
+    )
+    path = os.path.join(get_base_dir(), "conversation_cache", f"{name}_{key}")
+    rank = dist.get_rank() if dist.is_initialized() else 0
+    if not os.path.exists(path):
+        if rank == 0:
+            print0(f"Rendering {len(task):,} conversations of {name} to {path}")
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            build_rendered_task(task, tokenizer, path)
+        else:
+            while not os.path.exists(path):
+                time.sleep(1)
+    return RenderedTask(path)
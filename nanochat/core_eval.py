@@ -11,18 +11,40 @@ import torch
 import torch.distributed as dist
 from jinja2 import Template
 
+from nanochat.common import length_bucketed_batches
+from nanochat.engine import KVCache
+from nanochat.gpt import GPT
+from nanochat.prompt_cache import cache_key, data_fingerprint, load_or_build, tokenizer_fingerprint
+
 # -----------------------------------------------------------------------------
 # Prompt rendering utilities
 
-def render_prompts_mc(item, continuation_delimiter, fewshot_examples=None):
-    """Render complete prompts for a multiple choice question"""
-    template_str = """
+# The templates are compiled once, at import time
+MC_TEMPLATE = Template("""
 {%- for example in fewshot_examples -%}
 {{ example.query }}{{ continuation_delimiter }}{{ example.choices[example.gold] }}
 
 {% endfor -%}
-{{ item.query }}{{ continuation_delimiter }}{{ choice }}""".strip()
-    template = Template(template_str)
+{{ item.query }}{{ continuation_delimiter }}{{ choice }}""".strip())
+
+SCHEMA_TEMPLATE = Template("""
+{%- for example in fewshot_examples -%}
+{{ example.context_options[example.gold] }}{{ continuation_delimiter }}{{ example.continuation }}
+
+{% endfor -%}
+{{ context }}{{ continuation_delimiter }}{{ item.continuation }}""".strip())
+
+LM_TEMPLATE = Template("""
+{%- for example in fewshot_examples -%}
+{{ example.context | trim }}{{ continuation_delimiter }}{{ example.continuation }}
+
+{% endfor -%}
+{{ item.context | trim }}{{ continuation_delimiter }}{% if include_continuation %}{{ item.continuation }}{% endif %}""".strip())
+
+
+def render_prompts_mc(item, continuation_delimiter, fewshot_examples=None):
+    """Render complete prompts for a multiple choice question"""
+    template = MC_TEMPLATE
     fewshot_examples = fewshot_examples or []
     context = {
         'fewshot_examples': fewshot_examples,
@@ -35,13 +57,7 @@ def render_prompts_mc(item, continuation_delimiter, fewshot_examples=None):
 
 def render_prompts_schema(item, continuation_delimiter, fewshot_examples=None):
     """Render complete prompts for a schema question"""
-    template_str = """
-{%- for example in fewshot_examples -%}
-{{ example.context_options[example.gold] }}{{ continuation_delimiter }}{{ example.continuation }}
-
-{% endfor -%}
-{{ context }}{{ continuation_delimiter }}{{ item.continuation }}""".strip()
-    template = Template(template_str)
+    template = SCHEMA_TEMPLATE
     fewshot_examples = fewshot_examples or []
     context = {
         'fewshot_examples': fewshot_examples,
@@ -59,13 +75,7 @@ def render_prompts_lm(item, continuation_delimiter, fewshot_examples=None):
     Notice that we manually trim the context in the template,
     which in some datasets seems to have trailing whitespace (which we don't want).
     """
-    template_str = """
-{%- for example in fewshot_examples -%}
-{{ example.context | trim }}{{ continuation_delimiter }}{{ example.continuation }}
-
-{% endfor -%}
-{{ item.context | trim }}{{ continuation_delimiter }}{% if include_continuation %}{{ item.continuation }}{% endif %}""".strip()
-    template = Template(template_str)
+    template = LM_TEMPLATE
     fewshot_examples = fewshot_examples or []
     context = {
         'fewshot_examples': fewshot_examples,
@@ -111,18 +121,26 @@ def stack_sequences(tokens, pad_token_id):
 
 
 def batch_sequences_mc(tokenizer, prompts):
-    # In multiple choice, contexts are the same but the continuation is different (common prefix)
     tokens = tokenizer(prompts, prepend=tokenizer.get_bos_token_id())
+    return spans_mc(tokens)
+
+
+def spans_mc(tokens):
+    # In multiple choice, contexts are the same but the continuation is different (common prefix)
     # figure out the start and end of each continuation
     answer_start_idx = find_common_length(tokens, direction='left')
-    start_indices = [answer_start_idx] * len(prompts)
+    start_indices = [answer_start_idx] * len(tokens)
     end_indices = [len(x) for x in tokens]
     return tokens, start_indices, end_indices
 
 
 def batch_sequences_schema(tokenizer, prompts):
-    # In schema tasks, contexts vary but continuation is the same (common suffix)
     tokens = tokenizer(prompts, prepend=tokenizer.get_bos_token_id())
+    return spans_schema(tokens)
+
+
+def spans_schema(tokens):
+    # In schema tasks, contexts vary but continuation is the same (common suffix)
     # figure out the start and end of each context
     suffix_length = find_common_length(tokens, direction='right')
     end_indices = [len(x) for x in tokens]
@@ -131,8 +149,12 @@ def batch_sequences_schema(tokenizer, prompts):
 
 
 def batch_sequences_lm(tokenizer, prompts):
-    # In LM tasks, we have two prompts: without and with continuation
     tokens = tokenizer(prompts, prepend=tokenizer.get_bos_token_id())
+    return spans_lm(tokens)
+
+
+def spans_lm(tokens):
+    # In LM tasks, we have two prompts: without and with continuation
     tokens_without, tokens_with = tokens
     start_idx, end_idx = len(tokens_without), len(tokens_with)
     assert start_idx < end_idx, "prompt without is supposed to be a prefix of prompt with"
@@ -164,9 +186,17 @@ def forward_model(model, input_ids):
     return losses, predictions
 
 
-@torch.no_grad()
-def evaluate_example(idx, model, tokenizer, data, device, task_meta):
-    """Evaluate a single example, return True if correct, False otherwise"""
+def sample_fewshot(idx, n, num_fewshot):
+    """
+    Indices of the few-shot examples for example idx (never idx itself), out of n examples.
+    Same draws as rng.sample([i for i in range(n) if i != idx], num_fewshot), without building that list.
+    """
+    rng = random.Random(1234 + idx)
+    return [i + (i >= idx) for i in rng.sample(range(n - 1), num_fewshot)]
+
+
+def render_example(idx, data, task_meta):
+    """Render the prompts of a single example"""
     item = data[idx]
     task_type = task_meta['task_type']
     num_fewshot = task_meta['num_fewshot']
@@ -175,28 +205,28 @@ def evaluate_example(idx, model, tokenizer, data, device, task_meta):
     # Sample few-shot examples (excluding current item)
     fewshot_examples = []
     if num_fewshot > 0:
-        rng = random.Random(1234 + idx)
-        available_indices = [i for i in range(len(data)) if i != idx]
-        fewshot_indices = rng.sample(available_indices, num_fewshot)
-        fewshot_examples = [data[i] for i in fewshot_indices]
+        fewshot_examples = [data[i] for i in sample_fewshot(idx, len(data), num_fewshot)]
 
-    # Render prompts and batch sequences based on task type
+    # Render prompts based on task type
     if task_type == 'multiple_choice':
-        prompts = render_prompts_mc(item, continuation_delimiter, fewshot_examples)
-        tokens, start_idxs, end_idxs = batch_sequences_mc(tokenizer, prompts)
+        return render_prompts_mc(item, continuation_delimiter, fewshot_examples)
     elif task_type == 'schema':
-        prompts = render_prompts_schema(item, continuation_delimiter, fewshot_examples)
-        tokens, start_idxs, end_idxs = batch_sequences_schema(tokenizer, prompts)
+        return render_prompts_schema(item, continuation_delimiter, fewshot_examples)
     elif task_type == 'language_modeling':
-        prompts = render_prompts_lm(item, continuation_delimiter, fewshot_examples)
-        tokens, start_idxs, end_idxs = batch_sequences_lm(tokenizer, prompts)
+        return render_prompts_lm(item, continuation_delimiter, fewshot_examples)
     else:
         raise ValueError(f"Unsupported task type: {task_type}")
 
+
+def example_spans(task_type, tokens, max_seq_len=None):
+    """Given the tokenized prompts of an example, return its rows (tokens, start_idxs, end_idxs)"""
+    spans_fn = {'multiple_choice': spans_mc, 'schema': spans_schema, 'language_modeling': spans_lm}[task_type]
+    tokens, start_idxs, end_idxs = spans_fn(tokens)
+
     # Some models can't forward sequences beyond a certain length (e.g. GPT-2)
     # In these cases, we have to truncate sequences to max length and adjust the indices
-    if hasattr(model, 'max_seq_len') and model.max_seq_len is not None:
-        max_tokens = model.max_seq_len
+    if max_seq_len is not None:
+        max_tokens = max_seq_len
         new_tokens, new_start_idxs, new_end_idxs = [], [], []
         for t, s, e in zip(tokens, start_idxs, end_idxs):
             if len(t) > max_tokens:
@@ -212,15 +242,62 @@ def evaluate_example(idx, model, tokenizer, data, device, task_meta):
                 new_end_idxs.append(e)
         tokens, start_idxs, end_idxs = new_tokens, new_start_idxs, new_end_idxs
 
-    # Stack up all the sequences into a batch
-    pad_token_id = tokenizer.get_bos_token_id() # use BOS as pad token is ok
-    input_ids = stack_sequences(tokens, pad_token_id)
-    input_ids = input_ids.to(device)
+    return tokens, start_idxs, end_idxs
 
-    # Forward the model, get the autoregressive loss and argmax prediction at each token
-    losses, predictions = forward_model(model, input_ids)
 
-    # See if the losses/predictions come out correctly
+def model_max_seq_len(model):
+    return getattr(model, 'max_seq_len', None)
+
+
+def prepare_example(idx, model, tokenizer, data, task_meta):
+    """Render and tokenize a single example. Returns its rows (tokens, start_idxs, end_idxs)."""
+    prompts = render_example(idx, data, task_meta)
+    tokens = tokenizer(prompts, prepend=tokenizer.get_bos_token_id())
+    return example_spans(task_meta['task_type'], tokens, model_max_seq_len(model))
+
+
+def prepare_examples(indices, model, tokenizer, data, task_meta):
+    """prepare_example for many examples, with a single (multi-threaded) tokenizer call"""
+    prompts = [render_example(idx, data, task_meta) for idx in indices]
+    flat_tokens = tokenizer([p for ps in prompts for p in ps], prepend=tokenizer.get_bos_token_id())
+    prepared, offset = [], 0
+    for ps in prompts:
+        tokens = flat_tokens[offset:offset + len(ps)]
+        prepared.append(example_spans(task_meta['task_type'], tokens, model_max_seq_len(model)))
+        offset += len(ps)
+    return prepared
+
+
+def prepare_task_cached(label, model, tokenizer, data, task_meta):
+    """
+    prepare_examples for all the examples of a task, through the on-disk prompt cache
+    (nanochat/prompt_cache.py), so that e.g. evaluating many checkpoints tokenizes only once.
+    """
+    key = cache_key(
+        label=label,
+        task_meta=task_meta,
+        tokenizer=tokenizer_fingerprint(tokenizer),
+        max_seq_len=model_max_seq_len(model),
+        data=data_fingerprint(data),
+    )
+    def build():
+        prepared = prepare_examples(range(len(data)), model, tokenizer, data, task_meta)
+        rows = [row for tokens, _, _ in prepared for row in tokens]
+        starts = [s for _, start_idxs, _ in prepared for s in start_idxs]
+        ends = [e for _, _, end_idxs in prepared for e in end_idxs]
+        num_rows = [len(tokens) for tokens, _, _ in prepared]
+        return {"rows": rows}, {"starts": starts, "ends": ends, "num_rows": num_rows}
+    ragged, flat = load_or_build(f"core_{label}", key, build)
+    prepared, offset = [], 0
+    for n in flat["num_rows"]:
+        rows_i = slice(offset, offset + n)
+        prepared.append((ragged["rows"][rows_i], flat["starts"][rows_i], flat["ends"][rows_i]))
+        offset += n
+    return prepared
+
+
+def score_example(item, task_type, input_ids, losses, predictions, start_idxs, end_idxs):
+    """Given the forward results for the rows of one example, return True if correct, False otherwise"""
     if task_type == 'language_modeling':
         # language modeling task is currently always batch size 1
         si = start_idxs[0]
@@ -237,22 +314,170 @@ def evaluate_example(idx, model, tokenizer, data, device, task_meta):
         is_correct = pred_idx == item['gold']
     else:
         raise ValueError(f"Unsupported task type: {task_type}")
-
     return is_correct
 
 
-def evaluate_task(model, tokenizer, data, device, task_meta):
+@torch.no_grad()
+def forward_model_shared_prefixes(model, examples, pad_token_id, device):
+    """
+    Same as forward_model (for the token rows of each example, padded here), for examples whose rows
+    all share their first prefix_len tokens, e.g. the few-shot context + question of a multiple choice
+    example. examples is a list of (tokens, prefix_len).
+    The prefixes of all the examples are forwarded together, once each (left padded, like the prompts of
+    the Engine: the padding is masked out of attention and skipped by the rotary positions, so every
+    token sits at the same position as in forward_model). The KV cache is expanded to one row per choice
+    of every example, and all the continuations are forwarded on top in one (right padded) batch.
+    Only positions from prefix_len-1 on get losses/predictions (the ones scoring looks at), the others are nan/-1.
+    Returns a list of (input_ids, losses, predictions), one per example.
+    """
+    m = model.config
+    kv_model_kwargs = {"num_heads": m.n_kv_head, "head_dim": m.n_embd // m.n_head, "num_layers": m.n_layer}
+    prefix_lens = [prefix_len for _, prefix_len in examples]
+    max_prefix_len = max(prefix_lens)
+    # 1) forward the prefixes, one row per example
+    prefixes = [[pad_token_id] * (max_prefix_len - prefix_len) + list(tokens[0][:prefix_len]) for tokens, prefix_len in examples]
+    kv_cache_prefix = KVCache(batch_size=len(examples), seq_len=max_prefix_len, **kv_model_kwargs)
+    if any(prefix_len < max_prefix_len for prefix_len in prefix_lens):
+        kv_cache_prefix.key_mask = torch.tensor([[False] * (max_prefix_len - prefix_len) + [True] * prefix_len for prefix_len in prefix_lens], dtype=torch.bool, device=device)
+    prefix_logits = model(torch.tensor(prefixes, dtype=torch.long, device=device), kv_cache=kv_cache_prefix)[:, -1:, :] # (E, 1, V)
+    # 2) expand the cache to one row per choice and forward the continuations
+    repeats = [len(tokens) for tokens, _ in examples]
+    continuation_ids = stack_sequences([row[prefix_len:] for tokens, prefix_len in examples for row in tokens], pad_token_id).to(device)
+    num_rows, continuation_len = continuation_ids.size()
+    kv_cache = KVCache(batch_size=num_rows, seq_len=max_prefix_len + continuation_len, **kv_model_kwargs)
+    kv_cache.prefill(kv_cache_prefix, repeats=repeats)
+    continuation_logits = model(continuation_ids, kv_cache=kv_cache) # (R, C, V)
+    # 3) the last logits of the prefix and all but the last of the continuation predict the continuation tokens
+    prefix_logits = prefix_logits.repeat_interleave(torch.tensor(repeats, device=device), dim=0)
+    logits = torch.cat([prefix_logits, continuation_logits[:, :-1]], dim=1) # (R, C, V)
+    continuation_losses = torch.nn.functional.cross_entropy(
+        logits.flatten(0, 1).float(),
+        continuation_ids.flatten(),
+        reduction='none'
+    ).view(num_rows, -1)
+    continuation_predictions = logits.argmax(dim=-1)
+    # 4) back to the rows of each example
+    outputs, offset = [], 0
+    for tokens, prefix_len in examples:
+        input_ids = stack_sequences(tokens, pad_token_id).to(device)
+        n, seq_len = input_ids.size()
+        rows_i = slice(offset, offset + n)
+        losses = torch.full((n, seq_len), float('nan'), dtype=torch.float32, device=device)
+        losses[:, prefix_len-1:-1] = continuation_losses[rows_i, :seq_len - prefix_len]
+        predictions = torch.full((n, seq_len), -1, dtype=torch.long, device=device)
+        predictions[:, prefix_len-1:-1] = continuation_predictions[rows_i, :seq_len - prefix_len]
+        outputs.append((input_ids, losses, predictions))
+        offset += n
+    return outputs
+
+
+def forward_model_shared_prefix(model, tokens, prefix_len, pad_token_id, device):
+    """forward_model_shared_prefixes for a single example. Returns input_ids, losses, predictions."""
+    return forward_model_shared_prefixes(model, [(tokens, prefix_len)], pad_token_id, device)[0]
+
+
+def shared_prefix_len(model, task_type, tokens, start_idxs):
+    """
+    The prefix length to use with forward_model_shared_prefix for an example,
+    or 0 if it is not worth it (and the example should go into a padded batch).
+    """
+    if task_type != 'multiple_choice' or not isinstance(model, GPT):
+        return 0 # needs our KV cache, and only MC rows share a prefix
+    # the prefix must leave at least one token of every row to forward on top of it
+    prefix_len = min(start_idxs[0], min(len(t) for t in tokens) - 1)
+    shared = prefix_len * (len(tokens) - 1) # tokens we would not forward again
+    return prefix_len if shared >= sum(len(t) for t in tokens) // 2 else 0
+
+
+@torch.no_grad()
+def evaluate_example(idx, model, tokenizer, data, device, task_meta):
+    """Evaluate a single example, return True if correct, False otherwise"""
+    tokens, start_idxs, end_idxs = prepare_example(idx, model, tokenizer, data, task_meta)
+
+    # Stack up all the sequences into a batch
+    pad_token_id = tokenizer.get_bos_token_id() # use BOS as pad token is ok
+    input_ids = stack_sequences(tokens, pad_token_id)
+    input_ids = input_ids.to(device)
+
+    # Forward the model, get the autoregressive loss and argmax prediction at each token
+    losses, predictions = forward_model(model, input_ids)
+
+    # See if the losses/predictions come out correctly
+    return score_example(data[idx], task_meta['task_type'], input_ids, losses, predictions, start_idxs, end_idxs)
+
+
+@torch.no_grad()
+def evaluate_examples(indices, model, tokenizer, data, device, task_meta, max_batch_tokens=8192, prepared=None):
+    """
+    Evaluate many examples with few forward passes. All the examples are tokenized up front,
+    then packed into length-bucketed batches of up to max_batch_tokens (padded) tokens, keeping
+    the rows of an example together. Right padding cannot affect earlier positions (causal
+    attention), so the results are the same as one example at a time, up to numerics.
+    Multiple choice examples whose choices share a long prefix (e.g. many-shot prompts) instead
+    forward that prefix only once, also in length-bucketed batches, see forward_model_shared_prefixes.
+    prepared: optionally the already prepared rows of these examples (aligned with indices).
+    Returns a dict {idx: is_correct}.
+    """
+    task_type = task_meta['task_type']
+    pad_token_id = tokenizer.get_bos_token_id() # use BOS as pad token is ok
+    if prepared is None:
+        prepared = prepare_examples(indices, model, tokenizer, data, task_meta)
+    results = {}
+    batched, shared, prefix_lens = [], [], {}
+    for i, (tokens, start_idxs, end_idxs) in enumerate(prepared):
+        prefix_len = shared_prefix_len(model, task_type, tokens, start_idxs)
+        if prefix_len > 0:
+            shared.append(i)
+            prefix_lens[i] = prefix_len
+        else:
+            batched.append(i)
+    lengths = [max(len(t) for t in prepared[i][0]) for i in shared]
+    sizes = [len(prepared[i][0]) for i in shared]
+    for bucket in length_bucketed_batches(lengths, max_batch_tokens, sizes):
+        batch = [shared[j] for j in bucket]
+        outputs = forward_model_shared_prefixes(model, [(prepared[i][0], prefix_lens[i]) for i in batch], pad_token_id, device)
+        for i, (input_ids, losses, predictions) in zip(batch, outputs):
+            tokens, start_idxs, end_idxs = prepared[i]
+            idx = indices[i]
+            results[idx] = score_example(data[idx], task_type, input_ids, losses.cpu(), predictions, start_idxs, end_idxs)
+    lengths = [max(len(t) for t in prepared[i][0]) for i in batched]
+    sizes = [len(prepared[i][0]) for i in batched]
+    for bucket in length_bucketed_batches(lengths, max_batch_tokens, sizes):
+        batch = [batched[j] for j in bucket]
+        rows = [row for i in batch for row in prepared[i][0]]
+        input_ids = stack_sequences(rows, pad_token_id)
+        losses, predictions = forward_model(model, input_ids.to(device))
+        # a single transfer per batch, then score every example on the cpu
+        losses, predictions = losses.cpu(), predictions.cpu()
+        offset = 0
+        for i in batch:
+            tokens, start_idxs, end_idxs = prepared[i]
+            rows_i = slice(offset, offset + len(tokens))
+            idx = indices[i]
+            results[idx] = score_example(data[idx], task_type, input_ids[rows_i], losses[rows_i], predictions[rows_i], start_idxs, end_idxs)
+            offset += len(tokens)
+    return results
+
+
+def evaluate_task(model, tokenizer, data, device, task_meta, max_batch_tokens=8192, label=None):
     """
     This function is responsible for evaluating one task across many examples.
     It also handles dispatch to all processes if the script is run with torchrun.
+    If the task label is given, the tokenized prompts go through the on-disk prompt cache.
     """
     rank = dist.get_rank() if dist.is_initialized() else 0
     world_size = dist.get_world_size() if dist.is_initialized() else 1
-    correct = torch.zeros(len(data), dtype=torch.float32, device=device)
+    correct = torch.zeros(len(data), dtype=torch.float32)
     # stride the examples to each rank
-    for idx in range(rank, len(data), world_size):
-        is_correct = evaluate_example(idx, model, tokenizer, data, device, task_meta)
+    indices = list(range(rank, len(data), world_size))
+    prepared = None
+    if label is not None:
+        prepared_all = prepare_task_cached(label, model, tokenizer, data, task_meta)
+        prepared = [prepared_all[idx] for idx in indices]
+    results = evaluate_examples(indices, model, tokenizer, data, device, task_meta, max_batch_tokens, prepared)
+    for idx, is_correct in results.items():
         correct[idx] = float(is_correct)
+    correct = correct.to(device)
     # sync results across all the processes if running distributed
     if world_size > 1:
         dist.barrier()
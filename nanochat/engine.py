@@ -11,9 +11,13 @@ Notes:
 The whole thing is made as efficient as possible.
 """
 
+import multiprocessing
+import queue
 import signal
+import threading
 import warnings
 from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from contextlib import contextmanager
 
 import torch
@@ -46,10 +50,11 @@ def eval_with_timeout(formula, max_time=3):
         # print(f"Warning: Failed to eval {formula}, exception: {e}") # it's ok ignore wrong calculator usage
         return None
 
-def use_calculator(expr):
+def calculator_expr(expr):
     """
-    Evaluate a Python expression safely.
+    Check that an expression is something the calculator tool is willing to evaluate.
     Supports both math expressions and string operations like .count()
+    Returns the cleaned up expression, or None if it is not allowed.
     """
     # Remove commas from numbers
     expr = expr.replace(",", "")
@@ -58,7 +63,7 @@ def use_calculator(expr):
     if all([x in "0123456789*+-/.() " for x in expr]):
         if "**" in expr:  # disallow power operator
             return None
-        return eval_with_timeout(expr)
+        return expr
 
     # Check if it's a string operation we support
     # Allow: strings (single/double quotes), .count(), letters, numbers, spaces, parens
@@ -78,33 +83,152 @@ def use_calculator(expr):
     if '.count(' not in expr:
         return None
 
+    return expr
+
+def use_calculator(expr):
+    """
+    Evaluate a Python expression safely, in this process.
+    Note that the timeout uses signal.alarm, so this only works on the main thread.
+    The Engine goes through a CalculatorPool instead.
+    """
+    expr = calculator_expr(expr)
+    if expr is None:
+        return None
     # Evaluate with timeout
     return eval_with_timeout(expr)
 
+def _calculator_worker(conn, max_time):
+    # Runs in its own process (so it has its own main thread for signal.alarm): evaluate until told to stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # ctrl-c is for the parent to handle
+    while True:
+        try:
+            expr = conn.recv()
+        except EOFError:
+            break
+        if expr is None:
+            break
+        conn.send(eval_with_timeout(expr, max_time))
+
+class CalculatorPool:
+    """
+    A few prewarmed worker processes that evaluate calculator expressions with a real timeout.
+    submit() returns a Future right away, so a decode loop never blocks on a tool call.
+    Workers time out with signal.alarm in their own main thread; as a backstop a worker that
+    does not answer in time (or crashes) is killed and replaced. Safe to share between threads.
+    """
+
+    def __init__(self, num_workers=2, timeout=3):
+        self.timeout = timeout
+        self.idle = queue.Queue()
+        for _ in range(num_workers):
+            self.idle.put(self._start_worker())
+        self.executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="calculator")
+
+    def _start_worker(self):
+        parent_conn, child_conn = multiprocessing.Pipe()
+        p = multiprocessing.Process(target=_calculator_worker, args=(child_conn, self.timeout), daemon=True)
+        p.start()
+        child_conn.close()
+        return p, parent_conn
+
+    def _run(self, expr):
+        p, conn = self.idle.get()
+        result, healthy = None, False
+        try:
+            conn.send(expr)
+            if conn.poll(self.timeout + 1):
+                result, healthy = conn.recv(), True
+        except (EOFError, OSError):
+            pass
+        if not healthy:
+            # hung or dead worker: replace it
+            p.kill()
+            p.join()
+            conn.close()
+            p, conn = self._start_worker()
+        self.idle.put((p, conn))
+        return result
+
+    def submit(self, expr):
+        """Evaluate an expression (already checked with calculator_expr) in the background."""
+        return self.executor.submit(self._run, expr)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        while not self.idle.empty():
+            p, conn = self.idle.get()
+            try:
+                conn.send(None)
+            except OSError:
+                pass
+            p.join(timeout=1)
+            if p.is_alive():
+                p.kill()
+            conn.close()
+
+_calculator_pool = None
+_calculator_pool_lock = threading.Lock()
+
+def get_calculator_pool():
+    """The process-wide CalculatorPool, started on first use."""
+    global _calculator_pool
+    with _calculator_pool_lock:
+        if _calculator_pool is None:
+            _calculator_pool = CalculatorPool()
+        return _calculator_pool
+
 # -----------------------------------------------------------------------------
+# Quantized KV cache storage: every (row, head, position) vector of head_dim values is stored
+# in 8 bits with its own fp32 scale (absmax / the largest representable value)
+KV_QUANT_MAX = {"int8": 127.0, "fp8": 448.0} # fp8 = float8_e4m3fn (a storage format here, the math is in the model dtype)
+
+def quantize_kv(x, mode):
+    """x (..., D) -> (8-bit values, fp32 scales (..., 1))."""
+    scale = x.abs().amax(dim=-1, keepdim=True).float().clamp(min=1e-8) / KV_QUANT_MAX[mode]
+    q = x.float() / scale
+    if mode == "int8":
+        q = q.round().clamp(-127, 127).to(torch.int8)
+    else:
+        q = q.to(torch.float8_e4m3fn)
+    return q, scale
+
+def dequantize_kv(q, scale, dtype):
+    return (q.float() * scale).to(dtype)
+
+
 class KVCache:
     """
     Works hand-in-hand with the GPT model to maintain the KV cache.
     Note that the .pos advances automatically after the last layer of the Transformer inserts.
+    quantize="int8"|"fp8" stores K/V in 8 bits (about half the memory of bf16, so twice the rows),
+    dequantized at read time, layer by layer (see quantize_kv).
     """
 
-    def __init__(self, batch_size, num_heads, seq_len, head_dim, num_layers):
+    def __init__(self, batch_size, num_heads, seq_len, head_dim, num_layers, quantize=None):
+        assert quantize in (None, "int8", "fp8"), f"Unknown KV cache quantization: {quantize}"
         # Each of K/V is of shape (B, H, T, D) and we have one per layer of the Transformer.
         self.kv_shape = (num_layers, 2, batch_size, num_heads, seq_len, head_dim)
         self.kv_cache = None
+        self.quantize = quantize
+        self.kv_scales = None # (L, 2, B, H, T, 1) fp32, if quantized
+        self.dtype = None # the dtype K/V come in (and are returned in)
         self.pos = 0 # current position in time in the cache
+        self.key_mask = None # (B, T) bool, False = key is masked out of attention. None = all valid
 
     def reset(self):
         self.pos = 0
+        self.key_mask = None
 
     def get_pos(self):
         return self.pos
 
-    def prefill(self, other):
+    def prefill(self, other, repeats=None):
         """
         Prefill given another KV cache. Optionally expand along batch dim.
         This is used when we do batch 1 prefill and then want to generate
         multiple samples in parallel from there.
+        repeats: optionally, how many rows each row of other becomes (a list that sums to the batch size),
+        by default every row is repeated batch_size // other's batch_size times.
         """
         # 1) validate the shapes
         assert self.kv_cache is None, "Cannot prefill a non-empty KV cache"
@@ -114,23 +238,79 @@ class KVCache:
                 # num_layers, batch_size, num_heads, head_dim must match
                 assert dim1 == dim2, f"Batch dim mismatch: {dim1} != {dim2}"
             elif ix == 2:
-                # batch_size can be expanded
-                assert dim1 == dim2 or dim2 == 1, f"Batch dim mismatch: {dim1} != {dim2}"
+                # batch_size can be expanded: each row of other is repeated dim1 // dim2 times (or as given)
+                if repeats is None:
+                    assert dim1 % dim2 == 0, f"Batch dim mismatch: {dim1} != {dim2}"
+                else:
+                    assert len(repeats) == dim2 and sum(repeats) == dim1, f"Batch dim mismatch: {dim1} != sum of {repeats}"
             elif ix == 4:
                 # seq_len: self must be longer than other
                 assert dim1 >= dim2, f"Seq len mismatch: {dim1} < {dim2}"
+        assert self.quantize == other.quantize, "Cannot prefill across KV cache storage formats"
+        if repeats is None:
+            repeats = self.kv_shape[2] // other.kv_shape[2]
+        else:
+            repeats = torch.tensor(repeats, dtype=torch.long, device=other.kv_cache.device)
+        expand = lambda x, dim: x if isinstance(repeats, int) and repeats == 1 else x.repeat_interleave(repeats, dim=dim)
         # 2) initialize the cache
-        dtype, device = other.kv_cache.dtype, other.kv_cache.device
-        self.kv_cache = torch.empty(self.kv_shape, dtype=dtype, device=device)
-        # 3) copy the data over
-        self.kv_cache[:, :, :, :, :other.pos, :] = other.kv_cache
+        device = other.kv_cache.device
+        self._allocate(other.dtype, device)
+        # 3) copy the data over (and the key mask, if the rows of other have keys masked out, e.g. padding)
+        other_kv = other.kv_cache[:, :, :, :, :other.pos, :]
+        self.kv_cache[:, :, :, :, :other.pos, :] = expand(other_kv, 2)
+        if self.quantize:
+            self.kv_scales[:, :, :, :, :other.pos, :] = expand(other.kv_scales[:, :, :, :, :other.pos, :], 2)
+        if other.key_mask is not None:
+            self.key_mask = torch.ones((self.kv_shape[2], max(self.kv_shape[4], other.pos)), dtype=torch.bool, device=device)
+            self.key_mask[:, :other.pos] = expand(other.key_mask[:, :other.pos], 0)
         # 4) update the pos
         self.pos = other.pos
 
+    def set_next_valid(self, valid):
+        """
+        Set, for each row, whether the key at the next position (self.pos) may be attended to.
+        Used for rows that are paused: they are fed a dummy token that nobody should see.
+        """
+        batch_size, seq_len = self.kv_shape[2], self.kv_shape[4]
+        if self.key_mask is None:
+            if all(valid):
+                return
+            self.key_mask = torch.ones((batch_size, max(seq_len, self.pos + 1)), dtype=torch.bool, device=self.kv_cache.device)
+        self.get_key_mask(self.pos + 1) # make sure it is long enough
+        self.key_mask[:, self.pos] = torch.tensor(valid, dtype=torch.bool, device=self.key_mask.device)
+
+    def get_key_mask(self, length):
+        """The key validity mask (B, length), or None if every key is valid."""
+        if self.key_mask is None:
+            return None
+        if self.key_mask.size(1) < length:
+            pad = torch.ones((self.key_mask.size(0), length - self.key_mask.size(1)), dtype=torch.bool, device=self.key_mask.device)
+            self.key_mask = torch.cat([self.key_mask, pad], dim=1)
+        return self.key_mask[:, :length]
+
+    def _allocate(self, dtype, device):
+        self.dtype = dtype
+        storage_dtype = {None: dtype, "int8": torch.int8, "fp8": torch.float8_e4m3fn}[self.quantize]
+        self.kv_cache = torch.empty(self.kv_shape, dtype=storage_dtype, device=device)
+        if self.quantize:
+            self.kv_scales = torch.empty(self.kv_shape[:-1] + (1,), dtype=torch.float32, device=device)
+
+    def _grow(self, t_needed):
+        # a new, longer buffer (resize_ would keep the flat storage, scrambling the (..., T, D) layout)
+        def grow(buffer):
+            shape = list(buffer.shape)
+            shape[4] = t_needed
+            new_buffer = torch.empty(shape, dtype=buffer.dtype, device=buffer.device)
+            new_buffer[:, :, :, :, :self.pos] = buffer[:, :, :, :, :self.pos]
+            return new_buffer
+        self.kv_cache = grow(self.kv_cache)
+        if self.quantize:
+            self.kv_scales = grow(self.kv_scales)
+
     def insert_kv(self, layer_idx, k, v):
         # Lazy initialize the cache here because we need to know the dtype/device
         if self.kv_cache is None:
-            self.kv_cache = torch.empty(self.kv_shape, dtype=k.dtype, device=k.device)
+            self._allocate(k.dtype, k.device)
         # Insert new keys/values to the cache and return the full cache so far
         B, H, T_add, D = k.size()
         t0, t1 = self.pos, self.pos + T_add
@@ -138,15 +318,25 @@ class KVCache:
         if t1 > self.kv_cache.size(4):
             t_needed = t1 + 1024 # as much as we need plus buffer of 1024
             t_needed = (t_needed + 1023) & ~1023 # then round up to the nearest multiple of 1024
-            current_shape = list(self.kv_cache.shape)
-            current_shape[4] = t_needed
-            self.kv_cache.resize_(current_shape)
-        # Insert k, v into the cache
-        self.kv_cache[layer_idx, 0, :, :, t0:t1] = k
-        self.kv_cache[layer_idx, 1, :, :, t0:t1] = v
-        # Return the full cached keys/values up to current position (as a view)
-        key_view = self.kv_cache[layer_idx, 0, :, :, :t1]
-        value_view = self.kv_cache[layer_idx, 1, :, :, :t1]
+            self._grow(t_needed)
+        if self.quantize:
+            # Store the 8-bit k, v, then read back the dequantized keys/values up to current position.
+            # The new positions are returned exactly, only what comes from the cache carries quantization error.
+            for i, x in enumerate((k, v)):
+                q, scale = quantize_kv(x, self.quantize)
+                self.kv_cache[layer_idx, i, :, :, t0:t1] = q
+                self.kv_scales[layer_idx, i, :, :, t0:t1] = scale
+            key_view = dequantize_kv(self.kv_cache[layer_idx, 0, :, :, :t1], self.kv_scales[layer_idx, 0, :, :, :t1], k.dtype)
+            value_view = dequantize_kv(self.kv_cache[layer_idx, 1, :, :, :t1], self.kv_scales[layer_idx, 1, :, :, :t1], v.dtype)
+            key_view[:, :, t0:t1] = k
+            value_view[:, :, t0:t1] = v
+        else:
+            # Insert k, v into the cache
+            self.kv_cache[layer_idx, 0, :, :, t0:t1] = k
+            self.kv_cache[layer_idx, 1, :, :, t0:t1] = v
+            # Return the full cached keys/values up to current position (as a view)
+            key_view = self.kv_cache[layer_idx, 0, :, :, :t1]
+            value_view = self.kv_cache[layer_idx, 1, :, :, :t1]
         # Increment pos after the last layer of the Transformer processes
         if layer_idx == self.kv_cache.size(0) - 1:
             self.pos = t1
@@ -176,23 +366,108 @@ def sample_next_token(logits, rng, temperature=1.0, top_k=None):
 
 class RowState:
     # Per-row state tracking during generation
-    def __init__(self, current_tokens=None):
-        self.current_tokens = current_tokens or [] # Current token sequence for this row
+    def __init__(self):
         self.forced_tokens = deque() # Queue of tokens to force inject
         self.in_python_block = False # Whether we are inside a python block
         self.python_expr_tokens = [] # Tokens of the current python expression
+        self.pending_result = None # Future of an in-flight calculator call, the row is paused until it resolves
         self.completed = False # Whether this row has completed generation
 
 class Engine:
 
-    def __init__(self, model, tokenizer):
+    def __init__(self, model, tokenizer, calculator_pool=None, kv_quantize=None):
         self.model = model
         self.tokenizer = tokenizer # needed for tool use
+        self._calculator_pool = calculator_pool
+        self.kv_quantize = kv_quantize # None | "int8" | "fp8": KV cache storage, see KVCache
+
+    @property
+    def calculator_pool(self):
+        # only start worker processes if the model actually uses the tool
+        if self._calculator_pool is None:
+            self._calculator_pool = get_calculator_pool()
+        return self._calculator_pool
+
+    def _process_column(self, row_states, sampled_tokens, special):
+        """
+        Choose the next token of every row (sampled, or forced by tool use) and advance the
+        per-row tool use state machine. Returns (token_column, token_masks).
+        A row waiting for its calculator result is paused: its token is None (mask 0).
+        """
+        python_start, python_end, output_start, output_end, assistant_end, bos = special
+        # Collect finished calculator calls. If every live row is waiting on one, there is nothing to decode meanwhile
+        waiting = [state for state in row_states if state.pending_result is not None]
+        if waiting:
+            if all(state.completed or state.pending_result is not None for state in row_states):
+                wait([state.pending_result for state in waiting], return_when=FIRST_COMPLETED)
+            for state in waiting:
+                if state.pending_result.done():
+                    result = state.pending_result.result()
+                    state.pending_result = None
+                    if result is not None:
+                        result_tokens = self.tokenizer.encode(str(result))
+                        state.forced_tokens.append(output_start)
+                        state.forced_tokens.extend(result_tokens)
+                        state.forced_tokens.append(output_end)
+        # Fast path: no row is inside a tool call and nothing interesting was sampled
+        busy = any(state.in_python_block or state.forced_tokens or state.pending_result is not None for state in row_states)
+        if not busy and python_start not in sampled_tokens and assistant_end not in sampled_tokens and bos not in sampled_tokens:
+            return list(sampled_tokens), [1] * len(sampled_tokens)
+        token_column = [] # contains the next token id along each row
+        token_masks = [] # contains the mask (was it sampled (1) or forced (0)?) along each row
+        for state, sampled_token in zip(row_states, sampled_tokens):
+            if state.pending_result is not None:
+                token_column.append(None)
+                token_masks.append(0)
+                continue
+            # Select the next token in this row
+            is_forced = len(state.forced_tokens) > 0 # are there tokens waiting to be forced in deque?
+            token_masks.append(0 if is_forced else 1) # mask is 0 if forced, 1 if sampled
+            next_token = state.forced_tokens.popleft() if is_forced else sampled_token
+            token_column.append(next_token)
+            # On <|assistant_end|> or <|bos|>, mark the row as completed
+            if next_token == assistant_end or next_token == bos:
+                state.completed = True
+            # Handle tool logic
+            if next_token == python_start:
+                state.in_python_block = True
+                state.python_expr_tokens = []
+            elif next_token == python_end and state.in_python_block:
+                state.in_python_block = False
+                if state.python_expr_tokens:
+                    expr = calculator_expr(self.tokenizer.decode(state.python_expr_tokens))
+                    if expr is not None:
+                        # evaluated in the background, the forced output tokens are queued once it is back
+                        state.pending_result = self.calculator_pool.submit(expr)
+                state.python_expr_tokens = []
+            elif state.in_python_block:
+                state.python_expr_tokens.append(next_token)
+        return token_column, token_masks
 
     @torch.inference_mode()
-    def generate(self, tokens, num_samples=1, max_tokens=None, temperature=1.0, top_k=None, seed=42):
-        """Same as generate, but does single prefill and then clones the KV cache."""
-        assert isinstance(tokens, list) and isinstance(tokens[0], int), "expecting list of ints"
+    def generate(self, tokens, num_samples=1, max_tokens=None, temperature=1.0, top_k=None, seed=42, sync_every=1):
+        """
+        Same as generate, but does single prefill and then clones the KV cache.
+        tokens is either one prompt (list of ints), replicated num_samples times, or a list of
+        prompts (list of lists of ints, possibly of different lengths), each replicated num_samples
+        times: row i is then a sample of prompt i // num_samples. Prompts are left padded to a
+        common length and the padding keys are masked out of attention and skipped by the rotary
+        positions (see GPT.forward), so the padding does not change what a row computes.
+        With sync_every > 1, up to that many decode steps run back to back on the device
+        (inputs fed from the previous step's samples, no host round trip), and their token
+        columns are then copied to the host in one go and yielded in a burst. If tool use
+        forces a token in the middle of such a chunk, the steps sampled after it are dropped
+        and the KV cache is rolled back, so at temperature 0 the output does not depend on
+        sync_every. Streaming callers should keep the default of 1 (lowest latency).
+        Calculator calls run in a CalculatorPool. While a row waits for its result, the other
+        rows keep decoding and the waiting row yields None; it is fed a dummy token whose key is
+        masked out of attention. With a single live row there is nothing to overlap, so generation
+        just waits for the result and None is never yielded.
+        """
+        assert isinstance(tokens, list) and len(tokens) > 0, "expecting a non-empty list"
+        prompts = [tokens] if isinstance(tokens[0], int) else tokens
+        assert all(isinstance(prompt, list) and isinstance(prompt[0], int) for prompt in prompts), "expecting list(s) of ints"
+        assert sync_every >= 1, "sync_every must be at least 1"
         device = self.model.get_device()
         rng = torch.Generator(device=device)
         rng.manual_seed(seed)
@@ -205,25 +480,32 @@ class Engine:
         output_end = get_special("<|output_end|>")
         assistant_end = get_special("<|assistant_end|>") # if sampled, ends row
         bos = self.tokenizer.get_bos_token_id() # if sampled, ends row
+        special = (python_start, python_end, output_start, output_end, assistant_end, bos)
 
-        # 1) Run a batch 1 prefill of the prompt tokens
+        # 1) Run a prefill of the prompt tokens, one row per prompt (left padded with masked out keys)
         m = self.model.config
-        kv_model_kwargs = {"num_heads": m.n_kv_head, "head_dim": m.n_embd // m.n_head, "num_layers": m.n_layer}
+        kv_model_kwargs = {"num_heads": m.n_kv_head, "head_dim": m.n_embd // m.n_head, "num_layers": m.n_layer, "quantize": self.kv_quantize}
+        num_prompts = len(prompts)
+        prompt_len = max(len(prompt) for prompt in prompts)
         kv_cache_prefill = KVCache(
-            batch_size=1,
-            seq_len=len(tokens),
+            batch_size=num_prompts,
+            seq_len=prompt_len,
             **kv_model_kwargs,
         )
-        ids = torch.tensor([tokens], dtype=torch.long, device=device)
+        if any(len(prompt) < prompt_len for prompt in prompts):
+            kv_cache_prefill.key_mask = torch.tensor([[False] * (prompt_len - len(prompt)) + [True] * len(prompt) for prompt in prompts], dtype=torch.bool, device=device)
+        ids = torch.tensor([[bos] * (prompt_len - len(prompt)) + prompt for prompt in prompts], dtype=torch.long, device=device)
         logits = self.model.forward(ids, kv_cache=kv_cache_prefill)
         logits = logits[:, -1, :]
-        next_ids = sample_next_token(logits, rng, temperature, top_k)  # (B, 1)
-        sampled_tokens = next_ids[:, 0].tolist()
+        # The first column comes from the prefill: sample it for each row (not once per prompt), so samples differ from the start
+        logits = logits.repeat_interleave(num_samples, dim=0) if num_samples > 1 else logits
+        first_column = sample_next_token(logits, rng, temperature, top_k)[:, 0].tolist()  # (num_prompts * num_samples,)
 
         # 2) Replicate the KV cache for each sample/row
-        kv_length_hint = (len(tokens) + max_tokens) if max_tokens is not None else self.model.config.sequence_len
+        batch_size = num_prompts * num_samples
+        kv_length_hint = (prompt_len + max_tokens) if max_tokens is not None else self.model.config.sequence_len
         kv_cache_decode = KVCache(
-            batch_size=num_samples,
+            batch_size=batch_size,
             seq_len=kv_length_hint,
             **kv_model_kwargs,
         )
@@ -231,83 +513,70 @@ class Engine:
         del kv_cache_prefill # no need to keep this memory around
 
         # 3) Initialize states for each sample
-        row_states = [RowState(tokens.copy()) for _ in range(num_samples)]
+        row_states = [RowState() for _ in range(batch_size)]
 
-        # 4) Main generation loop
+        # 4) Preallocate the decode buffers: the input ids of the next forward pass, and the sampled ids of a chunk
+        ids = torch.tensor(first_column, dtype=torch.long, device=device).unsqueeze(1)
+        sampled = torch.empty((batch_size, sync_every), dtype=torch.long, device=device)
+
+        # 5) Main generation loop
+        columns = [first_column] # sampled columns waiting to be processed on the host
         num_generated = 0
-        first_iteration = True
         while True:
-            # Stop condition: we've reached max tokens
+            # Process the pending columns in order
+            for j, sampled_tokens in enumerate(columns):
+                # Stop condition: we've reached max tokens
+                if max_tokens is not None and num_generated >= max_tokens:
+                    return
+                # Stop condition: all rows are completed
+                if all(state.completed for state in row_states):
+                    return
+                token_column, token_masks = self._process_column(row_states, sampled_tokens, special)
+                yield token_column, token_masks
+                num_generated += 1
+                if 0 in token_masks:
+                    # Some row took a forced token instead of its sample (or is paused), so the next input is not
+                    # the one the device assumed: drop the rest of the chunk, roll back the cache, feed this column
+                    kv_cache_decode.pos -= len(columns) - 1 - j
+                    # paused rows get a dummy input (python_end, the last token they had) that is masked out
+                    next_column = [python_end if token is None else token for token in token_column]
+                    ids.copy_(torch.tensor(next_column, dtype=torch.long, device=device).unsqueeze(1))
+                    kv_cache_decode.set_next_valid([token is not None for token in token_column])
+                    break
+            # Stop conditions again, to avoid a wasted forward pass at the very end
             if max_tokens is not None and num_generated >= max_tokens:
-                break
-            # Stop condition: all rows are completed
+                return
             if all(state.completed for state in row_states):
-                break
+                return
 
-            # Get sampled tokens - either from prefill or from forward pass
-            if first_iteration:
-                # Use the tokens we already sampled from prefill
-                sampled_tokens = [sampled_tokens[0]] * num_samples  # Broadcast first token to all rows
-                # TODO: we should sample a token for each row instead of broadcasting
-                first_iteration = False
-            else:
-                # Forward the model and get the next token for each row
+            # Decode a chunk of steps on the device. Tokens waiting to be forced need a host round trip per step
+            num_steps = 1 if any(state.forced_tokens or state.pending_result is not None for state in row_states) else sync_every
+            if max_tokens is not None:
+                num_steps = min(num_steps, max_tokens - num_generated)
+            for j in range(num_steps):
                 logits = self.model.forward(ids, kv_cache=kv_cache_decode)  # (B, T, vocab_size)
                 logits = logits[:, -1, :]  # (B, vocab_size) at last time step
                 next_ids = sample_next_token(logits, rng, temperature, top_k)  # (B, 1)
-                sampled_tokens = next_ids[:, 0].tolist()
-
-            # Process each row: choose the next token, update state, optional tool use
-            token_column = [] # contains the next token id along each row
-            token_masks = [] # contains the mask (was it sampled (1) or forced (0)?) along each row
-            for i, state in enumerate(row_states):
-                # Select the next token in this row
-                is_forced = len(state.forced_tokens) > 0 # are there tokens waiting to be forced in deque?
-                token_masks.append(0 if is_forced else 1) # mask is 0 if forced, 1 if sampled
-                next_token = state.forced_tokens.popleft() if is_forced else sampled_tokens[i]
-                token_column.append(next_token)
-                # Update the state of this row to include the next token
-                state.current_tokens.append(next_token)
-                # On <|assistant_end|> or <|bos|>, mark the row as completed
-                if next_token == assistant_end or next_token == bos:
-                    state.completed = True
-                # Handle tool logic
-                if next_token == python_start:
-                    state.in_python_block = True
-                    state.python_expr_tokens = []
-                elif next_token == python_end and state.in_python_block:
-                    state.in_python_block = False
-                    if state.python_expr_tokens:
-                        expr = self.tokenizer.decode(state.python_expr_tokens)
-                        result = use_calculator(expr)
-                        if result is not None:
-                            result_tokens = self.tokenizer.encode(str(result))
-                            state.forced_tokens.append(output_start)
-                            state.forced_tokens.extend(result_tokens)
-                            state.forced_tokens.append(output_end)
-                    state.python_expr_tokens = []
-                elif state.in_python_block:
-                    state.python_expr_tokens.append(next_token)
-
-            # Yield the token column
-            yield token_column, token_masks
-            num_generated += 1
-            # Prepare ids for next iteration
-            ids = torch.tensor(token_column, dtype=torch.long, device=device).unsqueeze(1)
-
-    def generate_batch(self, tokens, num_samples=1, **kwargs):
+                sampled[:, j:j+1].copy_(next_ids)
+                ids.copy_(next_ids)
+            columns = sampled[:, :num_steps].t().tolist() # the only host sync of the chunk
+
+    def generate_batch(self, tokens, num_samples=1, sync_every=8, **kwargs):
         """
         Non-streaming batch generation that just returns the final token sequences.
         Returns a list of token sequences (list of lists of ints).
         Terminal tokens (assistant_end, bos) are not included in the results.
+        Nobody watches the tokens arrive here, so by default decode several steps per host sync.
         """
         assistant_end = self.tokenizer.encode_special("<|assistant_end|>")
         bos = self.tokenizer.get_bos_token_id()
         results = [tokens.copy() for _ in range(num_samples)]
         masks = [[0] * len(tokens) for _ in range(num_samples)]
         completed = [False] * num_samples
-        for token_column, token_masks in self.generate(tokens, num_samples, **kwargs):
+        for token_column, token_masks in self.generate(tokens, num_samples, sync_every=sync_every, **kwargs):
             for i, (token, mask) in enumerate(zip(token_column, token_masks)):
+                if token is None:
+                    continue # row paused on a tool call
                 if not completed[i]:
                     if token == assistant_end or token == bos:
                         completed[i] = True
@@ -319,6 +588,35 @@ class Engine:
                 break
         return results, masks
 
+    def generate_completions(self, prompts, num_samples=1, sync_every=8, **kwargs):
+        """
+        Batched generation for many prompts at once (see generate). Yields (prompt_index, sample_index,
+        completion, masks) as soon as each row is finished, so that e.g. scoring can overlap with the
+        rest of the batch still decoding. The completion excludes the prompt and the terminal token,
+        masks are 1 for sampled and 0 for forced tokens (as in generate_batch).
+        """
+        assistant_end = self.tokenizer.encode_special("<|assistant_end|>")
+        bos = self.tokenizer.get_bos_token_id()
+        completions = [[] for _ in range(len(prompts) * num_samples)]
+        masks = [[] for _ in range(len(completions))]
+        completed = [False] * len(completions)
+        for token_column, token_masks in self.generate(prompts, num_samples, sync_every=sync_every, **kwargs):
+            for i, (token, mask) in enumerate(zip(token_column, token_masks)):
+                if token is None or completed[i]:
+                    continue
+                if token == assistant_end or token == bos:
+                    completed[i] = True
+                    yield i // num_samples, i % num_samples, completions[i], masks[i]
+                else:
+                    completions[i].append(token)
+                    masks[i].append(mask)
+            if all(completed):
+                return
+        # rows that ran out of max_tokens
+        for i, done in enumerate(completed):
+            if not done:
+                yield i // num_samples, i % num_samples, completions[i], masks[i]
+
 
 if __name__ == "__main__":
     """
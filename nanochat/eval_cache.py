@@ -0,0 +1,119 @@
+"""
+Cache of evaluation results, so that re-running the evals of a checkpoint (e.g. a sweep
+regenerating its report) only computes what is missing.
+
+A result is keyed by everything it depends on: the checkpoint (a hash of its weights file),
+the task, the eval config and the code version (git commit, plus the uncommitted diff if any).
+Each result is a small json file under {base_dir}/eval_cache/.
+
+Example:
+    cache = EvalCache(checkpoint_fingerprint("base"))
+    bpb = cache.get_or_compute("bpb/val", {"split_tokens": split_tokens}, lambda: evaluate_bpb(...))
+
+All ranks look a result up (and so agree on whether to compute it), only rank 0 writes.
+"""
+
+import hashlib
+import json
+import os
+
+import torch.distributed as dist
+
+from nanochat.checkpoint_manager import find_largest_model, find_last_step, get_checkpoints_dir
+from nanochat.common import get_base_dir
+from nanochat.report import run_command
+
+_file_hashes = {}
+
+def file_hash(path):
+    """sha256 of a file, remembered in a sidecar file (valid while the size and mtime don't change)."""
+    stat = os.stat(path)
+    stamp = f"{stat.st_size} {stat.st_mtime_ns}"
+    if (path, stamp) in _file_hashes:
+        return _file_hashes[(path, stamp)]
+    sidecar = path + ".sha256"
+    digest = None
+    if os.path.exists(sidecar):
+        with open(sidecar, "r") as f:
+            saved_stamp, _, saved_digest = f.read().strip().rpartition(" ")
+        if saved_stamp == stamp:
+            digest = saved_digest
+    if digest is None:
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 24), b""):
+                h.update(chunk)
+        digest = h.hexdigest()
+        if not dist.is_initialized() or dist.get_rank() == 0: # only rank 0 writes (renamed into place: never seen half written)
+            try:
+                tmp_path = sidecar + f".tmp{os.getpid()}"
+                with open(tmp_path, "w") as f:
+                    f.write(f"{stamp} {digest}\n")
+                os.replace(tmp_path, sidecar)
+            except OSError:
+                pass # read-only checkpoint dir, fine, we'll just hash again next time
+    _file_hashes[(path, stamp)] = digest
+    return digest
+
+def checkpoint_fingerprint(source, model_tag=None, step=None):
+    """Hash of the weights of the checkpoint that load_model(source, ...) would load."""
+    checkpoints_dir = get_checkpoints_dir(source)
+    model_tag = find_largest_model(checkpoints_dir) if model_tag is None else model_tag
+    checkpoint_dir = os.path.join(checkpoints_dir, model_tag)
+    step = find_last_step(checkpoint_dir) if step is None else step
+    return file_hash(os.path.join(checkpoint_dir, f"model_{step:06d}.pt"))
+
+def code_version():
+    """The git commit of the code, plus a hash of the uncommitted changes (if any)."""
+    commit = run_command("git rev-parse HEAD") or "unknown"
+    diff = run_command("git diff HEAD")
+    if diff:
+        commit += "+" + hashlib.sha256(diff.encode("utf-8")).hexdigest()[:16]
+    return commit
+
+
+class EvalCache:
+    """Results of the evals of one checkpoint. enabled=False turns it into a pass-through."""
+
+    def __init__(self, checkpoint, code=None, enabled=True):
+        self.checkpoint = checkpoint
+        self.code = code_version() if code is None else code
+        self.enabled = enabled
+        self.cache_dir = os.path.join(get_base_dir(), "eval_cache")
+        self.hits = [] # tasks that were served from the cache, for logging
+
+    def path(self, task, config):
+        key_data = {"checkpoint": self.checkpoint, "task": task, "config": config, "code": self.code}
+        key = hashlib.sha256(json.dumps(key_data, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:24]
+        slug = "".join(c if c.isalnum() else "_" for c in task)
+        return os.path.join(self.cache_dir, f"{slug}_{key}.json")
+
+    def get(self, task, config):
+        """The cached result, or None."""
+        if not self.enabled:
+            return None
+        path = self.path(task, config)
+        if not os.path.exists(path):
+            return None
+        with open(path, "r") as f:
+            return json.load(f)["result"]
+
+    def put(self, task, config, result):
+        if not self.enabled or (dist.is_initialized() and dist.get_rank() != 0):
+            return
+        path = self.path(task, config)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = path + f".tmp{os.getpid()}"
+        with open(tmp_path, "w") as f:
+            json.dump({"checkpoint": self.checkpoint, "task": task, "config": config, "code": self.code, "result": result}, f, indent=2, default=str)
+        os.replace(tmp_path, path)
+
+    def get_or_compute(self, task, config, compute_fn):
+        """Look the result up, or compute it with compute_fn() (json-serializable) and store it."""
+        result = self.get(task, config)
+        if result is not None:
+            self.hits.append(task)
+            return result
+        result = compute_fn()
+        self.put(task, config, result)
+        return result
@@ -19,6 +19,12 @@ What is not covered:
 
 Overall this sandbox is good for evaluation of generated code and protects against
 accidental destructive behavior, but it is not safe against malicious adversarial code.
+
+execute_code() starts a fresh process per snippet. When checking many snippets (e.g. HumanEval,
+RL with code rewards), use a SandboxPool instead (or the shared one from get_sandbox_pool()):
+its worker processes apply reliability_guard once and then run snippet after snippet, and are
+replaced after max_runs snippets or whenever they time out or crash. A worker is reused across
+snippets, so a snippet that e.g. monkeypatches builtins can affect the next few in that worker.
 """
 
 import contextlib
@@ -27,10 +33,14 @@ import io
 import multiprocessing
 import os
 import platform
+import queue
+import shutil
 import signal
 import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import Optional
+from typing import List, Optional
 
 # -----------------------------------------------------------------------------
 
@@ -213,6 +223,60 @@ def reliability_guard(maximum_memory_bytes: Optional[int] = None):
     sys.modules["tkinter"] = None
 
 
+def _run_code(code: str, timeout: float) -> dict:
+    """Run code (in an already guarded process) and return the fields of an ExecutionResult."""
+    # Default to failure
+    result = {
+        "success": False,
+        "stdout": "",
+        "stderr": "",
+        "timeout": False,
+        "memory_exceeded": False,
+        "error": None,
+    }
+
+    try:
+        exec_globals = {}
+        with capture_io() as (stdout_capture, stderr_capture):
+            with time_limit(timeout):
+                # WARNING
+                # This program exists to execute untrusted model-generated code. Although
+                # it is highly unlikely that model-generated code will do something overtly
+                # malicious in response to this test suite, model-generated code may act
+                # destructively due to a lack of model capability or alignment.
+                # Users are strongly encouraged to sandbox this evaluation suite so that it
+                # does not perform destructive actions on their host or network. For more
+                # information on how OpenAI sandboxes its code, see the accompanying paper.
+                # Once you have read this disclaimer and taken appropriate precautions,
+                # uncomment the following line and proceed at your own risk:
+                exec(code, exec_globals)
+
+        result.update({
+            "success": True,
+            "stdout": stdout_capture.getvalue(),
+            "stderr": stderr_capture.getvalue(),
+        })
+
+    except TimeoutException:
+        result.update({
+            "timeout": True,
+            "error": "Execution timed out",
+        })
+
+    except MemoryError as e:
+        result.update({
+            "memory_exceeded": True,
+            "error": f"Memory limit exceeded: {e}",
+        })
+
+    except BaseException as e:
+        result.update({
+            "error": f"{type(e).__name__}: {e}",
+        })
+
+    return result
+
+
 def _unsafe_execute(code: str, timeout: float, maximum_memory_bytes: Optional[int], result_dict):
     """Execute code in a subprocess with safety guards. Results are written to result_dict."""
     with create_tempdir():
@@ -229,54 +293,7 @@ def _unsafe_execute(code: str, timeout: float, maximum_memory_bytes: Optional[in
         # Disable functionalities that can make destructive changes to the test.
         reliability_guard(maximum_memory_bytes=maximum_memory_bytes)
 
-        # Default to failure
-        result_dict.update({
-            "success": False,
-            "stdout": "",
-            "stderr": "",
-            "timeout": False,
-            "memory_exceeded": False,
-            "error": None,
-        })
-
-        try:
-            exec_globals = {}
-            with capture_io() as (stdout_capture, stderr_capture):
-                with time_limit(timeout):
-                    # WARNING
-                    # This program exists to execute untrusted model-generated code. Although
-                    # it is highly unlikely that model-generated code will do something overtly
-                    # malicious in response to this test suite, model-generated code may act
-                    # destructively due to a lack of model capability or alignment.
-                    # Users are strongly encouraged to sandbox this evaluation suite so that it
-                    # does not perform destructive actions on their host or network. For more
-                    # information on how OpenAI sandboxes its code, see the accompanying paper.
-                    # Once you have read this disclaimer and taken appropriate precautions,
-                    # uncomment the following line and proceed at your own risk:
-                    exec(code, exec_globals)
-
-            result_dict.update({
-                "success": True,
-                "stdout": stdout_capture.getvalue(),
-                "stderr": stderr_capture.getvalue(),
-            })
-
-        except TimeoutException:
-            result_dict.update({
-                "timeout": True,
-                "error": "Execution timed out",
-            })
-
-        except MemoryError as e:
-            result_dict.update({
-                "memory_exceeded": True,
-                "error": f"Memory limit exceeded: {e}",
-            })
-
-        except BaseException as e:
-            result_dict.update({
-                "error": f"{type(e).__name__}: {e}",
-            })
+        result_dict.update(_run_code(code, timeout))
 
         # Needed for cleaning up.
         shutil.rmtree = rmtree
@@ -349,3 +366,128 @@ def execute_code(
         memory_exceeded=result_dict["memory_exceeded"],
     )
 
+
+
+# -----------------------------------------------------------------------------
+# Pool of long-lived sandbox workers
+
+def _sandbox_worker(conn, workdir: str, maximum_memory_bytes: Optional[int]):
+    """Runs in its own process: guard once, then run the snippets sent over conn until told to stop."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # ctrl-c is for the parent to handle
+    os.chdir(workdir)
+    # These system calls are needed to clean up the work directory between snippets.
+    rmtree, rmdir, unlink = shutil.rmtree, os.rmdir, os.unlink
+    reliability_guard(maximum_memory_bytes=maximum_memory_bytes)
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            break
+        if request is None:
+            break
+        code, timeout = request
+        conn.send(_run_code(code, timeout))
+        # leave an empty work directory to the next snippet (rmtree needs the real rmdir/unlink for a moment)
+        shutil.rmtree, os.rmdir, os.unlink = rmtree, rmdir, unlink
+        try:
+            for name in os.listdir(workdir):
+                path = os.path.join(workdir, name)
+                if os.path.isdir(path) and not os.path.islink(path):
+                    rmtree(path, ignore_errors=True)
+                else:
+                    unlink(path)
+        except OSError:
+            pass
+        finally:
+            shutil.rmtree, os.rmdir, os.unlink = None, None, None
+
+
+class SandboxPool:
+    """
+    A few prewarmed sandbox worker processes (see the module docstring). execute() blocks until
+    a worker is free, submit() returns a Future, execute_many() runs a batch with at most
+    num_workers snippets in flight. Safe to share between threads.
+    """
+
+    def __init__(self, num_workers: int = 4, maximum_memory_bytes: Optional[int] = 256 * 1024 * 1024, max_runs: int = 100):
+        self.maximum_memory_bytes = maximum_memory_bytes
+        self.max_runs = max_runs
+        self.idle = queue.Queue()
+        for _ in range(num_workers):
+            self.idle.put(self._start_worker())
+        self.executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="sandbox")
+
+    def _start_worker(self):
+        workdir = tempfile.mkdtemp(prefix="nanochat_sandbox_")
+        parent_conn, child_conn = multiprocessing.Pipe()
+        p = multiprocessing.Process(target=_sandbox_worker, args=(child_conn, workdir, self.maximum_memory_bytes), daemon=True)
+        p.start()
+        child_conn.close()
+        return {"process": p, "conn": parent_conn, "workdir": workdir, "runs": 0}
+
+    def _stop_worker(self, worker, kill: bool):
+        p, conn = worker["process"], worker["conn"]
+        if not kill:
+            try:
+                conn.send(None)
+            except OSError:
+                pass
+            p.join(timeout=1)
+        if p.is_alive():
+            p.kill()
+        p.join()
+        conn.close()
+        shutil.rmtree(worker["workdir"], ignore_errors=True)
+
+    def execute(self, code: str, timeout: float = 5.0) -> ExecutionResult:
+        """Same as execute_code, on a pooled worker."""
+        worker = self.idle.get()
+        result = None
+        try:
+            worker["conn"].send((code, timeout))
+            if worker["conn"].poll(timeout + 1):
+                result = worker["conn"].recv()
+        except (EOFError, OSError):
+            pass
+        worker["runs"] += 1
+        if result is None or result["timeout"] or worker["runs"] >= self.max_runs:
+            # hung, dead, interrupted mid-snippet or just old: replace it
+            self._stop_worker(worker, kill=result is None or result["timeout"])
+            worker = self._start_worker()
+        self.idle.put(worker)
+        if result is None:
+            return ExecutionResult(
+                success=False,
+                stdout="",
+                stderr="",
+                error="Execution timed out or crashed (process killed)",
+                timeout=True,
+                memory_exceeded=False,
+            )
+        return ExecutionResult(**result)
+
+    def submit(self, code: str, timeout: float = 5.0):
+        """Execute code in the background, returns a Future of the ExecutionResult."""
+        return self.executor.submit(self.execute, code, timeout)
+
+    def execute_many(self, codes: List[str], timeout: float = 5.0) -> List[ExecutionResult]:
+        """Execute a batch of snippets in parallel, results in the same order."""
+        futures = [self.submit(code, timeout) for code in codes]
+        return [future.result() for future in futures]
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        while not self.idle.empty():
+            self._stop_worker(self.idle.get(), kill=False)
+
+
+_sandbox_pool = None
+_sandbox_pool_lock = threading.Lock()
+
+def get_sandbox_pool() -> SandboxPool:
+    """The process-wide SandboxPool, started on first use."""
+    global _sandbox_pool
+    with _sandbox_pool_lock:
+        if _sandbox_pool is None:
+            _sandbox_pool = SandboxPool()
+        return _sandbox_pool
@@ -18,6 +18,7 @@ from functools import partial
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint, create_selective_checkpoint_contexts
 
 from nanochat.adamw import DistAdamW
 from nanochat.common import get_dist_info
@@ -32,6 +33,14 @@ class GPTConfig:
     n_head: int = 6 # number of query heads
     n_kv_head: int = 6 # number of key/value heads (MQA)
     n_embd: int = 768
+    # activation checkpointing (training only), applied to every checkpoint_every-th block:
+    # "none" | "block" (recompute the whole block) | "mlp" (recompute only the MLP) | "attn_out" (recompute the block except the attention kernel)
+    activation_checkpoint: str = "none"
+    checkpoint_every: int = 1
+    # RoPE scaling, to stretch the context beyond sequence_len at inference:
+    # "none" | "linear" (position interpolation: positions / factor) | "ntk" (NTK-aware: base * factor^(d/(d-2)))
+    rope_scaling: str = "none"
+    rope_scaling_factor: float = 1.0
 
 
 def norm(x):
@@ -49,6 +58,90 @@ def apply_rotary_emb(x, cos, sin):
     out = out.to(x.dtype) # ensure input/output dtypes match
     return out
 
+
+def _softcap_ce_grad(logits, lse, tanh, targets, scale):
+    # d(scale * loss) / d(pre-softcap logits), per row: (softmax - onehot) * scale, then through the softcap
+    grad = torch.exp(logits - lse[:, None])
+    grad.scatter_add_(1, targets[:, None], torch.full_like(lse[:, None], -1.0))
+    grad.mul_(scale[:, None])
+    grad.mul_(1 - tanh.float().square()) # d/dz softcap * tanh(z / softcap) = 1 - tanh^2
+    return grad.to(tanh.dtype)
+
+
+class SoftcapCrossEntropy(torch.autograd.Function):
+    """
+    lm_head -> logits softcap -> fp32 cross-entropy, chunk_size rows at a time, so that the full
+    (N, vocab) logits are never materialized. For a reduced loss the gradients are computed already
+    in the forward pass (chunk by chunk); for reduction='none' the backward recomputes each chunk.
+    """
+
+    @staticmethod
+    def forward(ctx, x, weight, targets, softcap, reduction, chunk_size, grad_in_forward):
+        N = x.size(0)
+        w = weight.to(x.dtype)
+        valid = targets >= 0 # -1 = ignore_index
+        safe_targets = targets.clamp(min=0)
+        num_valid = valid.sum()
+        scale = valid.float() / num_valid if reduction == 'mean' else valid.float()
+        losses = torch.empty(N, dtype=torch.float32, device=x.device)
+        lse = torch.empty(N, dtype=torch.float32, device=x.device)
+        if grad_in_forward:
+            grad_x = torch.empty_like(x)
+            grad_w = torch.zeros_like(weight, dtype=torch.float32)
+        with torch.autocast(x.device.type, enabled=False):
+            for start in range(0, N, chunk_size):
+                rows = slice(start, start + chunk_size)
+                tanh = torch.tanh(F.linear(x[rows], w) / softcap)
+                logits = (softcap * tanh).float() # use tf32/fp32 for the loss
+                lse[rows] = logits.logsumexp(dim=-1)
+                losses[rows] = (lse[rows] - logits.gather(1, safe_targets[rows, None]).squeeze(1)) * valid[rows]
+                if grad_in_forward:
+                    grad_logits = _softcap_ce_grad(logits, lse[rows], tanh, safe_targets[rows], scale[rows])
+                    grad_x[rows] = grad_logits @ w
+                    grad_w += (grad_logits.t() @ x[rows]).float()
+        ctx.grad_in_forward = grad_in_forward
+        ctx.softcap, ctx.chunk_size = softcap, chunk_size
+        if grad_in_forward:
+            ctx.save_for_backward(grad_x, grad_w.to(weight.dtype))
+        else:
+            ctx.save_for_backward(x, weight, safe_targets, valid, lse)
+        if reduction == 'none':
+            return losses
+        return losses.sum() / num_valid if reduction == 'mean' else losses.sum()
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        if ctx.grad_in_forward:
+            grad_x, grad_w = ctx.saved_tensors
+            return grad_x * grad_output.to(grad_x.dtype), grad_w * grad_output.to(grad_w.dtype), None, None, None, None, None
+        # reduction='none': recompute the logits of each chunk, the per-row grad_output is the scale
+        x, weight, safe_targets, valid, lse = ctx.saved_tensors
+        w = weight.to(x.dtype)
+        scale = grad_output.float() * valid
+        grad_x = torch.empty_like(x)
+        grad_w = torch.zeros_like(weight, dtype=torch.float32)
+        with torch.autocast(x.device.type, enabled=False):
+            for start in range(0, x.size(0), ctx.chunk_size):
+                rows = slice(start, start + ctx.chunk_size)
+                tanh = torch.tanh(F.linear(x[rows], w) / ctx.softcap)
+                logits = (ctx.softcap * tanh).float()
+                grad_logits = _softcap_ce_grad(logits, lse[rows], tanh, safe_targets[rows], scale[rows])
+                grad_x[rows] = grad_logits @ w
+                grad_w += (grad_logits.t() @ x[rows]).float()
+        return grad_x, grad_w.to(weight.dtype), None, None, None, None, None
+
+
+def softcap_cross_entropy(x, weight, targets, softcap, reduction='mean', chunk_size=1024):
+    """
+    Same as F.cross_entropy(softcap * tanh((x @ weight.T) / softcap), targets, ignore_index=-1, reduction=reduction),
+    with the logits in fp32, but without ever holding the full logits. x: (N, D), weight: (V, D), targets: (N,).
+    """
+    assert reduction in ('mean', 'sum', 'none')
+    if torch.is_autocast_enabled(x.device.type):
+        x = x.to(torch.get_autocast_dtype(x.device.type)) # the lm_head matmul runs in the autocast dtype, as with nn.Linear
+    grad_in_forward = reduction != 'none' and torch.is_grad_enabled() and (x.requires_grad or weight.requires_grad)
+    return SoftcapCrossEntropy.apply(x, weight, targets, softcap, reduction, chunk_size, grad_in_forward)
+
 class CausalSelfAttention(nn.Module):
     def __init__(self, config, layer_idx):
         super().__init__()
@@ -64,7 +157,7 @@ class CausalSelfAttention(nn.Module):
         self.c_v = nn.Linear(self.n_embd, self.n_kv_head * self.head_dim, bias=False)
         self.c_proj = nn.Linear(self.n_embd, self.n_embd, bias=False)
 
-    def forward(self, x, cos_sin, kv_cache):
+    def forward(self, x, cos_sin, kv_cache, doc_mask=None):
         B, T, C = x.size()
 
         # Project the input to get queries, keys, and values
@@ -84,13 +177,19 @@ class CausalSelfAttention(nn.Module):
         Tq = q.size(2) # number of queries in this forward pass
         Tk = k.size(2) # number of keys/values in total (in the cache + current forward pass)
 
+        # Rows of the KV cache can have keys that must not be attended to (e.g. paused rows in the Engine)
+        key_mask = kv_cache.get_key_mask(Tk) if kv_cache is not None else None # (B, Tk) or None
+
         # Attention: queries attend to keys/values autoregressively. A few cases to handle:
         enable_gqa = self.n_head != self.n_kv_head # Group Query Attention (GQA): duplicate key/value heads to match query heads if desired
-        if kv_cache is None or Tq == Tk:
+        if doc_mask is not None:
+            # Packed sequences (training): causal attention within each document only, doc_mask is (B, 1, T, T)
+            y = F.scaled_dot_product_attention(q, k, v, attn_mask=doc_mask, enable_gqa=enable_gqa)
+        elif key_mask is None and (kv_cache is None or Tq == Tk):
             # During training (no KV cache), attend as usual with causal attention
             # And even if there is KV cache, we can still use this simple version when Tq == Tk
             y = F.scaled_dot_product_attention(q, k, v, is_causal=True, enable_gqa=enable_gqa)
-        elif Tq == 1:
+        elif key_mask is None and Tq == 1:
             # During inference but with a single query in this forward pass:
             # The query has to attend to all the keys/values in the cache
             y = F.scaled_dot_product_attention(q, k, v, is_causal=False, enable_gqa=enable_gqa)
@@ -103,6 +202,11 @@ class CausalSelfAttention(nn.Module):
                 attn_mask[:, :prefix_len] = True
             # Then, causal attention within this chunk
             attn_mask[:, prefix_len:] = torch.tril(torch.ones((Tq, Tq), dtype=torch.bool, device=q.device))
+            if key_mask is not None:
+                # (B, 1, Tq, Tk), broadcast over heads. Each query keeps its own key so a row never masks everything
+                diagonal = torch.zeros((Tq, Tk), dtype=torch.bool, device=q.device)
+                diagonal[:, prefix_len:] = torch.eye(Tq, dtype=torch.bool, device=q.device)
+                attn_mask = ((attn_mask & key_mask[:, None, :]) | diagonal)[:, None]
             y = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask, enable_gqa=enable_gqa)
 
         # Re-assemble the heads side by side and project back to residual stream
@@ -124,17 +228,39 @@ class MLP(nn.Module):
         return x
 
 
+def _save_attention_outputs():
+    # selective checkpointing: keep the outputs of the attention kernels, recompute everything else
+    names = ["_scaled_dot_product_flash_attention", "_scaled_dot_product_efficient_attention",
+             "_scaled_dot_product_cudnn_attention", "_scaled_dot_product_flash_attention_for_cpu"]
+    return create_selective_checkpoint_contexts([getattr(torch.ops.aten, name).default for name in names if hasattr(torch.ops.aten, name)])
+
+
 class Block(nn.Module):
     def __init__(self, config, layer_idx):
         super().__init__()
         self.attn = CausalSelfAttention(config, layer_idx)
         self.mlp = MLP(config)
-
-    def forward(self, x, cos_sin, kv_cache):
-        x = x + self.attn(norm(x), cos_sin, kv_cache)
-        x = x + self.mlp(norm(x))
+        self.checkpoint = "none" # activation checkpointing policy of this block, see GPT.set_activation_checkpointing
+
+    def forward(self, x, cos_sin, kv_cache, doc_mask=None):
+        policy = self.checkpoint if (torch.is_grad_enabled() and kv_cache is None) else "none"
+        if policy == "block":
+            return checkpoint(self._forward, x, cos_sin, kv_cache, doc_mask, use_reentrant=False)
+        if policy == "attn_out":
+            return checkpoint(self._forward, x, cos_sin, kv_cache, doc_mask, use_reentrant=False, context_fn=_save_attention_outputs)
+        if policy == "mlp":
+            x = x + self.attn(norm(x), cos_sin, kv_cache, doc_mask)
+            return x + checkpoint(self._mlp, x, use_reentrant=False)
+        return self._forward(x, cos_sin, kv_cache, doc_mask)
+
+    def _forward(self, x, cos_sin, kv_cache, doc_mask):
+        x = x + self.attn(norm(x), cos_sin, kv_cache, doc_mask)
+        x = x + self._mlp(x)
         return x
 
+    def _mlp(self, x):
+        return self.mlp(norm(x))
+
 
 class GPT(nn.Module):
     def __init__(self, config):
@@ -145,15 +271,31 @@ class GPT(nn.Module):
             "h": nn.ModuleList([Block(config, layer_idx) for layer_idx in range(config.n_layer)]),
         })
         self.lm_head = nn.Linear(config.n_embd, config.vocab_size, bias=False)
-        # To support meta device initialization, we init the rotary embeddings here, but it's fake
-        # As for rotary_seq_len, these rotary embeddings are pretty small/cheap in memory,
-        # so let's just over-compute them, but assert fail if we ever reach that amount.
-        # In the future we can dynamically grow the cache, for now it's fine.
-        self.rotary_seq_len = config.sequence_len * 10 # 10X over-compute should be enough, TODO make nicer?
+        # To support meta device initialization, we init the rotary embeddings here, but it's fake.
+        # They cover sequence_len positions, and grow (doubling) in forward when a longer sequence comes along.
+        # cos and sin live in one tensor (2, 1, seq_len, 1, head_dim/2), so that growing swaps both in a single
+        # assignment: a forward on another thread (chat_web, serve_bench share the model) never sees a mixed pair.
+        self.rotary_seq_len = config.sequence_len
+        self.set_rope_scaling(config.rope_scaling, config.rope_scaling_factor, recompute=False)
         head_dim = config.n_embd // config.n_head
         cos, sin = self._precompute_rotary_embeddings(self.rotary_seq_len, head_dim)
-        self.register_buffer("cos", cos, persistent=False) # persistent=False means it's not saved to the checkpoint
-        self.register_buffer("sin", sin, persistent=False)
+        self.register_buffer("rotary", torch.stack([cos, sin]), persistent=False) # persistent=False means it's not saved to the checkpoint
+        self.set_activation_checkpointing(config.activation_checkpoint, config.checkpoint_every)
+
+    def set_activation_checkpointing(self, policy, every=1):
+        """Set the activation checkpointing policy (see GPTConfig), e.g. on a loaded model. Call it before torch.compile."""
+        assert policy in ("none", "block", "mlp", "attn_out"), f"Unknown activation checkpointing policy: {policy}"
+        assert every >= 1, "checkpoint_every must be >= 1"
+        for layer_idx, block in enumerate(self.transformer.h):
+            block.checkpoint = policy if layer_idx % every == 0 else "none"
+
+    def set_rope_scaling(self, kind, factor=1.0, recompute=True):
+        """Set the RoPE scaling (see GPTConfig), e.g. on a loaded model to chat beyond its training context."""
+        assert kind in ("none", "linear", "ntk"), f"Unknown RoPE scaling: {kind}"
+        assert factor >= 1.0, "the RoPE scaling factor must be >= 1"
+        self.rope_scaling, self.rope_scaling_factor = kind, factor
+        if recompute:
+            self.init_rotary()
 
     def init_weights(self):
         self.apply(self._init_weights)
@@ -164,13 +306,28 @@ class GPT(nn.Module):
             torch.nn.init.zeros_(block.mlp.c_proj.weight)
             torch.nn.init.zeros_(block.attn.c_proj.weight)
         # init the rotary embeddings
-        head_dim = self.config.n_embd // self.config.n_head
-        cos, sin = self._precompute_rotary_embeddings(self.rotary_seq_len, head_dim)
-        self.cos, self.sin = cos, sin
+        self.init_rotary()
         # Cast the embeddings from fp32 to bf16: optim can tolerate it and it saves memory: both in the model and the activations
         if self.transformer.wte.weight.device.type == "cuda":
             self.transformer.wte.to(dtype=torch.bfloat16)
 
+    def init_rotary(self, seq_len=None):
+        # the rotary embeddings are a non-persistent buffer: they are not in the checkpoint and must be recomputed
+        seq_len = self.rotary_seq_len if seq_len is None else seq_len
+        head_dim = self.config.n_embd // self.config.n_head
+        cos, sin = self._precompute_rotary_embeddings(seq_len, head_dim)
+        rotary = torch.stack([cos, sin])
+        self.rotary, self.rotary_seq_len = rotary, seq_len # one assignment publishes both tables
+        return rotary
+
+    @property
+    def cos(self):
+        return self.rotary[0]
+
+    @property
+    def sin(self):
+        return self.rotary[1]
+
     def _init_weights(self, module):
         if isinstance(module, nn.Linear):
             # https://arxiv.org/pdf/2310.17813
@@ -188,11 +345,15 @@ class GPT(nn.Module):
         # autodetect the device from model embeddings
         if device is None:
             device = self.transformer.wte.weight.device
+        if self.rope_scaling == "ntk":
+            base = base * self.rope_scaling_factor ** (head_dim / (head_dim - 2))
         # stride the channels
         channel_range = torch.arange(0, head_dim, 2, dtype=torch.float32, device=device)
         inv_freq = 1.0 / (base ** (channel_range / head_dim))
         # stride the time steps
         t = torch.arange(seq_len, dtype=torch.float32, device=device)
+        if self.rope_scaling == "linear":
+            t = t / self.rope_scaling_factor
         # calculate the rotation frequencies at each (time, channel) pair
         freqs = torch.outer(t, inv_freq)
         cos, sin = freqs.cos(), freqs.sin()
@@ -242,33 +403,60 @@ class GPT(nn.Module):
                 group["initial_lr"] = group["lr"]
         return optimizers
 
-    def forward(self, idx, targets=None, kv_cache=None, loss_reduction='mean'):
+    def forward(self, idx, targets=None, kv_cache=None, loss_reduction='mean', doc_ids=None):
+        """
+        doc_ids (B, T), optional: several sequences packed into each row, tokens with the same id
+        belong to the same (contiguous) sequence. Each token then only attends within its own
+        sequence, and rotary positions restart at every sequence, so every packed sequence is
+        computed exactly as if it had a row to itself.
+        With a KV cache whose key_mask masks out some keys (left padding, paused rows in the Engine),
+        the rotary position of a token is the number of valid keys before it in its row, so the
+        masked keys don't shift the positions: a padded row is computed as if it had no padding.
+        """
         B, T = idx.size()
 
         # Grab the rotary embeddings for the current sequence length (they are of shape (1, seq_len, 1, head_dim))
-        assert T <= self.cos.size(1), f"Sequence length grew beyond the rotary embeddings cache: {T} > {self.cos.size(1)}"
-        assert idx.device == self.cos.device, f"Rotary embeddings and idx are on different devices: {idx.device} != {self.cos.device}"
-        assert self.cos.dtype == torch.bfloat16, "Rotary embeddings must be in bfloat16"
         # if kv cache exists, we need to offset the rotary embeddings to the current position in the cache
         T0 = 0 if kv_cache is None else kv_cache.get_pos()
-        cos_sin = self.cos[:, T0:T0+T], self.sin[:, T0:T0+T] # truncate cache to current sequence length
+        rotary = self.rotary # read once: another thread may swap in longer tables meanwhile
+        if T0 + T > rotary.size(2):
+            # grow geometrically, so that a long generation only recomputes the tables a few times
+            rotary = self.init_rotary(max(T0 + T, 2 * rotary.size(2)))
+        cos, sin = rotary[0], rotary[1]
+        assert idx.device == cos.device, f"Rotary embeddings and idx are on different devices: {idx.device} != {cos.device}"
+        assert cos.dtype == torch.bfloat16, "Rotary embeddings must be in bfloat16"
+        cos_sin = cos[:, T0:T0+T], sin[:, T0:T0+T] # truncate cache to current sequence length
+        key_mask = kv_cache.get_key_mask(T0 + T) if kv_cache is not None else None
+        if key_mask is not None:
+            # per row positions that skip the masked out keys (those get position 0, nobody attends to them)
+            masked_before = (~key_mask).cumsum(dim=1)
+            positions = (torch.arange(T0 + T, device=idx.device) - masked_before).clamp(min=0)[:, T0:]
+            cos_sin = cos[0, positions], sin[0, positions] # (B, T, 1, head_dim/2)
+        doc_mask = None
+        if doc_ids is not None:
+            assert kv_cache is None, "packed sequences are for training/scoring, not for the KV cache"
+            positions = torch.arange(T, device=idx.device).expand(B, T)
+            is_start = torch.ones_like(doc_ids, dtype=torch.bool)
+            is_start[:, 1:] = doc_ids[:, 1:] != doc_ids[:, :-1]
+            positions = positions - torch.where(is_start, positions, 0).cummax(dim=1).values # position within the sequence
+            cos_sin = cos[0, positions], sin[0, positions] # (B, T, 1, head_dim/2)
+            causal = torch.tril(torch.ones((T, T), dtype=torch.bool, device=idx.device))
+            doc_mask = (causal & (doc_ids[:, :, None] == doc_ids[:, None, :]))[:, None] # (B, 1, T, T)
 
         # Forward the trunk of the Transformer
         x = self.transformer.wte(idx)
         x = norm(x)
         for block in self.transformer.h:
-            x = block(x, cos_sin, kv_cache)
+            x = block(x, cos_sin, kv_cache, doc_mask)
         x = norm(x)
 
         # Forward the lm_head (compute logits)
         softcap = 15
         if targets is not None:
-            # training mode: compute and return the loss
-            # TODO: experiment with Liger Kernels / chunked cross-entropy etc.
-            logits = self.lm_head(x)
-            logits = softcap * torch.tanh(logits / softcap) # logits softcap
-            logits = logits.float() # use tf32/fp32 for logits
-            loss = F.cross_entropy(logits.view(-1, logits.size(-1)), targets.view(-1), ignore_index=-1, reduction=loss_reduction)
+            # training mode: compute and return the loss, chunked so the full (B, T, vocab) logits are never materialized
+            # an int8 quantized lm_head (Int8Linear, see nanochat/quantize.py) has no weight, it is dequantized for the loss
+            weight = self.lm_head.weight if isinstance(self.lm_head, nn.Linear) else self.lm_head.dequantize()
+            loss = softcap_cross_entropy(x.view(B * T, -1), weight, targets.view(-1), softcap, reduction=loss_reduction)
             return loss
         else:
             # inference mode: compute and return the logits
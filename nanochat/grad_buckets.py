@@ -0,0 +1,178 @@
+"""
+Bucketed gradient reduce_scatter for the distributed optimizers (DistAdamW, DistMuon).
+
+Instead of one collective per parameter (or per group of world_size parameters), the grads
+live in a few flat buffers of about bucket_size_mb each and every buffer is reduce scattered
+in one call. Each buffer is laid out as (world_size, shard_numel): row r holds what rank r
+should receive, so a single reduce_scatter_tensor averages everything at once.
+The .grad of every param is a view into its bucket (set up by zero_grad()), so backward
+accumulates straight into the buffers and launching a bucket copies nothing. For that, a param
+sharded along dim 0 (DistAdamW) gets a bucket to itself, its dim 0 shards are then the rows.
+Zero the grads with the optimizer's zero_grad(), not with set_to_none on the model: a grad
+that was replaced is copied back into its bucket at launch, which works but costs the copy.
+
+The buckets can be launched from inside backward: after arm(), a post-accumulate-grad hook
+on every param counts the grads that are done, and a bucket goes out as soon as all of its
+params have their final grad, overlapping the communication with the rest of backward. Arm
+only right before the last micro-step of gradient accumulation (the hooks fire on every
+backward), and only if nothing modifies the grads between backward and the optimizer step
+(e.g. gradient clipping): the grads are read at the moment the bucket is launched.
+This overlap is eager mode only: the backward of a torch.compile'd model is one graph, and
+the hooks of all the params fire after it, so there is nothing left to overlap with. Scripts
+that compile the model don't arm, every bucket is then launched by the optimizer step.
+Buckets that did not go out during backward are launched by the optimizer step.
+
+The optimizer then processes the buckets in the order they complete (wait_any style). That order
+differs from rank to rank, so the collectives that follow (the all_gathers of the updated params)
+are issued in bucket index order, which is the same on every rank: see ready_in_order().
+On backends without reduce_scatter/AVG (e.g. gloo on CPU, for testing) an all_reduce is used.
+"""
+
+from contextlib import nullcontext
+
+import torch
+import torch.distributed as dist
+
+
+class GradBuckets:
+    """
+    buckets: list of buckets, each a list of slots (param, rank, offset, length):
+    - rank None: the param's grad is sharded along dim 0, grad.view(world_size, length) is the whole bucket (offset 0)
+    - rank r: the whole grad (length = numel) is row r, columns [offset, offset + length)
+    Slots of a bucket that are never written (padding) stay zero.
+    """
+
+    def __init__(self, buckets, world_size, rank):
+        self.world_size = world_size
+        self.rank = rank
+        self.slots = buckets
+        self.inputs, self.outputs = [], []
+        self.bucket_of = {}
+        for b, slots in enumerate(buckets):
+            assert all(owner is not None for _, owner, _, _ in slots) or len(slots) == 1, "a sharded param needs a bucket to itself"
+            shard_numel = max(offset + length for _, _, offset, length in slots)
+            p0 = slots[0][0]
+            self.inputs.append(torch.zeros((world_size, shard_numel), dtype=p0.dtype, device=p0.device))
+            self.outputs.append(torch.empty(shard_numel, dtype=p0.dtype, device=p0.device))
+            for p, _, _, _ in slots:
+                self.bucket_of[p] = b
+        self.num_params = [len({id(p) for p, _, _, _ in slots}) for slots in buckets]
+        self.use_reduce_scatter = dist.get_backend() == "nccl"
+        self.armed = False
+        self.ready_counts = [0] * len(buckets)
+        self.futures = [None] * len(buckets)
+        self.launch_order = []
+        self.processed, self.next_in_order = set(), 0
+        self.profiler = None # a StepProfiler timing the waits as the "comm" phase, see nanochat/step_profiler.py
+        for p in self.bucket_of:
+            p.register_post_accumulate_grad_hook(self._on_grad_ready)
+        self.zero_grad()
+
+    @staticmethod
+    def plan(params, world_size, bucket_size_mb, sharded):
+        """
+        Split params into buckets of about bucket_size_mb. Pass them in the order their grads
+        become ready, i.e. the reverse of the forward order, so that the first buckets fill up first.
+        sharded=True: every param is sharded along dim 0 across the ranks (DistAdamW), one bucket each.
+        sharded=False: params go in chunks of world_size, param i of a chunk is owned by rank i (DistMuon).
+        Returns the buckets as lists of slots, see GradBuckets.
+        """
+        if sharded:
+            return [[(p, None, 0, p.numel() // world_size)] for p in params]
+        bucket_bytes = bucket_size_mb * 1024 * 1024
+        buckets, slots, offset = [], [], 0
+        units = [[(p, r, p.numel()) for r, p in enumerate(params[i:i + world_size])] for i in range(0, len(params), world_size)]
+        for unit in units:
+            length = unit[0][2] # all params of a unit have the same shape
+            if slots and (offset + length) * world_size * unit[0][0].element_size() > bucket_bytes:
+                buckets.append(slots)
+                slots, offset = [], 0
+            slots.extend((p, rank, offset, length) for p, rank, length in unit)
+            offset += length
+        if slots:
+            buckets.append(slots)
+        return buckets
+
+    def grad_view(self, p, rank, offset, length):
+        """The part of its bucket that is the .grad of param p."""
+        buffer = self.inputs[self.bucket_of[p]]
+        view = buffer if rank is None else buffer[rank, offset:offset + length]
+        return view.view(p.shape)
+
+    @torch.no_grad()
+    def zero_grad(self):
+        """Zero the buckets and (re)point the .grad of every param to its view."""
+        for buffer in self.inputs:
+            buffer.zero_()
+        for slots in self.slots:
+            for p, rank, offset, length in slots:
+                p.grad = self.grad_view(p, rank, offset, length)
+
+    def arm(self):
+        """Launch each bucket from the next backward, as soon as all its grads are accumulated."""
+        self.armed = True
+        self.ready_counts = [0] * len(self.slots)
+
+    def _on_grad_ready(self, p):
+        if not self.armed:
+            return
+        b = self.bucket_of[p]
+        self.ready_counts[b] += 1
+        if self.ready_counts[b] == self.num_params[b]:
+            self.launch(b)
+
+    @torch.no_grad()
+    def launch(self, b):
+        buffer = self.inputs[b]
+        for p, rank, offset, length in self.slots[b]:
+            view = self.grad_view(p, rank, offset, length)
+            if p.grad is None or p.grad.data_ptr() != view.data_ptr():
+                # the grad was set to None (and reallocated by backward) since zero_grad(): copy it back in
+                view.copy_(p.grad if p.grad is not None else torch.zeros_like(view))
+                p.grad = view
+        output = self.outputs[b]
+        if self.use_reduce_scatter:
+            future = dist.reduce_scatter_tensor(output, buffer, op=dist.ReduceOp.AVG, async_op=True).get_future()
+        else:
+            work = dist.all_reduce(buffer, op=dist.ReduceOp.SUM, async_op=True) # in place: the grads become the sums
+            future = work.get_future().then(lambda _: output.copy_(buffer[self.rank]).div_(self.world_size))
+        self.futures[b] = future
+        self.launch_order.append(b)
+
+    def completed(self):
+        """Launch whatever did not go out during backward, then yield the bucket indices as they complete."""
+        for b in range(len(self.slots)):
+            if self.futures[b] is None:
+                self.launch(b)
+        pending = list(self.launch_order)
+        self.processed, self.next_in_order = set(), 0
+        while pending:
+            done = [b for b in pending if self.futures[b].done()]
+            if not done:
+                # nothing finished yet: block on the bucket that was launched first (of those left)
+                with self.profiler.phase("comm") if self.profiler is not None else nullcontext():
+                    self.futures[pending[0]].wait()
+                done = [pending[0]]
+            for b in done:
+                self.futures[b].wait() # surfaces errors, if any
+                pending.remove(b)
+                yield b
+        self.armed = False
+        self.futures = [None] * len(self.slots)
+        self.launch_order = []
+
+    def ready_in_order(self, b):
+        """
+        Mark bucket b (from completed()) as processed, return the buckets whose follow-up collectives
+        can be issued now: all the processed ones up to the first that is not, in index order.
+        """
+        self.processed.add(b)
+        ready = []
+        while self.next_in_order in self.processed:
+            ready.append(self.next_in_order)
+            self.next_in_order += 1
+        return ready
+
+    def shard(self, b, offset, length):
+        """The averaged (and, for sharded params, sliced to this rank) grad of a slot of bucket b."""
+        return self.outputs[b][offset:offset + length]
@@ -0,0 +1,147 @@
+"""
+Minimal serving metrics, exported in the Prometheus text exposition format.
+
+Kept dependency-free on purpose (no prometheus_client). The histograms are fixed
+bucket counters that only ever get incremented, so there are no locks anywhere:
+chat_web does all of its bookkeeping on the asyncio event loop thread, and even if
+a second thread did observe values, the worst case under the GIL is a lost sample.
+
+Example:
+    metrics = ServingMetrics()
+    metrics.ttft.observe(0.123)
+    print(metrics.render())
+"""
+
+import bisect
+import math
+
+
+def exponential_buckets(start, factor, count):
+    """Bucket upper bounds start, start*factor, ..., count of them in total."""
+    assert start > 0 and factor > 1 and count >= 1
+    return [start * factor ** i for i in range(count)]
+
+
+def _format_value(value):
+    # Prometheus wants +Inf/-Inf/NaN spelled out, and plain ints for counts
+    if isinstance(value, int):
+        return str(value)
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if math.isnan(value):
+        return "NaN"
+    return repr(float(value))
+
+
+class Counter:
+    """Monotonically increasing counter."""
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def render(self):
+        return [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} counter",
+            f"{self.name} {_format_value(self.value)}",
+        ]
+
+
+class Gauge:
+    """A value that can go up and down. Optionally computed at scrape time by a callback."""
+
+    def __init__(self, name, help, fn=None):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def render(self):
+        value = self.fn() if self.fn is not None else self.value
+        return [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} gauge",
+            f"{self.name} {_format_value(value)}",
+        ]
+
+
+class Histogram:
+    """
+    Fixed-bucket histogram. counts[i] holds the observations in (buckets[i-1], buckets[i]],
+    the last slot is the +Inf overflow bucket. Cumulative counts are only computed on render.
+    """
+
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        # bisect_left finds the first bucket with upper bound >= value, i.e. "le" semantics
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} histogram",
+        ]
+        cumulative = 0
+        for upper, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{_format_value(float(upper))}"}} {cumulative}')
+        cumulative += self.counts[-1]
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {cumulative}')
+        lines.append(f"{self.name}_sum {_format_value(self.sum)}")
+        lines.append(f"{self.name}_count {cumulative}")
+        return lines
+
+
+class ServingMetrics:
+    """All the metrics chat_web exposes on /metrics, in one place."""
+
+    def __init__(self, prefix="nanochat"):
+        latency_buckets = exponential_buckets(0.005, 2, 14) # 5ms ... ~41s
+        token_buckets = exponential_buckets(1, 2, 14) # 1 ... 8192 tokens
+        self.requests = Counter(f"{prefix}_requests_total", "Number of chat completion requests started.")
+        self.queue_wait = Histogram(f"{prefix}_queue_wait_seconds", "Time spent waiting for a free worker.", latency_buckets)
+        self.ttft = Histogram(f"{prefix}_time_to_first_token_seconds", "Time from the start of generation to the first token.", latency_buckets)
+        self.inter_token = Histogram(f"{prefix}_inter_token_latency_seconds", "Time between consecutive generated tokens.", exponential_buckets(0.001, 2, 14))
+        self.tokens_per_second = Histogram(f"{prefix}_tokens_per_second", "Generated tokens per second of a single request.", exponential_buckets(1, 2, 14))
+        self.prompt_tokens = Histogram(f"{prefix}_prompt_tokens", "Number of prompt tokens per request.", token_buckets)
+        self.completion_tokens = Histogram(f"{prefix}_completion_tokens", "Number of generated tokens per request.", token_buckets)
+        self.gauges = []
+
+    def add_gauge(self, name, help, fn):
+        """Register a gauge that is evaluated lazily at scrape time (e.g. busy workers)."""
+        gauge = Gauge(name, help, fn)
+        self.gauges.append(gauge)
+        return gauge
+
+    def render(self):
+        metrics = [
+            self.requests,
+            self.queue_wait,
+            self.ttft,
+            self.inter_token,
+            self.tokens_per_second,
+            self.prompt_tokens,
+            self.completion_tokens,
+            *self.gauges,
+        ]
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
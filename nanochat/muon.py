@@ -6,6 +6,8 @@ import torch
 import torch.distributed as dist
 from torch import Tensor
 
+from nanochat.grad_buckets import GradBuckets
+
 
 @torch.compile
 def zeropower_via_newtonschulz5(G: Tensor, steps: int) -> Tensor:
@@ -36,6 +38,24 @@ def zeropower_via_newtonschulz5(G: Tensor, steps: int) -> Tensor:
         X = X.mT
     return X
 
+@torch.no_grad()
+def muon_update_(params: list[Tensor], grads: list[Tensor], bufs: list[Tensor], lr: float, momentum: float, nesterov: bool, ns_steps: int):
+    """
+    Muon update of a list of same-shape params, in place. The momentum is updated with _foreach ops
+    and all the updates are orthogonalized together with one batched Newton-Schulz call on an (N, m, n)
+    stack, instead of N small chains of matmuls (the step is launch bound at small model sizes).
+    Note that with nesterov the grads are overwritten.
+    """
+    torch._foreach_lerp_(bufs, grads, 1 - momentum)
+    if nesterov:
+        torch._foreach_lerp_(grads, bufs, momentum)
+        updates = grads
+    else:
+        updates = bufs
+    X = zeropower_via_newtonschulz5(torch.stack(updates), steps=ns_steps)
+    scale = max(1, params[0].size(-2) / params[0].size(-1))**0.5
+    torch._foreach_add_(params, list(X.to(params[0].dtype).unbind(0)), alpha=-lr * scale)
+
 class Muon(torch.optim.Optimizer):
     """
     Muon - MomentUm Orthogonalized by Newton-schulz
@@ -71,24 +91,26 @@ class Muon(torch.optim.Optimizer):
     def step(self):
         for group in self.param_groups:
             params: list[Tensor] = group["params"]
+            assert all(p.grad is not None for p in params)
             for p in params:
-                g = p.grad
-                assert g is not None
                 state = self.state[p]
                 if "momentum_buffer" not in state:
-                    state["momentum_buffer"] = torch.zeros_like(g)
-                buf: Tensor = state["momentum_buffer"]
-                buf.lerp_(g, 1 - group["momentum"])
-                g = g.lerp_(buf, group["momentum"]) if group["nesterov"] else buf
-                g = zeropower_via_newtonschulz5(g, steps=group["ns_steps"])
-                p.add_(g, alpha=-group["lr"] * max(1, p.size(-2) / p.size(-1))**0.5)
+                    state["momentum_buffer"] = torch.zeros_like(p.grad)
+            # groups are by numel, params of the same shape are updated as one batch
+            for shape in dict.fromkeys(p.shape for p in params):
+                same_shape = [p for p in params if p.shape == shape]
+                bufs = [self.state[p]["momentum_buffer"] for p in same_shape]
+                muon_update_(same_shape, [p.grad for p in same_shape], bufs,
+                             group["lr"], group["momentum"], group["nesterov"], group["ns_steps"])
 
 
 class DistMuon(torch.optim.Optimizer):
     """
     Muon: SGD-momentum + (optional) Nesterov, then orthogonalize the 2D update via Newton–Schulz,
     finally apply aspect-ratio scaled step. Performs its own distributed synchronization:
-      - reduce_scatter(AVG) for gradient averaging
+      - reduce_scatter(AVG) for gradient averaging, in buckets (see nanochat/grad_buckets.py),
+        optionally launched from inside the last backward (call overlap_next_backward() right before it, eager mode only).
+        The grads are views into the buckets: zero them with zero_grad() of the optimizer
       - all_gather to replicate updated weights
 
     Notes:
@@ -104,9 +126,10 @@ class DistMuon(torch.optim.Optimizer):
         momentum: momentum coefficient in [0,1)
         nesterov: if True, Nesterov-style update (g <- lerp(g, buf, momentum)); else use buf
         ns_steps: number of Newton–Schulz iterations for the orthogonalization
+        bucket_size_mb: approximate size of the gradient buckets that are reduce scattered at once
     """
     def __init__(self, params, lr: float = 0.02, momentum: float = 0.95,
-                 nesterov: bool = True, ns_steps: int = 5):
+                 nesterov: bool = True, ns_steps: int = 5, bucket_size_mb: float = 32):
         defaults = dict(lr=lr, momentum=momentum, nesterov=nesterov, ns_steps=ns_steps)
         params = list(params)
         assert all(p.ndim == 2 for p in params), "Muon expects 2D parameters only"
@@ -123,6 +146,22 @@ class DistMuon(torch.optim.Optimizer):
                 print(f"Muon: Grouping {len(group_params)} params of shape {shape}, device {device}, dtype {dtype}")
             param_groups.append(dict(params=group_params, zero_buffer=torch.zeros_like(group_params[0])))
         super().__init__(param_groups, defaults)
+        # Bucket the gradients of each group: chunks of world_size params, param i of a chunk is owned by rank i
+        # (in reverse, the order the grads become ready)
+        world_size = dist.get_world_size()
+        buckets = []
+        for group in self.param_groups:
+            buckets.extend(GradBuckets.plan(group["params"][::-1], world_size, bucket_size_mb, sharded=False))
+        self.group_of = {p: group for group in self.param_groups for p in group["params"]}
+        self.grad_buckets = GradBuckets(buckets, world_size, rank)
+
+    def overlap_next_backward(self):
+        """Launch the gradient reduce scatters from inside the next backward pass, as the grads become ready."""
+        self.grad_buckets.arm()
+
+    def zero_grad(self, set_to_none=True):
+        """Zero the grads in place, they stay views into the gradient buckets (set_to_none is ignored)."""
+        self.grad_buckets.zero_grad()
 
     @torch.no_grad()
     def step(self):
@@ -132,57 +171,35 @@ class DistMuon(torch.optim.Optimizer):
         # Ensure all grads exist
         assert all(p.grad is not None for group in self.param_groups for p in group["params"]), "All params must have grads"
 
-        # Kick off all the reduce scatter operations to average up the gradients across all ranks
-        all_reduce_futures = []
-        for group in self.param_groups:
-            params = group["params"]
-            zero_buffer = group["zero_buffer"]
-            # Go through params in groups of world_size.
-            for base_i in range(0, len(params), world_size):
-                # The compute owner of each param is rank i % world_size
-                owner_idx = base_i + rank
-                # each rank stacks up its chunk of world_size params into a list
-                rs_input = [p.grad for p in params[base_i:base_i + world_size]]
-                # pad rs_input with the zero buffer to complete the group
-                rs_input.extend([zero_buffer] * (world_size - len(rs_input)))
-                # the output buffer gets strided across the group based on the rank
-                rs_output = params[owner_idx].grad if owner_idx < len(params) else torch.empty_like(zero_buffer)
-                # reduce scatter the gradients within this group of world_size params
-                work = dist.reduce_scatter(rs_output, rs_input, op=dist.ReduceOp.AVG, async_op=True).get_future()
-                all_reduce_futures.append(work)
-
-        # Now each rank computes the update and gathers
-        future_idx = 0
+        # Process the buckets of gradients in the order their reduce scatters complete
+        # (the all_gathers go out in bucket order, the same on every rank)
         all_gather_futures = []
-        for group in self.param_groups:
-            params = group["params"]
-            zero_buffer = group["zero_buffer"]
-            # Go through params in groups of world_size.
-            for base_i in range(0, len(params), world_size):
-                # The compute owner of each param is rank i % world_size
-                owner_idx = base_i + rank # calculate the index of the param that this rank owns
-                # Wait for the reduce scatter to complete
-                all_reduce_futures[future_idx].wait() # possibly later we could use wait_any polling instead
-                future_idx += 1
-                # Owner computes the Muon update, result is in its param
-                if owner_idx < len(params):
-                    p = params[owner_idx]
-                    g = p.grad  # now averaged across ranks
+        for b in self.grad_buckets.completed():
+            slots = self.grad_buckets.slots[b]
+            group = self.group_of[slots[0][0]] # a bucket never spans two groups
+            # Owner computes the Muon update of all the params it owns in this bucket at once, result is in its params
+            owned = [(p, offset, length) for p, owner, offset, length in slots if owner == rank]
+            if owned:
+                params = [p for p, _, _ in owned]
+                for p in params:
                     state = self.state[p]
                     if "momentum_buffer" not in state:
-                        state["momentum_buffer"] = torch.zeros_like(g)
-                    buf: Tensor = state["momentum_buffer"]
-                    buf.lerp_(g, 1.0 - group["momentum"])
-                    g = g.lerp_(buf, group["momentum"]) if group["nesterov"] else buf
-                    g = zeropower_via_newtonschulz5(g, steps=group["ns_steps"])
-                    scale = (max(1.0, p.size(-2) / p.size(-1)) ** 0.5)
-                    p.add_(g, alpha=-group["lr"] * scale)
-                # Replicate updated parameters to all ranks
-                ag_input = params[owner_idx] if owner_idx < len(params) else zero_buffer
-                ag_output = params[base_i:base_i + world_size]
-                ag_output.extend([torch.empty_like(zero_buffer) for _ in range(world_size - len(ag_output))]) # pad
-                work = dist.all_gather(ag_output, ag_input, async_op=True).get_future()
-                all_gather_futures.append(work)
+                        state["momentum_buffer"] = torch.zeros_like(p)
+                bufs = [self.state[p]["momentum_buffer"] for p in params]
+                grads = [self.grad_buckets.shard(b, offset, length).view_as(p) for p, offset, length in owned] # averaged across ranks
+                muon_update_(params, grads, bufs, group["lr"], group["momentum"], group["nesterov"], group["ns_steps"])
+            # Replicate updated parameters to all ranks, one chunk of world_size params at a time
+            for ready in self.grad_buckets.ready_in_order(b):
+                slots = self.grad_buckets.slots[ready]
+                zero_buffer = self.group_of[slots[0][0]]["zero_buffer"]
+                chunks = {}
+                for p, _, offset, _ in slots:
+                    chunks.setdefault(offset, []).append(p) # params of a chunk share their offset, in owner order
+                for chunk in chunks.values():
+                    ag_input = chunk[rank] if rank < len(chunk) else zero_buffer
+                    ag_output = chunk + [torch.empty_like(zero_buffer) for _ in range(world_size - len(chunk))] # pad
+                    work = dist.all_gather(ag_output, ag_input, async_op=True).get_future()
+                    all_gather_futures.append(work)
 
         # Wait for all work to finish
         torch.futures.collect_all(all_gather_futures).wait()
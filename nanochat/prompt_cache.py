@@ -0,0 +1,101 @@
+"""
+On-disk cache of tokenized eval prompts, so that evaluating many checkpoints of a run
+pays for rendering and tokenizing the eval data only once.
+
+An entry is identified by a hash of everything the tokens depend on (task, its config,
+the exact tokenizer, the data itself, ...), so a stale entry is never picked up: when any
+of that changes the key changes. Entries are .npz files of flat int32 arrays: a list of
+token lists is stored as the concatenated tokens plus an offsets array.
+
+In DDP, rank 0 builds a missing entry while the other ranks wait for its file to appear (not
+in a collective: building a big task can outlast the collective timeout), then everyone loads it.
+"""
+
+import hashlib
+import json
+import os
+import pickle
+import time
+
+import numpy as np
+import torch.distributed as dist
+
+from nanochat.common import get_base_dir
+
+_fingerprints = {}
+
+def tokenizer_fingerprint(tokenizer):
+    """A hash that changes whenever the tokenizer would produce different token ids."""
+    key = id(tokenizer)
+    if key not in _fingerprints:
+        if hasattr(tokenizer, "enc"):
+            payload = pickle.dumps(tokenizer.enc) # RustBPETokenizer: the tiktoken Encoding (ranks, pattern, specials)
+        elif hasattr(tokenizer, "tokenizer"):
+            payload = tokenizer.tokenizer.to_str().encode("utf-8") # HuggingFaceTokenizer: the full tokenizer json
+        else:
+            raise ValueError(f"Don't know how to fingerprint tokenizer of type {type(tokenizer)}")
+        _fingerprints[key] = hashlib.sha256(payload).hexdigest()
+    return _fingerprints[key]
+
+def data_fingerprint(data):
+    """Hash of json-serializable data (e.g. the list of examples of a task)."""
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode("utf-8")).hexdigest()
+
+def cache_key(**key_data):
+    return hashlib.sha256(json.dumps(key_data, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:16]
+
+def cache_path(name, key):
+    cache_dir = os.path.join(get_base_dir(), "prompt_cache")
+    return os.path.join(cache_dir, f"{name}_{key}.npz")
+
+def pack_ragged(lists):
+    """List of int lists -> (values, offsets) with lists[i] == values[offsets[i]:offsets[i+1]]."""
+    lengths = np.fromiter((len(x) for x in lists), dtype=np.int64, count=len(lists))
+    offsets = np.zeros(len(lists) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    values = np.fromiter((v for x in lists for v in x), dtype=np.int32, count=int(offsets[-1]))
+    return values, offsets
+
+def unpack_ragged(values, offsets):
+    values = values.tolist()
+    offsets = offsets.tolist()
+    return [values[a:b] for a, b in zip(offsets[:-1], offsets[1:])]
+
+def save_entry(path, ragged, flat):
+    """Write ragged fields (lists of int lists) and flat fields (lists of ints) atomically."""
+    arrays = {}
+    for name, lists in ragged.items():
+        arrays[f"{name}.values"], arrays[f"{name}.offsets"] = pack_ragged(lists)
+    for name, values in flat.items():
+        arrays[name] = np.asarray(values, dtype=np.int64)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + f".tmp{os.getpid()}.npz" # np.savez insists on the .npz suffix
+    np.savez(tmp_path, **arrays)
+    os.replace(tmp_path, path)
+
+def load_entry(path):
+    ragged, flat = {}, {}
+    with np.load(path) as f:
+        for name in f.files:
+            if name.endswith(".values"):
+                field = name[:-len(".values")]
+                ragged[field] = unpack_ragged(f[name], f[field + ".offsets"])
+            elif not name.endswith(".offsets"):
+                flat[name] = f[name].tolist()
+    return ragged, flat
+
+def load_or_build(name, key, build_fn):
+    """
+    Return the cached (ragged, flat) fields for this key, calling build_fn() -> (ragged, flat)
+    and saving the result if the entry does not exist yet.
+    """
+    path = cache_path(name, key)
+    rank = dist.get_rank() if dist.is_initialized() else 0
+    if not os.path.exists(path):
+        if rank == 0:
+            ragged, flat = build_fn()
+            save_entry(path, ragged, flat)
+        else:
+            while not os.path.exists(path): # save_entry renames the finished file into place
+                time.sleep(1)
+    return load_entry(path)
@@ -0,0 +1,72 @@
+"""
+Weight-only int8 quantization of the GPT, for cheap (CPU) inference.
+
+All the Linear layers of the Transformer (attention c_q/c_k/c_v/c_proj, MLP c_fc/c_proj)
+and the lm_head get their weights stored as int8 with one fp32 scale per output channel
+(symmetric absmax). Activations stay in float. On CPU (and MPS) the matmul runs directly
+on the int8 weights via torch._weight_int8pack_mm, elsewhere the weights are dequantized
+on the fly. Decode is memory bandwidth bound, so 4X smaller weights (vs fp32) is ~the speedup.
+The token embedding is a lookup, not a matmul, so it is left alone.
+
+Example:
+    model = quantize_model(model) # in place, returns the model for convenience
+"""
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+class Int8Linear(nn.Module):
+    """Drop-in replacement for a bias-free nn.Linear with int8 weights and per-channel scales."""
+
+    def __init__(self, in_features, out_features, device=None):
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.register_buffer("weight_int8", torch.empty((out_features, in_features), dtype=torch.int8, device=device))
+        self.register_buffer("scale", torch.empty((out_features,), dtype=torch.float32, device=device))
+
+    @classmethod
+    @torch.no_grad()
+    def from_linear(cls, linear):
+        assert linear.bias is None, "our Linear layers have no biases"
+        w = linear.weight.float()
+        module = cls(linear.in_features, linear.out_features, device=w.device)
+        scale = w.abs().amax(dim=1).clamp(min=1e-12) / 127.0
+        module.weight_int8.copy_(torch.round(w / scale[:, None]).clamp(-127, 127).to(torch.int8))
+        module.scale.copy_(scale)
+        return module
+
+    def dequantize(self, dtype=torch.float32):
+        return self.weight_int8.to(dtype) * self.scale.to(dtype)[:, None]
+
+    def forward(self, x):
+        if x.device.type in ("cpu", "mps") and hasattr(torch, "_weight_int8pack_mm"):
+            # fused int8 weight matmul, wants a 2D input and the scales in the dtype of the input
+            x2d = x.reshape(-1, self.in_features).contiguous()
+            y = torch._weight_int8pack_mm(x2d, self.weight_int8, self.scale.to(x.dtype))
+            return y.view(*x.shape[:-1], self.out_features)
+        return F.linear(x, self.dequantize(x.dtype))
+
+    def extra_repr(self):
+        return f"in_features={self.in_features}, out_features={self.out_features}"
+
+
+def quantize_model(model):
+    """Replace the Linear layers of a GPT with Int8Linear (in place). Works on the meta device too."""
+    targets = [(model, "lm_head")]
+    for block in model.transformer.h:
+        targets += [(block.attn, name) for name in ("c_q", "c_k", "c_v", "c_proj")]
+        targets += [(block.mlp, name) for name in ("c_fc", "c_proj")]
+    for parent, name in targets:
+        linear = getattr(parent, name)
+        if isinstance(linear, nn.Linear):
+            setattr(parent, name, Int8Linear.from_linear(linear))
+    return model
+
+
+def model_size_bytes(model):
+    """Bytes taken by the parameters and (persistent or not) buffers of a model."""
+    tensors = list(model.parameters()) + list(model.buffers())
+    return sum(t.numel() * t.element_size() for t in tensors)
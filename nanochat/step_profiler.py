@@ -0,0 +1,183 @@
+"""
+Opt-in per-phase timing of training steps (data wait, forward, backward, optimizers, comm wait).
+
+On CUDA every phase is bracketed by a pair of CUDA events on the current stream, so the
+timings are GPU time and cost no extra synchronization: the events are only read when a
+window of steps is summarized. Elsewhere (CPU, MPS) it's plain wall clock.
+Phases that run more than once per step (e.g. forward/backward with gradient accumulation)
+are summed per step. Phases opened inside another phase (e.g. "comm", the wait for the
+gradient reduce_scatters inside the optimizer step) are nested: they are reported, but
+their time is also part of the enclosing phase. "other" is whatever the top-level phases don't cover.
+
+Optionally, a torch.profiler trace of a range of steps is written (with the phases as labels).
+
+Example:
+    profiler = StepProfiler(device_type, enabled=True, window=50)
+    for step in range(num_steps):
+        profiler.start_step(step)
+        with profiler.phase("data"):
+            x, y = next(loader)
+        ...
+        profiler.end_step()
+        if profiler.window_ready():
+            print0(profiler.format(profiler.summary()))
+"""
+
+import os
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+
+import torch
+
+
+def percentile(values, q):
+    """The q-th percentile (0-100) of a list of numbers, linearly interpolated."""
+    values = sorted(values)
+    if not values:
+        return float("nan")
+    k = (len(values) - 1) * q / 100
+    lo = int(k)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+def parse_step_range(spec):
+    """ "100-105" -> (100, 105) inclusive, "" -> None."""
+    if not spec:
+        return None
+    start, _, end = spec.partition("-")
+    start = int(start)
+    return start, int(end) if end else start
+
+
+class StepProfiler:
+    """Times the phases of training steps, see the module docstring. enabled=False makes every call a no-op."""
+
+    def __init__(self, device_type, enabled=True, window=50, trace_steps="", trace_dir=None):
+        self.enabled = enabled
+        self.use_cuda_events = enabled and device_type == "cuda"
+        self.window = window
+        self.trace_range = parse_step_range(trace_steps) if enabled else None
+        self.trace_dir = trace_dir
+        self.trace = None
+        self.history = [] # per step: {phase: ms}
+        self.nested = set() # names of the phases that ran inside another phase
+        self.pending = [] # steps whose events are not resolved yet
+        self.depth = 0
+        self.steps_since_summary = 0
+
+    def _mark(self):
+        if self.use_cuda_events:
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            return event
+        return time.perf_counter()
+
+    def _elapsed_ms(self, start, end):
+        if self.use_cuda_events:
+            end.synchronize()
+            return start.elapsed_time(end)
+        return 1000 * (end - start)
+
+    def attach(self, optimizers):
+        """Also time the gradient communication waits of the distributed optimizers, as the "comm" phase."""
+        if not self.enabled:
+            return
+        for opt in optimizers:
+            if hasattr(opt, "grad_buckets"):
+                opt.grad_buckets.profiler = self
+
+    def start_step(self, step):
+        if not self.enabled:
+            return
+        self.step = step
+        self.marks = [] # (phase, start, end)
+        self.step_start = self._mark()
+        if self.trace_range is not None and step == self.trace_range[0]:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.trace = torch.profiler.profile(activities=activities)
+            self.trace.__enter__()
+
+    @contextmanager
+    def _phase(self, name):
+        if self.depth > 0:
+            self.nested.add(name)
+        self.depth += 1
+        label = torch.profiler.record_function(name) if self.trace is not None else nullcontext()
+        start = self._mark()
+        try:
+            with label:
+                yield
+        finally:
+            self.marks.append((name, start, self._mark()))
+            self.depth -= 1
+
+    def phase(self, name):
+        """Context manager timing one phase of the current step."""
+        if not self.enabled:
+            return nullcontext()
+        return self._phase(name)
+
+    def end_step(self):
+        if not self.enabled:
+            return
+        self.pending.append((self.step_start, self._mark(), self.marks))
+        self.steps_since_summary += 1
+        if self.trace is not None and self.step == self.trace_range[1]:
+            self.trace.__exit__(None, None, None)
+            os.makedirs(self.trace_dir, exist_ok=True)
+            rank = int(os.environ.get("RANK", 0))
+            path = os.path.join(self.trace_dir, f"trace_steps{self.trace_range[0]}-{self.trace_range[1]}_rank{rank}.json")
+            self.trace.export_chrome_trace(path)
+            print(f"Wrote torch.profiler trace to {path}")
+            self.trace = None
+
+    def _resolve(self):
+        # read the timings of all the finished steps (on CUDA this waits for their last event)
+        for step_start, step_end, marks in self.pending:
+            times = defaultdict(float)
+            for name, start, end in marks:
+                times[name] += self._elapsed_ms(start, end)
+            times["step"] = self._elapsed_ms(step_start, step_end)
+            times["other"] = times["step"] - sum(ms for name, ms in times.items() if name not in self.nested and name not in ("step", "other"))
+            self.history.append(dict(times))
+        self.pending = []
+
+    def window_ready(self):
+        return self.enabled and self.steps_since_summary >= self.window
+
+    def summary(self, last=None):
+        """{phase: {p50, p90, max (ms), share (% of the median step)}} over the last `last` steps (default: the window)."""
+        self._resolve()
+        self.steps_since_summary = 0
+        steps = self.history[-(last or self.window):] if last != 0 else self.history
+        names = sorted({name for times in steps for name in times}, key=lambda name: (name in ("step", "other"), name))
+        step_p50 = percentile([times["step"] for times in steps], 50)
+        stats = {}
+        for name in names:
+            values = [times.get(name, 0.0) for times in steps]
+            p50 = percentile(values, 50)
+            stats[name] = dict(p50=p50, p90=percentile(values, 90), max=max(values), share=100 * p50 / step_p50 if step_p50 else 0.0)
+        return stats
+
+    def format(self, stats):
+        """One log line: phase p50/p90 ms (share of the step)."""
+        parts = [f"{name}{'*' if name in self.nested else ''}: {s['p50']:.1f}/{s['p90']:.1f}ms ({s['share']:.0f}%)" for name, s in stats.items()]
+        return "profile p50/p90 | " + " | ".join(parts)
+
+    def wandb_data(self, stats):
+        data = {}
+        for name, s in stats.items():
+            data[f"profile/{name}_p50_ms"] = s["p50"]
+            data[f"profile/{name}_p90_ms"] = s["p90"]
+        return data
+
+    def report_data(self):
+        """Breakdown over all the profiled steps, for the nanochat.report section."""
+        if not self.enabled:
+            return {}
+        stats = self.summary(last=0)
+        return {f"Step phase {name}{' (nested)' if name in self.nested else ''}": f"p50 {s['p50']:.1f}ms, p90 {s['p90']:.1f}ms, max {s['max']:.1f}ms ({s['share']:.0f}% of step)" for name, s in stats.items()}
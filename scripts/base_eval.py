@@ -22,15 +22,18 @@ import yaml
 from nanochat.checkpoint_manager import load_model
 from nanochat.common import autodetect_device_type, compute_cleanup, compute_init, get_base_dir, print0
 from nanochat.core_eval import evaluate_task
+from nanochat.eval_cache import EvalCache, checkpoint_fingerprint
 from nanochat.tokenizer import HuggingFaceTokenizer
 
 # -----------------------------------------------------------------------------
 # nanoChat specific function dealing with I/O etc.
 
-def evaluate_model(model, tokenizer, device, max_per_task=-1):
+def evaluate_model(model, tokenizer, device, max_per_task=-1, max_batch_tokens=8192, cache=None):
     """
     Evaluate a base model on the CORE benchmark.
     - max_per_task: crop the data to this many examples per task for testing (-1 = disable)
+    - max_batch_tokens: how many (padded) tokens to pack into a single forward pass
+    - cache: optional EvalCache of this model, tasks already evaluated are not run again
     TODO: clean up this function, delete the need for all the files, for pandas dependency, etc.
     """
     # Load config and task metadata
@@ -70,8 +73,12 @@ def evaluate_model(model, tokenizer, device, max_per_task=-1):
         if max_per_task > 0:
             data = data[:max_per_task]
 
-        # run the evaluation for this task
-        accuracy = evaluate_task(model, tokenizer, data, device, task_meta)
+        # run the evaluation for this task (or look it up)
+        run_task = lambda: evaluate_task(model, tokenizer, data, device, task_meta, max_batch_tokens=max_batch_tokens, label=label)
+        if cache is not None:
+            accuracy = cache.get_or_compute(f"CORE/{label}", {**task_meta, "max_per_task": max_per_task}, run_task)
+        else:
+            accuracy = run_task()
 
         results[label] = accuracy
         row = eval_metadata[eval_metadata["Eval Task"] == label]
@@ -122,6 +129,8 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--hf-path', type=str, default=None, help='HuggingFace model path to evaluate')
     parser.add_argument('--max-per-task', type=int, default=-1, help='Max examples per task to evaluate (-1 = disable)')
+    parser.add_argument('--batch-tokens', type=int, default=8192, help='Max (padded) tokens per forward pass')
+    parser.add_argument('--no-cache', action='store_true', help='Recompute every task even if its result is in the eval cache')
     args = parser.parse_args()
 
     # distributed / precision setup
@@ -137,15 +146,19 @@ def main():
         model, tokenizer = load_hf_model(hf_path, device)
         model_name = hf_path # just for logging
         model_slug = hf_path.replace("/", "-") # for the output csv file
+        cache = EvalCache(f"hf:{hf_path}", enabled=not args.no_cache)
     else:
         # load a local model from the file system
         model, tokenizer, meta = load_model("base", device, phase="eval")
         model_name = f"base_model (step {meta['step']})" # just for logging
         model_slug = f"base_model_{meta['step']:06d}" # for the output csv file
+        cache = EvalCache(checkpoint_fingerprint("base", step=meta["step"]), enabled=not args.no_cache)
 
     # Evaluate the model
     with autocast_ctx:
-        out = evaluate_model(model, tokenizer, device, max_per_task=args.max_per_task)
+        out = evaluate_model(model, tokenizer, device, max_per_task=args.max_per_task, max_batch_tokens=args.batch_tokens, cache=cache)
+    if cache.hits:
+        print0(f"Reused cached results for {len(cache.hits)}/{len(out['results'])} tasks")
 
     # Write out the results to a csv file
     core_metric = None
@@ -175,6 +188,7 @@ def main():
         {
             "Model": model_name,
             "CORE metric": core_metric,
+            "Cached tasks": len(cache.hits),
         },
         centered_results, # the full table
     ])
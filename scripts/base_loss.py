@@ -15,6 +15,7 @@ from nanochat.checkpoint_manager import load_model
 from nanochat.common import autodetect_device_type, compute_cleanup, compute_init, print0
 from nanochat.dataloader import tokenizing_distributed_data_loader
 from nanochat.engine import Engine
+from nanochat.eval_cache import EvalCache, checkpoint_fingerprint
 from nanochat.loss_eval import evaluate_bpb
 from nanochat.tokenizer import get_token_bytes
 
@@ -23,6 +24,7 @@ device_batch_size = 32
 split_tokens = 20*524288  # number of tokens to evaluate per split
 model_tag = None # optional model tag for the output directory name
 model_step = None # optional model step for the output directory name
+use_cache = 1 # reuse the bpb of a split if this checkpoint was already evaluated with the same settings (see nanochat/eval_cache.py)
 device_type = "" # cuda|cpu|mps (empty => autodetect)
 exec(open(os.path.join('nanochat', 'configurator.py')).read()) # overrides from command line or config file
 
@@ -32,6 +34,7 @@ ddp, ddp_rank, ddp_local_rank, ddp_world_size, device = compute_init(device_type
 model, tokenizer, meta = load_model("base", device, phase="eval", model_tag=model_tag, step=model_step)
 sequence_len = meta["model_config"]["sequence_len"] # could be arbitrary really
 autocast_ctx = torch.amp.autocast(device_type=device_type, dtype=torch.bfloat16) if device_type == "cuda" else nullcontext()
+cache = EvalCache(checkpoint_fingerprint("base", model_tag, meta["step"]), enabled=bool(use_cache))
 
 # Evaluate the loss on each split
 tokens_per_step = device_batch_size * sequence_len * ddp_world_size
@@ -39,11 +42,15 @@ assert split_tokens % tokens_per_step == 0, "split_tokens must be divisible by t
 steps = split_tokens // tokens_per_step
 token_bytes = get_token_bytes(device=device)
 bpb_results = {}
-for split_name in ["train", "val"]:
+def split_bpb(split_name):
     loader = tokenizing_distributed_data_loader(device_batch_size, sequence_len, split_name, device=device)
     with autocast_ctx:
-        bpb = evaluate_bpb(model, loader, steps, token_bytes)
-    print0(f"{split_name} bpb: {bpb:.4f}")
+        return evaluate_bpb(model, loader, steps, token_bytes)
+for split_name in ["train", "val"]:
+    # which tokens get evaluated depends on how the loader splits the data into batches and across ranks
+    bpb_config = {"split_tokens": split_tokens, "sequence_len": sequence_len, "device_batch_size": device_batch_size, "world_size": ddp_world_size}
+    bpb = cache.get_or_compute(f"bpb/{split_name}", bpb_config, lambda: split_bpb(split_name))
+    print0(f"{split_name} bpb: {bpb:.4f}{' (cached)' if f'bpb/{split_name}' in cache.hits else ''}")
     bpb_results[split_name] = bpb
 
 # Master process also samples from the model
@@ -20,7 +20,7 @@ from contextlib import nullcontext
 import torch
 import wandb
 
-from nanochat.checkpoint_manager import save_checkpoint
+from nanochat.checkpoint_manager import AsyncCheckpointer
 from nanochat.common import (
     DummyWandb,
     autodetect_device_type,
@@ -34,6 +34,7 @@ from nanochat.dataloader import tokenizing_distributed_data_loader
 from nanochat.engine import Engine
 from nanochat.gpt import GPT, GPTConfig
 from nanochat.loss_eval import evaluate_bpb
+from nanochat.step_profiler import StepProfiler
 from nanochat.tokenizer import get_token_bytes, get_tokenizer
 from scripts.base_eval import evaluate_model
 
@@ -53,6 +54,8 @@ target_flops = -1.0 # calculate num_iterations to reach target_flops. Useful for
 target_param_data_ratio = 20 # calculate num_iterations to maintain fixed data:param ratio (Chinchilla=20) (-1 = disable)
 # Optimization
 device_batch_size = 32 # per-device batch size (set to not OOM)
+activation_checkpoint = "none" # none|block|mlp|attn_out: trade recompute for activation memory (bigger device_batch_size), see GPTConfig
+checkpoint_every = 1 # apply activation_checkpoint to every k-th block
 total_batch_size = 524288 # total desired batch size, in #tokens
 embedding_lr = 0.2 # learning rate for the embedding parameters (Adam)
 unembedding_lr = 0.004 # learning rate for the unembedding parameters (Adam)
@@ -62,6 +65,10 @@ grad_clip = 1.0 # gradient clipping value (0.0 = disabled)
 warmup_ratio = 0.0 # ratio of iterations for LR warmup
 warmdown_ratio = 0.2 # ratio of iterations for LR warmdown
 final_lr_frac = 0.0 # final LR is this fraction of the initial LR
+# Profiling
+profile = 0 # 1 = time the phases of every step (data, forward, backward, optimizers, comm wait), see nanochat/step_profiler.py
+profile_window = 50 # log the percentiles of the phases every this many steps
+profile_trace_steps = "" # e.g. "100-105": also write a torch.profiler trace of these steps
 # Evaluation
 eval_every = 250 # every how many steps to evaluate the model for val bpb
 eval_tokens = 20*524288 # number of tokens to evaluate val loss on
@@ -70,6 +77,7 @@ core_metric_max_per_task = 500 # examples per task in estimating the core metric
 sample_every = 2000 # every how many steps to sample from the model
 # Output
 model_tag = "" # optionally override the model tag for the output checkpoint directory name
+save_every = -1 # every how many steps to save a checkpoint, in the background (-1 = only at the end)
 # now allow CLI to override the settings via the configurator lol
 config_keys = [k for k,v in globals().items() if not k.startswith('_') and isinstance(v, (int, float, bool, str))]
 exec(open(os.path.join('nanochat', 'configurator.py')).read()) # overrides from command line or config file
@@ -121,6 +129,7 @@ with torch.device("meta"):
     model = GPT(model_config)
 model.to_empty(device=device)
 model.init_weights()
+model.set_activation_checkpointing(activation_checkpoint, checkpoint_every)
 orig_model = model # original, uncompiled model, for saving raw model state_dict
 model = torch.compile(model, dynamic=False) # TODO: dynamic True/False think through
 num_params = sum(p.numel() for p in model.parameters())
@@ -153,6 +162,13 @@ print0(f"Total training FLOPs estimate: {num_flops_per_token * total_tokens:e}")
 optimizers = model.setup_optimizers(unembedding_lr=unembedding_lr, embedding_lr=embedding_lr, matrix_lr=matrix_lr, weight_decay=weight_decay)
 adamw_optimizer, muon_optimizer = optimizers
 
+# Checkpoints are written in a background thread
+checkpointer = AsyncCheckpointer()
+
+# Opt-in per-phase timing of the training steps
+profiler = StepProfiler(device_type, enabled=bool(profile), window=profile_window, trace_steps=profile_trace_steps, trace_dir=os.path.join(get_base_dir(), "profile"))
+profiler.attach(optimizers)
+
 # Initialize the DataLoaders for train/val
 base_dir = get_base_dir()
 tokens_dir = os.path.join(base_dir, "tokenized_data")
@@ -247,15 +263,15 @@ for step in range(num_iterations + 1):
             print0(tokenizer.decode(sample[0]))
         model.train()
 
-    # save checkpoint at the end of the run (only on master process)
-    if master_process and last_step:
+    # save checkpoint at the end of the run (and every save_every steps), all ranks: each writes its optimizer shard
+    if last_step or (save_every > 0 and step > 0 and step % save_every == 0):
         output_dirname = model_tag if model_tag else f"d{depth}" # e.g. d12
         checkpoint_dir = os.path.join(base_dir, "base_checkpoints", output_dirname)
-        save_checkpoint(
+        checkpointer.save(
             checkpoint_dir,
             step,
             orig_model.state_dict(),
-            [opt.state_dict() for opt in optimizers], # TODO: make sure saving across ranks is done correctly
+            [opt.state_dict() for opt in optimizers], # sharded by rank for DistAdamW/DistMuon
             {
                 "step": step,
                 "val_bpb": val_bpb, # loss at last step
@@ -274,16 +290,20 @@ for step in range(num_iterations + 1):
     # evaluate the gradient
     synchronize()
     t0 = time.time()
+    profiler.start_step(step)
     for micro_step in range(grad_accum_steps):
-        with autocast_ctx:
+        with profiler.phase("forward"), autocast_ctx:
             loss = model(x, y)
         train_loss = loss.detach() # for logging
         loss = loss / grad_accum_steps # each .backward() is a grad sum => normalize loss here
-        loss.backward()
-        x, y = next(train_loader) # prefetch the next batch while the GPU is busy with forward/backward
+        with profiler.phase("backward"):
+            loss.backward()
+        with profiler.phase("data"):
+            x, y = next(train_loader) # prefetch the next batch while the GPU is busy with forward/backward
     # gradient clipping (TODO possibly expertiment with)
     if grad_clip > 0.0:
-        torch.nn.utils.clip_grad_norm_(orig_model.parameters(), grad_clip)
+        with profiler.phase("grad_clip"):
+            torch.nn.utils.clip_grad_norm_(orig_model.parameters(), grad_clip)
     # step the optimizers
     lrm = get_lr_multiplier(step)
     for opt in optimizers:
@@ -292,9 +312,12 @@ for step in range(num_iterations + 1):
     muon_momentum = get_muon_momentum(step)
     for group in muon_optimizer.param_groups:
         group["momentum"] = muon_momentum
-    for opt in optimizers:
-        opt.step()
-    model.zero_grad(set_to_none=True)
+    for opt_name, opt in zip(["adamw", "muon"], optimizers):
+        with profiler.phase(f"optim_{opt_name}"):
+            opt.step()
+    for opt in optimizers: # (the distributed optimizers zero their gradient buckets in place)
+        opt.zero_grad(set_to_none=True)
+    profiler.end_step()
     synchronize()
     t1 = time.time()
     dt = t1 - t0
@@ -322,6 +345,12 @@ for step in range(num_iterations + 1):
             "train/tok_per_sec": tok_per_sec,
             "train/mfu": mfu,
         })
+    if profiler.window_ready():
+        profile_stats = profiler.summary()
+        print0(profiler.format(profile_stats))
+        wandb_run.log({"step": step, **profiler.wandb_data(profile_stats)})
+
+checkpointer.wait() # make sure the last checkpoint is written
 
 # print a few more stats
 print0(f"Peak memory usage: {get_max_memory() / 1024 / 1024:.2f}MiB")
@@ -340,6 +369,7 @@ get_report().log(section="Base model training", data=[
         "Number of training tokens": total_tokens,
         "Tokens : Params ratio": total_batch_size * num_iterations / num_params,
         "DDP world size": ddp_world_size,
+        "Activation checkpointing": f"{activation_checkpoint} (every {checkpoint_every})",
         "warmup_ratio": warmup_ratio,
         "warmdown_ratio": warmdown_ratio,
         "final_lr_frac": final_lr_frac,
@@ -349,10 +379,12 @@ get_report().log(section="Base model training", data=[
         "Final validation bpb": val_bpb,
         "CORE metric estimate": results.get("core_metric", None),
         "MFU %": f"{mfu:.2f}%",
+        "Throughput (tok/sec)": f"{tok_per_sec:,}",
         "Total training flops": f"{flops_so_far:e}",
         "Total training time": f"{total_training_time/60:.2f}m",
         "Peak memory usage": f"{get_max_memory() / 1024 / 1024:.2f}MiB",
-    }
+    },
+    profiler.report_data(), # per-phase breakdown of the steps (if profile=1)
 ])
 
 # cleanup
@@ -22,6 +22,10 @@ parser.add_argument('-t', '--temperature', type=float, default=0.6, help='Temper
 parser.add_argument('-k', '--top-k', type=int, default=50, help='Top-k sampling parameter')
 parser.add_argument('--device-type', type=str, default='', choices=['cuda', 'cpu', 'mps'], help='Device type for evaluation: cuda|cpu|mps. empty => autodetect')
 parser.add_argument('-d', '--dtype', type=str, default='bfloat16', choices=['float32', 'bfloat16'])
+parser.add_argument('--quantize', action='store_true', help='Use the int8 weight-only quantized model')
+parser.add_argument('--rope-scaling', type=str, default='none', choices=['none', 'linear', 'ntk'], help='RoPE scaling, to chat beyond the training context')
+parser.add_argument('--rope-scaling-factor', type=float, default=1.0, help='RoPE scaling factor, e.g. 4 for 4X the training context')
+parser.add_argument('--kv-quantize', type=str, default='none', choices=['none', 'int8', 'fp8'], help='KV cache storage (8 bits = half the memory of bf16)')
 args = parser.parse_args()
 
 # Init the model and tokenizer
@@ -30,7 +34,8 @@ device_type = autodetect_device_type() if args.device_type == "" else args.devic
 ddp, ddp_rank, ddp_local_rank, ddp_world_size, device = compute_init(device_type)
 ptdtype = torch.float32 if args.dtype == 'float32' else torch.bfloat16
 autocast_ctx = torch.amp.autocast(device_type=device_type, dtype=ptdtype) if device_type == "cuda" else nullcontext()
-model, tokenizer, meta = load_model(args.source, device, phase="eval", model_tag=args.model_tag, step=args.step)
+model, tokenizer, meta = load_model(args.source, device, phase="eval", model_tag=args.model_tag, step=args.step, quantize=args.quantize)
+model.set_rope_scaling(args.rope_scaling, args.rope_scaling_factor)
 
 # Special tokens for the chat state machine
 bos = tokenizer.get_bos_token_id()
@@ -38,7 +43,7 @@ user_start, user_end = tokenizer.encode_special("<|user_start|>"), tokenizer.enc
 assistant_start, assistant_end = tokenizer.encode_special("<|assistant_start|>"), tokenizer.encode_special("<|assistant_end|>")
 
 # Create Engine for efficient generation
-engine = Engine(model, tokenizer)
+engine = Engine(model, tokenizer, kv_quantize=None if args.kv_quantize == 'none' else args.kv_quantize)
 
 print("\nNanoChat Interactive Mode")
 print("-" * 50)
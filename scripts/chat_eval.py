@@ -9,6 +9,7 @@ torchrun --nproc_per_node=8 -m scripts.chat_eval -- -a ARC-Easy
 """
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import nullcontext
 from functools import partial
 
@@ -16,8 +17,18 @@ import torch
 import torch.distributed as dist
 
 from nanochat.checkpoint_manager import load_model
-from nanochat.common import autodetect_device_type, compute_cleanup, compute_init, get_dist_info, print0
+from nanochat.common import (
+    autodetect_device_type,
+    compute_cleanup,
+    compute_init,
+    get_dist_info,
+    length_bucketed_batches,
+    print0,
+)
+from nanochat.conversation_cache import task_fingerprint
 from nanochat.engine import Engine
+from nanochat.eval_cache import EvalCache, checkpoint_fingerprint
+from nanochat.prompt_cache import cache_key, load_or_build, tokenizer_fingerprint
 from tasks.arc import ARC
 from tasks.gsm8k import GSM8K
 from tasks.humaneval import HumanEval
@@ -25,43 +36,72 @@ from tasks.mmlu import MMLU
 from tasks.spellingbee import SpellingBee
 
 # -----------------------------------------------------------------------------
-# Generative evaluation loop (we go one problem at a time, sample, evaluate)
+# Tokenized prompts, through the on-disk prompt cache (shared by all the checkpoints we evaluate)
+
+def get_prompt_ids(task_name, task_object, tokenizer, num_problems):
+    """The tokenized prompts (render_for_completion) of the first num_problems problems of a task."""
+    key = cache_key(
+        task_name=task_name,
+        task=task_fingerprint(task_object), # the config and the data (dataset fingerprints) of the task
+        tokenizer=tokenizer_fingerprint(tokenizer),
+        num_problems=num_problems,
+    )
+    def build():
+        render = lambda i: tokenizer.render_for_completion(task_object[i])
+        with ThreadPoolExecutor(max_workers=8) as pool: # tiktoken releases the GIL while encoding
+            prompt_ids = list(pool.map(render, range(num_problems)))
+        return {"prompt_ids": prompt_ids}, {}
+    ragged, _ = load_or_build(f"chat_{task_name}", key, build)
+    return ragged["prompt_ids"]
 
-def run_generative_eval(task_object, tokenizer, model, engine, num_samples, max_new_tokens, temperature, top_k, max_problems=None):
+# -----------------------------------------------------------------------------
+# Generative evaluation loop
+# Prompts of gen_batch_size problems are decoded together in one batch (num_samples rows each),
+# and every completion is handed to a scoring thread as soon as its row finishes, so that
+# checking the answers (e.g. running HumanEval code) overlaps with decoding.
+
+def run_generative_eval(task_object, tokenizer, model, engine, num_samples, max_new_tokens, temperature, top_k, max_problems=None, prompt_ids=None, gen_batch_size=1):
 
     ddp, ddp_rank, ddp_local_rank, ddp_world_size = get_dist_info()
     device = model.get_device()
 
     num_problems = len(task_object) if max_problems is None else min(len(task_object), max_problems)
+    problems = list(range(ddp_rank, num_problems, ddp_world_size))
+    if prompt_ids is None:
+        prompt_ids = {i: tokenizer.render_for_completion(task_object[i]) for i in problems}
+    if gen_batch_size > 1:
+        # similar lengths in a batch means little padding, longest first means an OOM shows up right away
+        problems.sort(key=lambda i: len(prompt_ids[i]), reverse=True)
 
     # Run the evaluation
     num_passed, total = 0, 0
-    for i in range(ddp_rank, num_problems, ddp_world_size):
-        conversation = task_object[i]
-
-        # Tokenize the prompt
-        encoded_prompt = tokenizer.render_for_completion(conversation)
-        # Get the completions
-        results, _ = engine.generate_batch(
-            encoded_prompt,
-            num_samples=num_samples,
-            max_tokens=max_new_tokens,
-            temperature=temperature,
-            top_k=top_k,
-        )
-        # Decode the completions as text
-        prefix_length = len(encoded_prompt)
-        completions = [tokenizer.decode(result_tokens[prefix_length:]) for result_tokens in results]
-        # Evaluate success criteria
-        outcomes = [task_object.evaluate(conversation, completion) for completion in completions]
-        passed = any(outcomes)
-
-        # Keep stats
-        total += 1
-        num_passed += int(passed)
-
-        # Logging (overwrite the same line in the console)
-        print(f"\r\033[KRank {ddp_rank} | {num_passed}/{total} ({100*num_passed/total:.2f}%)", end='', flush=True)
+    outcomes = {} # problem index -> futures of the outcomes of its samples
+    def collect(wait_all):
+        nonlocal num_passed, total
+        for i in [i for i, futures in outcomes.items() if wait_all or all(f.done() for f in futures)]:
+            passed = any(f.result() for f in outcomes.pop(i))
+            # Keep stats
+            total += 1
+            num_passed += int(passed)
+            # Logging (overwrite the same line in the console)
+            print(f"\r\033[KRank {ddp_rank} | {num_passed}/{total} ({100*num_passed/total:.2f}%)", end='', flush=True)
+    with ThreadPoolExecutor(max_workers=1) as scorer:
+        for b in range(0, len(problems), gen_batch_size):
+            batch = problems[b:b + gen_batch_size]
+            conversations = [task_object[i] for i in batch]
+            stream = engine.generate_completions(
+                [prompt_ids[i] for i in batch],
+                num_samples=num_samples,
+                max_tokens=max_new_tokens,
+                temperature=temperature,
+                top_k=top_k,
+            )
+            for p, _, completion_tokens, _ in stream:
+                # Decode the completion as text and evaluate its success criteria, in the background
+                future = scorer.submit(task_object.evaluate, conversations[p], tokenizer.decode(completion_tokens))
+                outcomes.setdefault(batch[p], []).append(future)
+            collect(wait_all=False)
+        collect(wait_all=True)
 
     # Finish the in-place progress line with a newline before final summary
     print()
@@ -85,8 +125,14 @@ def run_generative_eval(task_object, tokenizer, model, engine, num_samples, max_
 # Categorical evaluation loop
 # A lot easier because we don't have to sample. Therefore, we can actually go
 # batches at a time and just check the logits for correct answer choices.
+# The problems are grouped by prompt length (length_bucketed_batches), so that little of the
+# compute goes to padding: many short prompts share a batch, long ones get few rows.
 
-def run_categorical_eval(task_object, tokenizer, model, batch_size, max_problems=None):
+def run_categorical_eval(task_object, tokenizer, model, batch_size, max_problems=None, prompt_ids=None, max_batch_tokens=0):
+    """
+    max_batch_tokens: the (padded) tokens per forward pass. 0 = batch_size x the longest prompt,
+    i.e. never more than batch_size problems of index order would pad to.
+    """
 
     ddp, ddp_rank, ddp_local_rank, ddp_world_size = get_dist_info()
     device = model.get_device()
@@ -94,26 +140,31 @@ def run_categorical_eval(task_object, tokenizer, model, batch_size, max_problems
 
     # We'll process batches of independent problems at a time because there is no sampling needed
     num_problems = len(task_object) if max_problems is None else min(len(task_object), max_problems)
-    ceil_div = lambda x, y: -(-x // y)
-    num_batches = ceil_div(num_problems, batch_size)
+    problems = list(range(ddp_rank, num_problems, ddp_world_size)) # stride the problems to each rank
+    if prompt_ids is not None:
+        rank_prompt_ids = [prompt_ids[ii] for ii in problems]
+    else:
+        rank_prompt_ids = [tokenizer.render_for_completion(task_object[ii]) for ii in problems] # TODO: remake the way this works
+    lengths = [len(ids) for ids in rank_prompt_ids]
+    if max_batch_tokens <= 0:
+        max_batch_tokens = batch_size * max(lengths, default=1)
 
     # Run the evaluation
     letter_to_id_cache = {} # many letters will repeat often, let's save the tokenizer some work
-    num_passed, total = 0, 0
-    for i in range(ddp_rank, num_batches, ddp_world_size):
-        i0, i1 = i * batch_size, min((i + 1) * batch_size, num_problems)
+    outcomes = [None] * len(problems) # in the original order of the problems
+    for bucket in length_bucketed_batches(lengths, max_batch_tokens):
 
-        # Prepare the batch of problems. They might all be of different length, so we pad/collate them.
-        conversations = [task_object[ii] for ii in range(i0, i1)]
-        prompt_ids = [tokenizer.render_for_completion(conversation) for conversation in conversations] # TODO: remake the way this works
-        max_length = max(len(ids) for ids in prompt_ids)
-        answer_time_positions = [len(ids) - 1 for ids in prompt_ids] # where the last token is (and the predicted answer)
-        padded_prompt_ids = [ids + [bos] * (max_length - len(ids)) for ids in prompt_ids]
-        prompt_ids = torch.tensor(padded_prompt_ids, dtype=torch.long, device=device)
+        # Prepare the batch of problems. They are of similar length, but still might differ, so we pad/collate them.
+        conversations = [task_object[problems[j]] for j in bucket]
+        batch_prompt_ids = [rank_prompt_ids[j] for j in bucket]
+        max_length = max(len(ids) for ids in batch_prompt_ids)
+        answer_time_positions = [len(ids) - 1 for ids in batch_prompt_ids] # where the last token is (and the predicted answer)
+        padded_prompt_ids = [ids + [bos] * (max_length - len(ids)) for ids in batch_prompt_ids]
+        input_ids = torch.tensor(padded_prompt_ids, dtype=torch.long, device=device)
 
         # Get the logits for the whole batch of conversations in parallel (efficiency win here)
         with torch.no_grad():
-            logits = model(prompt_ids) # (B, T, V)
+            logits = model(input_ids) # (B, T, V)
 
         # Focus on the available answer on just the letters corresponding to choices
         # Note that this helps the evaluation a lot because it specifically narrows the focus to only the avilable letters
@@ -136,9 +187,8 @@ def run_categorical_eval(task_object, tokenizer, model, batch_size, max_problems
             argmax_letter_id = focus_logits.argmax(dim=-1).item()
             predicted_letter = letters[argmax_letter_id]
             # evaluate the outcome
-            outcome = task_object.evaluate(conversation, predicted_letter)
-            num_passed += int(outcome)
-            total += 1
+            outcomes[bucket[idx]] = int(task_object.evaluate(conversation, predicted_letter))
+    num_passed, total = sum(outcomes), len(outcomes)
 
     # Aggregate results across all ranks
     if ddp:
@@ -157,7 +207,7 @@ def run_categorical_eval(task_object, tokenizer, model, batch_size, max_problems
 
 def run_chat_eval(task_name, model, tokenizer, engine,
                    batch_size=1, num_samples=1, max_new_tokens=512, temperature=0.0, top_k=50,
-                   max_problems=None):
+                   max_problems=None, gen_batch_size=1, max_batch_tokens=0):
     # Create the evaluation object
     task_module = {
         'HumanEval': HumanEval,
@@ -168,11 +218,13 @@ def run_chat_eval(task_name, model, tokenizer, engine,
         'SpellingBee': partial(SpellingBee, size=256, split="test"),
     }[task_name]
     task_object = task_module()
+    num_problems = len(task_object) if max_problems is None else min(len(task_object), max_problems)
+    prompt_ids = get_prompt_ids(task_name, task_object, tokenizer, num_problems)
     # Run the evaluation
     if task_object.eval_type == 'generative':
-        acc = run_generative_eval(task_object, tokenizer, model, engine, num_samples, max_new_tokens, temperature, top_k, max_problems=max_problems)
+        acc = run_generative_eval(task_object, tokenizer, model, engine, num_samples, max_new_tokens, temperature, top_k, max_problems=max_problems, prompt_ids=prompt_ids, gen_batch_size=gen_batch_size)
     elif task_object.eval_type == 'categorical':
-        acc = run_categorical_eval(task_object, tokenizer, model, batch_size, max_problems=max_problems)
+        acc = run_categorical_eval(task_object, tokenizer, model, batch_size, max_problems=max_problems, prompt_ids=prompt_ids, max_batch_tokens=max_batch_tokens)
     else:
         raise ValueError(f"Unsupported task evaluation type: {task_object.eval_type}")
     return acc
@@ -190,9 +242,13 @@ if __name__ == "__main__":
     parser.add_argument('-n', '--num-samples', type=int, default=1)
     parser.add_argument('-k', '--top-k', type=int, default=50)
     parser.add_argument('-b', '--batch-size', type=int, default=8, help='Batch size for categorical evaluation')
+    parser.add_argument('--batch-tokens', type=int, default=0, help='Max (padded) tokens per forward pass of categorical evaluation (0 = batch size x longest prompt)')
+    parser.add_argument('--gen-batch-size', type=int, default=16, help='Number of problems decoded together in generative evaluation')
     parser.add_argument('-g', '--model-tag', type=str, default=None, help='Model tag to load')
     parser.add_argument('-s', '--step', type=int, default=None, help='Step to load')
     parser.add_argument('-x', '--max-problems', type=int, default=None, help='Max problems to evaluate')
+    parser.add_argument('--kv-quantize', type=str, default='none', choices=['none', 'int8', 'fp8'], help='KV cache storage for generative evaluation (8 bits = about twice the rows)')
+    parser.add_argument('--no-cache', action='store_true', help='Recompute every task even if its result is in the eval cache')
     parser.add_argument('--device-type', type=str, default='', choices=['cuda', 'cpu', 'mps'], help='Device type for evaluation: cuda|cpu|mps. empty => autodetect')
     args = parser.parse_args()
 
@@ -202,7 +258,8 @@ if __name__ == "__main__":
     autocast_ctx = torch.amp.autocast(device_type=device_type, dtype=ptdtype) if device_type == "cuda" else nullcontext()
 
     model, tokenizer, meta = load_model(args.source, device, phase="eval", model_tag=args.model_tag, step=args.step)
-    engine = Engine(model, tokenizer)
+    engine = Engine(model, tokenizer, kv_quantize=None if args.kv_quantize == 'none' else args.kv_quantize)
+    cache = EvalCache(checkpoint_fingerprint(args.source, args.model_tag, meta["step"]), enabled=not args.no_cache)
 
     # Get the tasks to evaluate on
     all_tasks = ['ARC-Easy', 'ARC-Challenge', 'MMLU', 'GSM8K', 'HumanEval', 'SpellingBee']
@@ -218,9 +275,12 @@ if __name__ == "__main__":
 
     # Run all the task evaluations sequentially
     results = {}
+    # everything that can change the result of a task, including the batching: padded batches match
+    # one problem at a time only up to numerics, which can flip a greedy completion or an argmax
+    eval_config = {k: vars(args)[k] for k in ['dtype', 'temperature', 'max_new_tokens', 'num_samples', 'top_k', 'max_problems', 'kv_quantize', 'batch_size', 'gen_batch_size', 'batch_tokens']}
     for task_name in task_names:
         with autocast_ctx:
-            acc = run_chat_eval(
+            acc = cache.get_or_compute(f"chat/{task_name}", eval_config, lambda: run_chat_eval(
                 task_name,
                 model, tokenizer, engine,
                 batch_size=args.batch_size,
@@ -229,9 +289,12 @@ if __name__ == "__main__":
                 temperature=args.temperature,
                 top_k=args.top_k,
                 max_problems=args.max_problems,
-            )
+                gen_batch_size=args.gen_batch_size,
+                max_batch_tokens=args.batch_tokens,
+            ))
             results[task_name] = acc
-            print0(f"{task_name} accuracy: {100 * acc:.2f}%")
+            cached = f"chat/{task_name}" in cache.hits
+            print0(f"{task_name} accuracy: {100 * acc:.2f}%{' (cached)' if cached else ''}")
 
     # Log to report
     from nanochat.report import get_report
@@ -18,13 +18,14 @@ torchrun --standalone --nproc_per_node=8 -m scripts.chat_rl -- --run=default
 
 import itertools
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 import torch
 import torch.distributed as dist
 import wandb
 
-from nanochat.checkpoint_manager import load_model, save_checkpoint
-from nanochat.common import DummyWandb, compute_cleanup, compute_init, get_base_dir, print0
+from nanochat.checkpoint_manager import AsyncCheckpointer, load_model
+from nanochat.common import DummyWandb, compute_cleanup, compute_init, get_base_dir, pack_sequences, print0
 from nanochat.engine import Engine
 from tasks.gsm8k import GSM8K
 
@@ -33,6 +34,9 @@ run = "dummy" # wandb run name
 source = "sft" # mid|sft
 dtype = "bfloat16"
 device_batch_size = 8 # no forward pass will go above this to not OOM
+rollout_batch_size = -1 # max rows per generation call (-1 = as many as fit in free GPU memory)
+kv_quantize = "" # KV cache storage of the rollouts: ""|int8|fp8 (8 bits fit about twice the rows of bf16)
+reward_workers = 4 # threads that decode and score finished rollouts while generation continues
 examples_per_step = 16 # in total and across all ranks (note: examples, not samples/completions!)
 num_samples = 16 # number of samples per example (/question)
 max_new_tokens = 256
@@ -65,7 +69,7 @@ wandb_run = DummyWandb() if use_dummy_wandb else wandb.init(project="nanochat-rl
 
 # Init model and tokenizer
 model, tokenizer, meta = load_model(source, device, phase="eval")
-engine = Engine(model, tokenizer) # for sampling rollouts
+engine = Engine(model, tokenizer, kv_quantize=kv_quantize or None) # for sampling rollouts
 
 # -----------------------------------------------------------------------------
 # Rollout / sampling generator loop that yields batches of examples for training
@@ -75,69 +79,84 @@ val_task = GSM8K(subset="main", split="test")
 num_steps = (len(train_task) // examples_per_step) * num_epochs
 print0(f"Calculated number of steps: {num_steps}")
 
+def rollout_rows_per_call(max_seq_len):
+    """Rows of generation per call: the KV cache dominates memory, so fit it into half of the free GPU memory."""
+    if rollout_batch_size > 0:
+        return rollout_batch_size
+    m = model.config
+    free_bytes, _ = torch.cuda.mem_get_info()
+    head_dim = m.n_embd // m.n_head
+    bytes_per_value = 1 + 4 / head_dim if kv_quantize else 2 # 8 bits + an fp32 scale per head_dim vector, or bf16
+    kv_bytes_per_row = int(2 * m.n_layer * m.n_kv_head * head_dim * max_seq_len * bytes_per_value) # keys and values
+    logits_bytes_per_row = 2 * m.vocab_size * 4 # logits and probs, fp32
+    return max(1, int(0.5 * free_bytes) // (kv_bytes_per_row + logits_bytes_per_row))
+
 @torch.no_grad()
 def get_batch():
+    """
+    Yields one batch of rollouts per example. The examples_per_rank examples of an optimization step
+    are generated together (on policy: all with the weights of this step), in as few batched calls as
+    fit in memory, and every rollout is decoded and rewarded in a thread pool as soon as it finishes,
+    so reward computation overlaps with the rest of the generation.
+    """
     assistant_end = tokenizer.encode_special("<|assistant_end|>") # ok to use this token, it's only for padding and isn't used in the loss.
     rank_indices = range(ddp_rank, len(train_task), ddp_world_size) # each rank is responsible for different examples in the training data
-    for example_idx in itertools.cycle(rank_indices):
-
-        # First get the full conversation of both user and assistant messages
-        conversation = train_task[example_idx]
-
-        # Tokenize the conversation, deleting the last Assistant message and priming the Assistant for a completion instead
+    example_iter = itertools.cycle(rank_indices)
+    reward_fn = lambda conversation, generated_tokens: train_task.reward(conversation, tokenizer.decode(generated_tokens))
+    reward_pool = ThreadPoolExecutor(max_workers=reward_workers, thread_name_prefix="reward")
+    while True:
+        # The examples of this step, and their full conversations of both user and assistant messages
+        example_indices = [next(example_iter) for _ in range(examples_per_rank)]
+        conversations = [train_task[idx] for idx in example_indices]
+
+        # Tokenize the conversations, deleting the last Assistant message and priming the Assistant for a completion instead
         # (i.e. keep the <|assistant_start|>, but delete everything after it)
-        tokens = tokenizer.render_for_completion(conversation)
-        prefix_length = len(tokens)
+        prompts = [tokenizer.render_for_completion(conversation) for conversation in conversations]
 
-        # Generate num_samples samples using batched generation, use loop to avoid OOMs
+        # Generate num_samples samples of each example with batched generation, whole examples per call
         model.eval() # ensure the model is in eval mode
-        generated_token_sequences = []
-        masks = []
-        num_sampling_steps = num_samples // device_batch_size # go sequentially to prevent OOMs
-        for sampling_step in range(num_sampling_steps):
-            seed = hash((step, example_idx, sampling_step)) & 0x7FFFFFFF # positive half of int32
+        max_seq_len = max(len(tokens) for tokens in prompts) + max_new_tokens
+        examples_per_call = max(1, rollout_rows_per_call(max_seq_len) // num_samples)
+        rollouts = [[None] * num_samples for _ in prompts] # (token sequence, mask, reward future) of each sample
+        for c0 in range(0, len(prompts), examples_per_call):
+            seed = hash((step, example_indices[c0])) & 0x7FFFFFFF # positive half of int32, must change for each call
             with autocast_ctx:
-                generated_token_sequences_batch, masks_batch = engine.generate_batch(
-                    tokens,
-                    num_samples=device_batch_size,
+                stream = engine.generate_completions(
+                    prompts[c0:c0 + examples_per_call],
+                    num_samples=num_samples,
                     max_tokens=max_new_tokens,
                     temperature=temperature,
                     top_k=top_k,
-                    seed=seed, # must make sure to change the seed for each sampling step
+                    seed=seed,
                 )
-            generated_token_sequences.extend(generated_token_sequences_batch)
-            masks.extend(masks_batch)
-
-        # Calculate the rewards for each sample
-        rewards = []
-        for sample_tokens in generated_token_sequences:
-            # Get just the generated tokens (after the prompt)
-            generated_tokens = sample_tokens[prefix_length:]
-            # Decode the generated response
-            generated_text = tokenizer.decode(generated_tokens)
-            # Calculate the reward
-            reward = train_task.reward(conversation, generated_text)
-            rewards.append(reward)
-
-        # Pad the sequences so that their lengths (in time) match
-        max_length = max(len(seq) for seq in generated_token_sequences)
-        padded_generated_token_sequences = [seq + [assistant_end] * (max_length - len(seq)) for seq in generated_token_sequences]
-        padded_masks = [mask + [0] * (max_length - len(mask)) for mask in masks]
-        # Stack up the sequences and masks into PyTorch tensors
-        ids = torch.tensor(padded_generated_token_sequences, dtype=torch.long, device=device)
-        mask_ids = torch.tensor(padded_masks, dtype=torch.long, device=device)
-        # Generate autoregressive inputs and targets to the Transformer
-        inputs = ids[:, :-1]
-        targets = ids[:, 1:].clone() # clone to avoid in-place modification:
-        targets[mask_ids[:, 1:] == 0] = -1 # <-- inplace modification right here. -1 is the ignore index
-        # NOTE also that the Engine returns mask=0 for BOTH the prompt tokens AND the tool use tokens.
-        # So we will (correctly) end up not training on the prompt tokens, or the tool use forced tokens.
-        rewards = torch.tensor(rewards, dtype=torch.float, device=device)
-        # Calculate the advantages by simply subtracting the mean (instead of z-score (x-mu)/sigma)
-        mu = rewards.mean()
-        advantages = rewards - mu
-        # yield inputs/targets as (B, T) of ids and rewards as (B,) of floats
-        yield generated_token_sequences, inputs, targets, rewards, advantages
+                for p, sample_idx, generated_tokens, generated_masks in stream:
+                    e = c0 + p
+                    # Calculate the reward in the background
+                    reward = reward_pool.submit(reward_fn, conversations[e], generated_tokens)
+                    rollouts[e][sample_idx] = (prompts[e] + generated_tokens, [0] * len(prompts[e]) + generated_masks, reward)
+
+        for e in range(len(prompts)):
+            generated_token_sequences, masks, rewards = map(list, zip(*rollouts[e]))
+            rewards = [reward.result() for reward in rewards]
+            # Pad the sequences so that their lengths (in time) match
+            max_length = max(len(seq) for seq in generated_token_sequences)
+            padded_generated_token_sequences = [seq + [assistant_end] * (max_length - len(seq)) for seq in generated_token_sequences]
+            padded_masks = [mask + [0] * (max_length - len(mask)) for mask in masks]
+            # Stack up the sequences and masks into PyTorch tensors
+            ids = torch.tensor(padded_generated_token_sequences, dtype=torch.long, device=device)
+            mask_ids = torch.tensor(padded_masks, dtype=torch.long, device=device)
+            # Generate autoregressive inputs and targets to the Transformer
+            inputs = ids[:, :-1]
+            targets = ids[:, 1:].clone() # clone to avoid in-place modification:
+            targets[mask_ids[:, 1:] == 0] = -1 # <-- inplace modification right here. -1 is the ignore index
+            # NOTE also that the Engine returns mask=0 for BOTH the prompt tokens AND the tool use tokens.
+            # So we will (correctly) end up not training on the prompt tokens, or the tool use forced tokens.
+            rewards = torch.tensor(rewards, dtype=torch.float, device=device)
+            # Calculate the advantages by simply subtracting the mean (instead of z-score (x-mu)/sigma)
+            mu = rewards.mean()
+            advantages = rewards - mu
+            # yield inputs/targets as (B, T) of ids and rewards as (B,) of floats
+            yield generated_token_sequences, inputs, targets, rewards, advantages
 
 # -----------------------------------------------------------------------------
 # Simple evaluation loop for GSM8K pass@k
@@ -212,6 +231,9 @@ assert examples_per_step % ddp_world_size == 0, "Desired examples per step must
 examples_per_rank = examples_per_step // ddp_world_size # per GPU
 print0(f"Calculated examples per rank: {examples_per_rank}")
 
+# Checkpoints are written in a background thread
+checkpointer = AsyncCheckpointer()
+
 # Kick off the training loop
 batch_iterator = get_batch()
 for step in range(num_steps):
@@ -244,31 +266,51 @@ for step in range(num_steps):
     for example_step in range(examples_per_rank):
         # Get one batch corresponding to one example in the training dataset
         sequences_all, inputs_all, targets_all, rewards_all, advantages_all = next(batch_iterator)
+        # Per token weights of the PG objective, exactly as if we went over the padded rollouts in passes
+        # of device_batch_size rows: normalized by the number of valid tokens of the pass, number of passes, and examples_per_rank
+        assert inputs_all.size(0) % device_batch_size == 0
+        num_passes = inputs_all.size(0) // device_batch_size
+        weights_all = torch.zeros_like(targets_all, dtype=torch.float)
+        for b0 in range(0, inputs_all.size(0), device_batch_size):
+            b1 = b0 + device_batch_size
+            num_valid = (targets_all[b0:b1] >= 0).sum().clamp(min=1)
+            weights_all[b0:b1] = advantages_all[b0:b1, None] / (num_valid * num_passes * examples_per_rank)
+        weights_all[targets_all < 0] = 0.0
+        # Instead of padding every rollout to the longest one, pack the rollouts into rows of that length.
+        # Packed rollouts do not see each other (doc_ids), so the objective is unchanged, with fewer wasted FLOPs
+        row_len = inputs_all.size(1)
+        lengths = [len(seq) - 1 for seq in sequences_all] # unpadded number of input/target positions
+        rows = pack_sequences(lengths, row_len)
+        inputs_packed = torch.zeros((len(rows), row_len), dtype=torch.long, device=device)
+        targets_packed = torch.full((len(rows), row_len), -1, dtype=torch.long, device=device)
+        weights_packed = torch.zeros((len(rows), row_len), dtype=torch.float, device=device)
+        doc_ids = torch.full((len(rows), row_len), -1, dtype=torch.long, device=device) # padding at the end is its own document
+        for r, row in enumerate(rows):
+            t = 0
+            for i in row:
+                inputs_packed[r, t:t+lengths[i]] = inputs_all[i, :lengths[i]]
+                targets_packed[r, t:t+lengths[i]] = targets_all[i, :lengths[i]]
+                weights_packed[r, t:t+lengths[i]] = weights_all[i, :lengths[i]]
+                doc_ids[r, t:t+lengths[i]] = i
+                t += lengths[i]
         # Evaluate the loss and gradients
         model.train() # ensure the model is in train mode
         # We need one more loop because we can never exceed the device_batch_size
-        assert inputs_all.size(0) % device_batch_size == 0
-        num_passes = inputs_all.size(0) // device_batch_size
-        for pass_idx in range(num_passes):
+        for pass_idx, b0 in enumerate(range(0, len(rows), device_batch_size)):
             # Pluck out the batch for this pass
-            b0, b1 = pass_idx * device_batch_size, (pass_idx + 1) * device_batch_size
-            inputs = inputs_all[b0:b1]
-            targets = targets_all[b0:b1]
-            rewards = rewards_all[b0:b1]
-            advantages = advantages_all[b0:b1]
+            b1 = b0 + device_batch_size
+            inputs = inputs_packed[b0:b1]
+            targets = targets_packed[b0:b1]
             # Calculate log probabilities. Note that the loss calculates NLL = -logp, so we negate
             with autocast_ctx:
-                logp = -model(inputs, targets, loss_reduction='none').view_as(inputs) # (B, T)
+                logp = -model(inputs, targets, loss_reduction='none', doc_ids=doc_ids[b0:b1]).view_as(inputs) # (B, T)
             # Calculate the PG objective. Note that ignore_index=-1 ensures that invalid tokens have loss 0.
-            pg_obj = (logp * advantages.unsqueeze(-1)).sum()
-            # normalize by the number of valid tokens, number of passes, and examples_per_rank
-            num_valid = (targets >= 0).sum().clamp(min=1)
-            pg_obj = pg_obj / (num_valid * num_passes * examples_per_rank)
+            pg_obj = (logp * weights_packed[b0:b1]).sum()
             # Note, there is no need to add PPO ratio+clip because we are on policy
             # Finally, formulate the loss that we want to minimize (instead of objective we wish to maximize)
             loss = -pg_obj
             loss.backward()
-            print0(f"Step {step}/{num_steps} | Example step {example_step} | Pass {pass_idx} | loss: {loss.item():.6f} | Average reward: {rewards.mean().item()}")
+            print0(f"Step {step}/{num_steps} | Example step {example_step} | Pass {pass_idx} | loss: {loss.item():.6f} | Packed rows: {len(rows)}/{inputs_all.size(0)}")
         # For logging
         rewards_list.append(rewards_all.mean().item())
         sequence_lengths.extend(len(seq) for seq in sequences_all)
@@ -297,7 +339,8 @@ for step in range(num_steps):
             group["lr"] = group["initial_lr"] * lrm
     for opt in optimizers: # then step the optimizers
         opt.step()
-    model.zero_grad(set_to_none=True)
+    for opt in optimizers: # (the distributed optimizers zero their gradient buckets in place)
+        opt.zero_grad(set_to_none=True)
     wandb_run.log({
         "step": step,
         "lrm": lrm,
@@ -310,7 +353,7 @@ for step in range(num_steps):
         model_tag = f"d{depth}" # base the model tag on the depth of the base model
         checkpoint_dir = os.path.join(base_dir, "chatrl_checkpoints", model_tag)
         model_config_kwargs = model.config.__dict__ # slightly naughty, abusing the simplicity of GPTConfig, TODO nicer
-        save_checkpoint(
+        checkpointer.save(
             checkpoint_dir,
             step,
             model.state_dict(),
@@ -319,7 +362,8 @@ for step in range(num_steps):
                 "model_config": model_config_kwargs,
             }
         )
-        print(f"✅ Saved model checkpoint to {checkpoint_dir}")
+        print(f"✅ Saving model checkpoint to {checkpoint_dir} (in the background)")
+checkpointer.wait() # make sure the last checkpoint is written
 
 # Log to report
 from nanochat.report import get_report
@@ -15,13 +15,24 @@ os.environ["PYTORCH_CUDA_ALLOC_CONF"] = "expandable_segments:True"
 
 from contextlib import nullcontext
 
+import numpy as np
 import torch
 import torch.distributed as dist
 import wandb
 
 from nanochat.checkpoint_manager import load_model, save_checkpoint
-from nanochat.common import DummyWandb, autodetect_device_type, compute_cleanup, compute_init, get_base_dir, print0
+from nanochat.common import (
+    DummyWandb,
+    autodetect_device_type,
+    compute_cleanup,
+    compute_init,
+    get_base_dir,
+    length_bucketed_batches,
+    print0,
+)
+from nanochat.conversation_cache import render_task
 from nanochat.engine import Engine
+from nanochat.step_profiler import StepProfiler
 from scripts.chat_eval import run_chat_eval
 from tasks.arc import ARC
 from tasks.common import TaskMixture
@@ -41,6 +52,8 @@ step = None # step to load the model from (base model or midtrained model)
 device_type = "" # cuda|cpu|mps (empty => autodetect)
 dtype = "bfloat16"
 device_batch_size = 4 # max to avoid OOM
+activation_checkpoint = "none" # none|block|mlp|attn_out: trade recompute for activation memory (bigger device_batch_size), see GPTConfig
+checkpoint_every = 1 # apply activation_checkpoint to every k-th block
 # optimization
 num_epochs = 1
 num_iterations = -1 # override number of iterations (-1 = disable, use num_epochs to derive it)
@@ -55,6 +68,10 @@ eval_every = 100
 eval_steps = 100
 eval_metrics_every = 200
 eval_metrics_max_problems = 1024
+# profiling
+profile = 0 # 1 = time the phases of every step (data, forward, backward, optimizers, comm wait), see nanochat/step_profiler.py
+profile_window = 50 # log the percentiles of the phases every this many steps
+profile_trace_steps = "" # e.g. "100-105": also write a torch.profiler trace of these steps
 # now allow CLI to override the settings via the configurator lol
 config_keys = [k for k,v in globals().items() if not k.startswith('_') and isinstance(v, (int, float, bool, str))]
 exec(open(os.path.join('nanochat', 'configurator.py')).read()) # overrides from command line or config file
@@ -74,6 +91,7 @@ wandb_run = DummyWandb() if use_dummy_wandb else wandb.init(project="nanochat-sf
 
 # Load the model and tokenizer
 model, tokenizer, meta = load_model(source, device, phase="train", model_tag=model_tag, step=step)
+model.set_activation_checkpointing(activation_checkpoint, checkpoint_every)
 orig_model = model # original, uncompiled model
 # model = torch.compile(model, dynamic=True) # doesn't work super well because of variable lengths of inputs
 engine = Engine(model, tokenizer) # will be used for inline model evaluation only
@@ -95,38 +113,54 @@ val_ds = SmolTalk(split="test") # general conversations, 24K rows (though we don
 # -----------------------------------------------------------------------------
 # DataLoader
 
-def sft_data_generator(dataset, batch_size):
-    pad_token_id = tokenizer.encode_special("<|assistant_end|>") # use <|assistant_end|> as the pad token is ok, these positions are masked in the loss
-    # prepares a list of tokenized conversations into a batch and yields
-    def collate_and_yield(batch):
-        nrows = len(batch)
-        ncols = max(len(ids) for ids, mask in batch) - 1 # seq of n creates inputs/targets of n-1
-        inputs = torch.full((nrows, ncols), pad_token_id, dtype=torch.long)
-        targets = torch.full((nrows, ncols), -1, dtype=torch.long) # -1 is ignore index
-        for i, (ids, mask) in enumerate(batch):
-            n = len(ids)
-            ids_tensor = torch.tensor(ids, dtype=torch.long)
-            inputs[i, :n-1] = ids_tensor[:-1]
-            # recall -1 is the ignore index, so mask out targets where mask is 0
-            row_targets = ids_tensor[1:]
-            # mask[1:] omits the mask for the BOS token, which is never a target atm so it's ok
-            mask_tensor = torch.tensor(mask[1:], dtype=torch.long)
-            row_targets[mask_tensor == 0] = -1 # mask out targets where mask is 0
-            targets[i, :n-1] = row_targets
-        inputs = inputs.to(device) # move to device
-        targets = targets.to(device)
-        return inputs, targets
-    # iterates over the dataset in epochs, tokenizes
+pad_token_id = tokenizer.encode_special("<|assistant_end|>") # use <|assistant_end|> as the pad token is ok, these positions are masked in the loss
+
+def sft_collate(batch):
+    """Prepares a list of tokenized conversations into a batch (inputs, targets) on device."""
+    nrows = len(batch)
+    ncols = max(len(ids) for ids, mask in batch) - 1 # seq of n creates inputs/targets of n-1
+    inputs = torch.full((nrows, ncols), pad_token_id, dtype=torch.long)
+    targets = torch.full((nrows, ncols), -1, dtype=torch.long) # -1 is ignore index
+    for i, (ids, mask) in enumerate(batch):
+        n = len(ids)
+        ids_tensor = torch.from_numpy(ids)
+        inputs[i, :n-1] = ids_tensor[:-1]
+        # recall -1 is the ignore index, so mask out targets where mask is 0
+        row_targets = ids_tensor[1:]
+        # mask[1:] omits the mask for the BOS token, which is never a target atm so it's ok
+        mask_tensor = torch.from_numpy(mask[1:])
+        row_targets[mask_tensor == 0] = -1 # mask out targets where mask is 0
+        targets[i, :n-1] = row_targets
+    inputs = inputs.to(device) # move to device
+    targets = targets.to(device)
+    return inputs, targets
+
+def sft_data_generator(rendered, batch_size):
+    # iterates over the (already tokenized, see nanochat/conversation_cache.py) dataset in epochs
     batch = []
     while True:
-        for i in range(ddp_rank, len(dataset), ddp_world_size):
-            doc = dataset[i]
-            ids, mask = tokenizer.render_conversation(doc)
-            batch.append((ids, mask))
+        for i in range(ddp_rank, len(rendered), ddp_world_size):
+            ids, mask = rendered[i]
+            batch.append((ids.astype(np.int64), mask.astype(np.int64)))
             if len(batch) == batch_size:
-                yield collate_and_yield(batch)
+                yield sft_collate(batch)
                 batch = []
 
+def sft_val_buckets(rendered, batch_size, num_batches):
+    """
+    The validation conversations of this rank (the first num_batches * batch_size of them), grouped by
+    length into batches of similar length (length_bucketed_batches), within the padded tokens of
+    batch_size rows of the longest one. Returns a list of batches, each a list of conversation indices.
+    """
+    indices = list(range(ddp_rank, len(rendered), ddp_world_size))[:num_batches * batch_size]
+    lengths = [int(rendered.offsets[i + 1] - rendered.offsets[i]) - 1 for i in indices] # inputs are n-1 long
+    max_batch_tokens = batch_size * max(lengths, default=1)
+    return [[indices[j] for j in bucket] for bucket in length_bucketed_batches(lengths, max_batch_tokens)]
+
+def sft_val_loader(rendered, buckets):
+    for bucket in buckets:
+        yield sft_collate([(ids.astype(np.int64), mask.astype(np.int64)) for ids, mask in map(rendered.__getitem__, bucket)])
+
 examples_per_step = device_batch_size * ddp_world_size
 print0(f"Target examples per step: {target_examples_per_step}")
 print0(f"Device batch size: {device_batch_size}")
@@ -139,8 +173,10 @@ if num_iterations == -1:
     # derive num_iterations from num_epochs and the size of the dataset
     assert num_epochs > 0, "num_epochs must be positive if num_iterations is -1"
     num_iterations = (len(train_ds) // target_examples_per_step) * num_epochs
-train_loader = sft_data_generator(train_ds, batch_size=device_batch_size)
-build_val_loader = lambda: sft_data_generator(val_ds, batch_size=device_batch_size)
+train_loader = sft_data_generator(render_task(train_ds, tokenizer, "sft_train"), batch_size=device_batch_size)
+val_rendered = render_task(val_ds, tokenizer, "sft_val")
+val_buckets = sft_val_buckets(val_rendered, batch_size=device_batch_size, num_batches=eval_steps)
+build_val_loader = lambda: sft_val_loader(val_rendered, val_buckets)
 
 # -----------------------------------------------------------------------------
 # Initialize the Optimizer
@@ -157,6 +193,10 @@ for opt in optimizers:
         group["lr"] = group["lr"] * init_lr_frac
         group["initial_lr"] = group["lr"] # save the initial learning so we can decay easily later
 
+# Opt-in per-phase timing of the training steps
+profiler = StepProfiler(device_type, enabled=bool(profile), window=profile_window, trace_steps=profile_trace_steps, trace_dir=os.path.join(get_base_dir(), "profile"))
+profiler.attach(optimizers)
+
 # -----------------------------------------------------------------------------
 # Training loop
 
@@ -174,17 +214,17 @@ for step in range(num_iterations):
     # evaluate the validation loss
     if last_step or step % eval_every == 0:
         model.eval()
-        val_iter = iter(build_val_loader())
-        losses = []
-        for _ in range(eval_steps):
-            val_inputs, val_targets = next(val_iter)
+        # the batches are of different sizes (length bucketed), so average over all the target tokens
+        loss_sum = torch.zeros((), dtype=torch.float32, device=device)
+        num_targets = torch.zeros((), dtype=torch.float32, device=device)
+        for val_inputs, val_targets in build_val_loader():
             with torch.no_grad(), autocast_ctx:
-                loss = model(val_inputs, val_targets)
-            losses.append(loss)
-        val_loss = torch.stack(losses).mean() # average over eval_steps
+                loss_sum += model(val_inputs, val_targets, loss_reduction='sum').float()
+            num_targets += (val_targets >= 0).sum()
         if ddp:
-            dist.all_reduce(val_loss, op=dist.ReduceOp.AVG) # average over ranks
-        val_loss = val_loss.item()
+            dist.all_reduce(loss_sum, op=dist.ReduceOp.SUM) # sum over ranks
+            dist.all_reduce(num_targets, op=dist.ReduceOp.SUM)
+        val_loss = (loss_sum / num_targets).item()
         print0(f"Step {step:05d} | Validation loss: {val_loss:.6f}")
         wandb_run.log({
             "step": step,
@@ -212,14 +252,20 @@ for step in range(num_iterations):
         break
 
     # evaluate the gradient
+    profiler.start_step(step)
     num_tokens = torch.tensor(0, device=device) # the number of "active" tokens of supervision seen
     for micro_step in range(grad_accum_steps):
-        train_inputs, train_targets = next(train_iter)
-        with autocast_ctx:
+        with profiler.phase("data"):
+            train_inputs, train_targets = next(train_iter)
+        with profiler.phase("forward"), autocast_ctx:
             loss = model(train_inputs, train_targets)
         train_loss = loss.detach() # for logging
         loss = loss / grad_accum_steps # each .backward() is a grad sum => normalize loss here
-        loss.backward() # accumulate the gradient
+        if ddp and micro_step == grad_accum_steps - 1:
+            for opt in optimizers:
+                opt.overlap_next_backward() # reduce the grads during the last backward (eager only, the model is not compiled here)
+        with profiler.phase("backward"):
+            loss.backward() # accumulate the gradient
         num_tokens += (train_targets >= 0).sum()
     if ddp:
         dist.all_reduce(num_tokens, op=dist.ReduceOp.SUM) # sum over ranks
@@ -231,9 +277,12 @@ for step in range(num_iterations):
             group["lr"] = group["initial_lr"] * lrm
 
     # step the optimizers
-    for opt in optimizers:
-        opt.step()
-    model.zero_grad(set_to_none=True)
+    for opt_name, opt in zip(["adamw", "muon"], optimizers):
+        with profiler.phase(f"optim_{opt_name}"):
+            opt.step()
+    for opt in optimizers: # (the distributed optimizers zero their gradient buckets in place)
+        opt.zero_grad(set_to_none=True)
+    profiler.end_step()
 
     # logging
     train_loss_item = train_loss.item()
@@ -245,6 +294,10 @@ for step in range(num_iterations):
         "train_loss": train_loss_item,
         "num_tokens": num_tokens_item,
     })
+    if profiler.window_ready():
+        profile_stats = profiler.summary()
+        print0(profiler.format(profile_stats))
+        wandb_run.log({"step": step, **profiler.wandb_data(profile_stats)})
     step += 1
 
 # Save the model at the end of the run
@@ -279,6 +332,7 @@ get_report().log(section="Chat SFT", data=[
         "Training loss": train_loss_item,
         "Validation loss": val_loss,
     },
+    profiler.report_data(), # per-phase breakdown of the steps (if profile=1)
 ])
 
 # Cleanup
@@ -20,6 +20,7 @@ Endpoints:
   POST /chat/completions - Chat API (streaming only)
   GET  /health     - Health check with worker pool status
   GET  /stats      - Worker pool statistics and GPU utilization
+  GET  /metrics    - Prometheus metrics (TTFT, inter-token latency, queue wait, ...)
 
 Abuse Prevention:
   - Maximum 500 messages per request
@@ -36,6 +37,7 @@ import json
 import logging
 import os
 import random
+import time
 from contextlib import asynccontextmanager, nullcontext
 from dataclasses import dataclass
 from typing import AsyncGenerator, List, Optional
@@ -43,12 +45,13 @@ from typing import AsyncGenerator, List, Optional
 import torch
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, HTMLResponse, StreamingResponse
+from fastapi.responses import FileResponse, HTMLResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
 
 from nanochat.checkpoint_manager import load_model
 from nanochat.common import autodetect_device_type, compute_init
-from nanochat.engine import Engine
+from nanochat.engine import Engine, get_calculator_pool
+from nanochat.metrics import ServingMetrics
 
 # Abuse prevention limits
 MAX_MESSAGES_PER_REQUEST = 500
@@ -73,6 +76,10 @@ parser.add_argument('-p', '--port', type=int, default=8000, help='Port to run th
 parser.add_argument('-d', '--dtype', type=str, default='bfloat16', choices=['float32', 'bfloat16'])
 parser.add_argument('--device-type', type=str, default='', choices=['cuda', 'cpu', 'mps'], help='Device type for evaluation: cuda|cpu|mps. empty => autodetect')
 parser.add_argument('--host', type=str, default='0.0.0.0', help='Host to bind the server to')
+parser.add_argument('--quantize', action='store_true', help='Serve the int8 weight-only quantized model (see scripts/quantize_export.py)')
+parser.add_argument('--rope-scaling', type=str, default='none', choices=['none', 'linear', 'ntk'], help='RoPE scaling, to chat beyond the training context')
+parser.add_argument('--rope-scaling-factor', type=float, default=1.0, help='RoPE scaling factor, e.g. 4 for 4X the training context')
+parser.add_argument('--kv-quantize', type=str, default='none', choices=['none', 'int8', 'fp8'], help='KV cache storage (8 bits = half the memory of bf16)')
 args = parser.parse_args()
 
 # Configure logging for conversation traffic
@@ -86,6 +93,7 @@ logger = logging.getLogger(__name__)
 device_type = autodetect_device_type() if args.device_type == "" else args.device_type
 ddp, ddp_rank, ddp_local_rank, ddp_world_size, device = compute_init(device_type)
 ptdtype = torch.float32 if args.dtype == 'float32' else torch.bfloat16
+metrics = ServingMetrics()
 
 @dataclass
 class Worker:
@@ -124,8 +132,9 @@ class WorkerPool:
                 device = torch.device(device_type) # e.g. cpu|mps
                 print(f"Loading model on {device_type}...")
 
-            model, tokenizer, _ = load_model(source, device, phase="eval", model_tag=model_tag, step=step)
-            engine = Engine(model, tokenizer)
+            model, tokenizer, _ = load_model(source, device, phase="eval", model_tag=model_tag, step=step, quantize=args.quantize)
+            model.set_rope_scaling(args.rope_scaling, args.rope_scaling_factor)
+            engine = Engine(model, tokenizer, kv_quantize=None if args.kv_quantize == 'none' else args.kv_quantize)
             autocast_ctx = torch.amp.autocast(device_type=device_type, dtype=ptdtype) if device_type == "cuda" else nullcontext()
 
             worker = Worker(
@@ -142,7 +151,10 @@ class WorkerPool:
 
     async def acquire_worker(self) -> Worker:
         """Get an available worker from the pool."""
-        return await self.available_workers.get()
+        t0 = time.perf_counter()
+        worker = await self.available_workers.get()
+        metrics.queue_wait.observe(time.perf_counter() - t0)
+        return worker
 
     async def release_worker(self, worker: Worker):
         """Return a worker to the pool."""
@@ -225,8 +237,12 @@ def validate_chat_request(request: ChatRequest):
 async def lifespan(app: FastAPI):
     """Load models on all GPUs on startup."""
     print("Loading nanochat models across GPUs...")
+    get_calculator_pool() # prewarm the calculator tool worker processes, before any generation threads exist
     app.state.worker_pool = WorkerPool(num_gpus=args.num_gpus)
     await app.state.worker_pool.initialize(args.source, model_tag=args.model_tag, step=args.step)
+    worker_pool = app.state.worker_pool
+    metrics.add_gauge("nanochat_workers", "Total number of workers.", lambda: len(worker_pool.workers))
+    metrics.add_gauge("nanochat_busy_workers", "Number of workers currently generating.", lambda: len(worker_pool.workers) - worker_pool.available_workers.qsize())
     print(f"Server ready at http://localhost:{args.port}")
     yield
 
@@ -279,6 +295,10 @@ async def generate_stream(
     accumulated_tokens = []
     # Track the last complete UTF-8 string (without replacement characters)
     last_clean_text = ""
+    # Timing for the metrics endpoint
+    metrics.prompt_tokens.observe(len(tokens))
+    t_start = time.perf_counter()
+    t_last = None
 
     with worker.autocast_ctx:
         for token_column, token_masks in worker.engine.generate(
@@ -290,6 +310,12 @@ async def generate_stream(
             seed=random.randint(0, 2**31 - 1)
         ):
             token = token_column[0]
+            t_now = time.perf_counter()
+            if t_last is None:
+                metrics.ttft.observe(t_now - t_start)
+            else:
+                metrics.inter_token.observe(t_now - t_last)
+            t_last = t_now
 
             # Stopping criteria
             if token == assistant_end or token == bos:
@@ -309,6 +335,11 @@ async def generate_stream(
                     yield f"data: {json.dumps({'token': new_text, 'gpu': worker.gpu_id}, ensure_ascii=False)}\n\n"
                     last_clean_text = current_text
 
+    num_completion_tokens = len(accumulated_tokens)
+    metrics.completion_tokens.observe(num_completion_tokens)
+    if t_last is not None and t_last > t_start:
+        metrics.tokens_per_second.observe(num_completion_tokens / (t_last - t_start))
+
     yield f"data: {json.dumps({'done': True})}\n\n"
 
 @app.post("/chat/completions")
@@ -317,6 +348,7 @@ async def chat_completions(request: ChatRequest):
 
     # Basic validation to prevent abuse
     validate_chat_request(request)
+    metrics.requests.inc()
 
     # Log incoming conversation to console
     logger.info("="*20)
@@ -409,6 +441,11 @@ async def stats():
         ]
     }
 
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Serving metrics in the Prometheus text exposition format."""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
 if __name__ == "__main__":
     import uvicorn
     print("Starting NanoChat Web Server")
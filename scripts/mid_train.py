@@ -10,19 +10,21 @@ torchrun --standalone --nproc_per_node=8 -m scripts.mid_train -- --device_batch_
 """
 
 import os
-from collections import deque
 
 os.environ["PYTORCH_CUDA_ALLOC_CONF"] = "expandable_segments:True"
 import time
 from contextlib import nullcontext
 
+import numpy as np
 import torch
 import torch.distributed as dist
 import wandb
 
-from nanochat.checkpoint_manager import load_model, save_checkpoint
+from nanochat.checkpoint_manager import AsyncCheckpointer, load_model
 from nanochat.common import DummyWandb, autodetect_device_type, compute_cleanup, compute_init, get_base_dir, print0
+from nanochat.conversation_cache import render_task
 from nanochat.loss_eval import evaluate_bpb
+from nanochat.step_profiler import StepProfiler
 from nanochat.tokenizer import get_token_bytes
 from tasks.common import TaskMixture
 from tasks.customjson import CustomJSON
@@ -40,6 +42,8 @@ dtype = "bfloat16"
 num_iterations = -1 # explicit number of steps of the optimization (-1 = disable)
 max_seq_len = 2048
 device_batch_size = 32
+activation_checkpoint = "none" # none|block|mlp|attn_out: trade recompute for activation memory (bigger device_batch_size), see GPTConfig
+checkpoint_every = 1 # apply activation_checkpoint to every k-th block
 unembedding_lr = 0.004
 embedding_lr = 0.2
 matrix_lr = 0.02
@@ -48,6 +52,10 @@ weight_decay = 0.0
 eval_every = 150 # -1 = disable
 eval_tokens = 20*524288
 total_batch_size = 524288
+# Profiling
+profile = 0 # 1 = time the phases of every step (data, forward, backward, optimizers, comm wait), see nanochat/step_profiler.py
+profile_window = 50 # log the percentiles of the phases every this many steps
+profile_trace_steps = "" # e.g. "100-105": also write a torch.profiler trace of these steps
 dry_run = 0 # dry_run=1 is for experiments: we will log to wandb but we won't write checkpoints or report
 config_keys = [k for k,v in globals().items() if not k.startswith('_') and isinstance(v, (int, float, bool, str))]
 exec(open(os.path.join('nanochat', 'configurator.py')).read()) # overrides from command line or config file
@@ -69,8 +77,9 @@ wandb_run = DummyWandb() if use_dummy_wandb else wandb.init(project="nanochat-mi
 # Load the model and tokenizer
 model, tokenizer, meta = load_model("base", device, phase="train", model_tag=model_tag, step=step)
 pretrain_batch_size = meta.get("device_batch_size", None)
-if pretrain_batch_size is not None and device_batch_size > pretrain_batch_size:
-    print0(f"FOOTGUN WARNING: base model training used device_batch_size {pretrain_batch_size}, did you pass in a good --device_batch_size to this script?")
+if pretrain_batch_size is not None and device_batch_size > pretrain_batch_size and activation_checkpoint == "none":
+    print0(f"FOOTGUN WARNING: base model training used device_batch_size {pretrain_batch_size}, did you pass in a good --device_batch_size (or --activation_checkpoint) to this script?")
+model.set_activation_checkpointing(activation_checkpoint, checkpoint_every)
 orig_model = model
 model = torch.compile(model, dynamic=False)
 depth = model.config.n_layer
@@ -87,6 +96,13 @@ token_bytes = get_token_bytes(device=device)
 # Initialize the Optimizer (Muon for Linear layers, AdamW for embedding and lm_head)
 optimizers = model.setup_optimizers(unembedding_lr=unembedding_lr, embedding_lr=embedding_lr, matrix_lr=matrix_lr, weight_decay=weight_decay)
 adamw_optimizer, muon_optimizer = optimizers
+
+# Checkpoints are written in a background thread
+checkpointer = AsyncCheckpointer()
+
+# Opt-in per-phase timing of the training steps
+profiler = StepProfiler(device_type, enabled=bool(profile), window=profile_window, trace_steps=profile_trace_steps, trace_dir=os.path.join(get_base_dir(), "profile"))
+profiler.attach(optimizers)
 # Override the initial learning rate as a fraction of the base learning rate
 for opt in optimizers:
     for group in opt.param_groups:
@@ -118,33 +134,35 @@ approx_progress = 0.0 # will go from 0 to 1 over the course of the epoch
 def mid_data_generator(split):
     global last_step, approx_progress
     assert split in {"train", "val"}, "split must be 'train' or 'val'"
-    dataset = train_dataset if split == "train" else val_dataset
-    dataset_size = len(dataset)
+    rendered = train_rendered if split == "train" else val_rendered # conversations already tokenized, see nanochat/conversation_cache.py
+    dataset_size = len(rendered)
     assert dataset_size > 0
     needed_tokens = device_batch_size * max_seq_len + 1 # to form one training batch of inputs,targets
-    token_buffer = deque()
+    token_buffer = np.zeros(0, dtype=np.int64) # leftover tokens from the previous batch
     # CUDA supports memory pinning for faster transfers between CPU and GPU:
     scratch = torch.empty(needed_tokens, dtype=torch.int64, pin_memory=(device_type == "cuda"))
     cursor = ddp_rank # increments by ddp_world_size each time, so each rank processes unique documents
     it = 0 # iteration counter
     while True:
         # Accumulate enough tokens for one iteration before yielding
-        while len(token_buffer) < needed_tokens:
-            conversation = dataset[cursor]
-            ids, _ = tokenizer.render_conversation(conversation)
-            token_buffer.extend(ids)
+        pieces, num_tokens = [token_buffer], len(token_buffer)
+        while num_tokens < needed_tokens:
+            ids, _ = rendered[cursor]
+            pieces.append(ids)
+            num_tokens += len(ids)
             cursor += ddp_world_size
             if cursor >= dataset_size:
                 cursor -= dataset_size # wrap around for another epoch
                 if split == "train":
                     last_step = True # toggle last_step to True, which will terminate the training loop
+        token_buffer = np.concatenate(pieces).astype(np.int64, copy=False)
         # Stopping condition to respect num_iterations, if given
         it += 1
         if num_iterations > 0 and it >= num_iterations:
             last_step = True # toggle last_step to True, which will terminate the training loop
         # Build up inputs/targets and yield
-        for i in range(needed_tokens):
-            scratch[i] = token_buffer.popleft()
+        scratch.copy_(torch.from_numpy(token_buffer[:needed_tokens]))
+        token_buffer = token_buffer[needed_tokens:]
         inputs_cpu = scratch[:-1].to(dtype=torch.int32)
         targets_cpu = scratch[1:]
         inputs = inputs_cpu.view(device_batch_size, max_seq_len).to(device=device, dtype=torch.int32, non_blocking=True)
@@ -156,6 +174,8 @@ def mid_data_generator(split):
                 approx_progress = cursor / dataset_size # approximate progress as a fraction of the dataset
         yield inputs, targets
 
+train_rendered = render_task(train_dataset, tokenizer, "mid_train")
+val_rendered = render_task(val_dataset, tokenizer, "mid_val")
 train_loader = mid_data_generator("train")
 build_val_loader = lambda: mid_data_generator("val")
 progress = 0 # will go from 0 to 1 over the course of the epoch
@@ -206,15 +226,15 @@ while True:
         })
         model.train()
 
-    # save checkpoint at the end of the run (only on master process)
-    if master_process and last_step and not dry_run:
+    # save checkpoint at the end of the run, all ranks: each writes its optimizer shard
+    if last_step and not dry_run:
         output_dirname = f"d{depth}" # e.g. d12
         checkpoint_dir = os.path.join(base_dir, "mid_checkpoints", output_dirname)
-        save_checkpoint(
+        checkpointer.save(
             checkpoint_dir,
             step,
             orig_model.state_dict(),
-            [opt.state_dict() for opt in optimizers], # TODO: make sure saving across ranks is done correctly
+            [opt.state_dict() for opt in optimizers], # sharded by rank for DistAdamW/DistMuon
             {
                 "step": step,
                 "val_bpb": val_bpb, # loss at last step
@@ -238,13 +258,16 @@ while True:
     # evaluate the gradient
     synchronize()
     t0 = time.time()
+    profiler.start_step(step)
     for micro_step in range(grad_accum_steps):
-        with autocast_ctx:
+        with profiler.phase("forward"), autocast_ctx:
             loss = model(x, y)
         train_loss = loss.detach() # for logging
         loss = loss / grad_accum_steps # each .backward() is a grad sum => normalize loss here
-        loss.backward()
-        x, y = next(train_loader) # prefetch the next batch while the GPU is busy with forward/backward
+        with profiler.phase("backward"):
+            loss.backward()
+        with profiler.phase("data"):
+            x, y = next(train_loader) # prefetch the next batch while the GPU is busy with forward/backward
         progress = max(progress, approx_progress) # only increase progress monotonically
     # step the optimizers
     lrm = get_lr_multiplier(progress)
@@ -254,9 +277,12 @@ while True:
     muon_momentum = get_muon_momentum(step)
     for group in muon_optimizer.param_groups:
         group["momentum"] = muon_momentum
-    for opt in optimizers:
-        opt.step()
-    model.zero_grad(set_to_none=True)
+    for opt_name, opt in zip(["adamw", "muon"], optimizers):
+        with profiler.phase(f"optim_{opt_name}"):
+            opt.step()
+    for opt in optimizers: # (the distributed optimizers zero their gradient buckets in place)
+        opt.zero_grad(set_to_none=True)
+    profiler.end_step()
     synchronize()
     t1 = time.time()
     dt = t1 - t0
@@ -287,6 +313,12 @@ while True:
             "train/tok_per_sec": tok_per_sec,
             "train/mfu": mfu,
         })
+    if profiler.window_ready():
+        profile_stats = profiler.summary()
+        print0(profiler.format(profile_stats))
+        wandb_run.log({"step": step, **profiler.wandb_data(profile_stats)})
+
+checkpointer.wait() # make sure the checkpoint is written
 
 # print a few more stats
 print0(f"Peak memory usage: {get_max_memory() / 1024 / 1024:.2f}MiB")
@@ -301,10 +333,14 @@ if not dry_run:
         { # stats about the training setup
             "Number of iterations": step,
             "DDP world size": ddp_world_size,
+            "Activation checkpointing": f"{activation_checkpoint} (every {checkpoint_every})",
         },
         { # stats about training outcomes
             "Minimum validation bpb": min_val_bpb,
-        }
+            "Throughput (tok/sec)": f"{tok_per_sec:,}",
+            "Peak memory usage": f"{get_max_memory() / 1024 / 1024:.2f}MiB",
+        },
+        profiler.report_data(), # per-phase breakdown of the steps (if profile=1)
     ])
 
 # cleanup
@@ -0,0 +1,98 @@
+"""
+Export an int8 weight-only quantized copy of a checkpoint (see nanochat/quantize.py),
+and check how much accuracy it costs against the float model: bpb on a slice of the
+val split, and CORE on a few examples per task.
+
+The int8 weights are written next to the float checkpoint as int8_<step>.pt, and get
+picked up by load_model(..., quantize=True), e.g. chat_web/chat_cli with --quantize.
+
+Example run as:
+python -m scripts.quantize_export --source=sft --device_type=cpu
+"""
+import copy
+import os
+from contextlib import nullcontext
+
+import torch
+
+from nanochat.checkpoint_manager import (
+    find_largest_model,
+    find_last_step,
+    get_checkpoints_dir,
+    load_model_from_dir,
+    save_quantized_checkpoint,
+)
+from nanochat.common import autodetect_device_type, compute_cleanup, compute_init, print0
+from nanochat.dataloader import tokenizing_distributed_data_loader
+from nanochat.loss_eval import evaluate_bpb
+from nanochat.quantize import model_size_bytes, quantize_model
+from nanochat.tokenizer import get_token_bytes
+from scripts.base_eval import evaluate_model
+
+# Configuration
+source = "sft" # base|mid|sft|rl
+model_tag = None # optional model tag, default: the largest model
+model_step = None # optional model step, default: the last step
+device_batch_size = 8
+eval_tokens = 8*2048*8 # number of val tokens for the bpb comparison (0 = skip)
+core_max_per_task = 50 # examples per CORE task for the comparison (0 = skip)
+device_type = "" # cuda|cpu|mps (empty => autodetect)
+exec(open(os.path.join('nanochat', 'configurator.py')).read()) # overrides from command line or config file
+
+# Load the float model
+device_type = autodetect_device_type() if device_type == "" else device_type
+ddp, ddp_rank, ddp_local_rank, ddp_world_size, device = compute_init(device_type)
+autocast_ctx = torch.amp.autocast(device_type=device_type, dtype=torch.bfloat16) if device_type == "cuda" else nullcontext()
+checkpoints_dir = get_checkpoints_dir(source)
+model_tag = find_largest_model(checkpoints_dir) if model_tag is None else model_tag
+checkpoint_dir = os.path.join(checkpoints_dir, model_tag)
+model_step = find_last_step(checkpoint_dir) if model_step is None else model_step
+model, tokenizer, meta = load_model_from_dir(checkpoints_dir, device, phase="eval", model_tag=model_tag, step=model_step)
+
+# Quantize and save
+qmodel = quantize_model(copy.deepcopy(model))
+if ddp_rank == 0:
+    save_quantized_checkpoint(checkpoint_dir, model_step, qmodel)
+float_size, int8_size = model_size_bytes(model), model_size_bytes(qmodel)
+print0(f"Model size: float {float_size / 1e6:.1f}MB -> int8 {int8_size / 1e6:.1f}MB ({float_size / int8_size:.2f}X smaller)")
+if device_type != "cuda":
+    # without autocast the (bf16 when trained on GPU) embedding output would meet fp32 Linear weights.
+    # The int8 layers cast their scales to the activation dtype, so only the float reference needs this.
+    model.transformer.wte.to(dtype=torch.float32)
+
+# Accuracy check: the same evaluation for both models
+sequence_len = meta["model_config"]["sequence_len"]
+results = {}
+for name, m in [("float", model), ("int8", qmodel)]:
+    results[name] = {}
+    if eval_tokens > 0:
+        tokens_per_step = device_batch_size * sequence_len * ddp_world_size
+        steps = max(1, eval_tokens // tokens_per_step)
+        loader = tokenizing_distributed_data_loader(device_batch_size, sequence_len, "val", device=device)
+        with autocast_ctx:
+            results[name]["val bpb"] = evaluate_bpb(m, loader, steps, get_token_bytes(device=device))
+    if core_max_per_task > 0:
+        with autocast_ctx:
+            results[name]["CORE"] = evaluate_model(m, tokenizer, device, max_per_task=core_max_per_task)["core_metric"]
+    for metric, value in results[name].items():
+        print0(f"{name} {metric}: {value:.4f}")
+for metric in results["float"]:
+    print0(f"{metric} delta (int8 - float): {results['int8'][metric] - results['float'][metric]:+.4f}")
+
+# Log to report
+from nanochat.report import get_report
+
+get_report().log(section="Int8 quantization", data=[
+    {
+        "source": source,
+        "model_tag": model_tag,
+        "step": model_step,
+        "float size (MB)": float_size / 1e6,
+        "int8 size (MB)": int8_size / 1e6,
+    },
+    {f"float {metric}": value for metric, value in results["float"].items()},
+    {f"int8 {metric}": value for metric, value in results["int8"].items()},
+])
+
+# Cleanup
+compute_cleanup()
@@ -0,0 +1,308 @@
+"""
+Load generation and latency benchmark for the Engine and for chat_web.
+
+Two targets:
+- engine: drive nanochat.engine.Engine in-process, from a pool of worker threads
+  (mirrors the chat_web worker pool). The model is either loaded from a checkpoint
+  or is a tiny randomly initialized GPT that needs nothing on disk (good for CPU).
+- http: drive a running chat_web server over HTTP and parse its SSE stream.
+
+Requests arrive either all at once (closed loop, --rate 0) or as a Poisson process
+with the given rate. Prompt and response lengths are drawn from distributions given
+as "fixed:N", "uniform:LO:HI" or "lognormal:MEDIAN:SIGMA". The summary (throughput,
+TTFT, inter-token latency, end-to-end latency with p50/p95/p99) is printed as JSON.
+
+Examples:
+
+- tiny random model on CPU, no checkpoint needed
+python -m scripts.serve_bench --target engine --device-type cpu --depth 4 --num-requests 32 --concurrency 4
+
+- a trained model
+python -m scripts.serve_bench --target engine --source sft --num-requests 64 --rate 4
+
+- a running chat_web server
+python -m scripts.serve_bench --target http --url http://localhost:8000 --num-requests 64 --concurrency 8
+"""
+
+import argparse
+import json
+import math
+import random
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+
+parser = argparse.ArgumentParser(description='NanoChat serving benchmark')
+parser.add_argument('--target', type=str, default='engine', choices=['engine', 'http'], help='What to benchmark')
+parser.add_argument('--num-requests', type=int, default=32, help='Number of measured requests')
+parser.add_argument('--warmup', type=int, default=2, help='Number of unmeasured warmup requests')
+parser.add_argument('--concurrency', type=int, default=1, help='Max number of requests in flight')
+parser.add_argument('--rate', type=float, default=0.0, help='Poisson arrival rate in requests/sec (0 = all at once)')
+parser.add_argument('--prompt-len', type=str, default='uniform:16:256', help='Prompt length distribution (tokens)')
+parser.add_argument('--response-len', type=str, default='fixed:128', help='Response length distribution (max new tokens)')
+parser.add_argument('--temperature', type=float, default=1.0, help='Sampling temperature')
+parser.add_argument('--top-k', type=int, default=50, help='Top-k sampling parameter')
+parser.add_argument('--seed', type=int, default=1337, help='Seed for the request generator')
+parser.add_argument('--output', type=str, default='', help='Optionally also write the JSON summary to this file')
+# engine target
+parser.add_argument('-i', '--source', type=str, default='', help='Checkpoint source base|mid|sft|rl (empty = tiny random model)')
+parser.add_argument('-g', '--model-tag', type=str, default=None, help='Model tag to load')
+parser.add_argument('-s', '--step', type=int, default=None, help='Step to load')
+parser.add_argument('--depth', type=int, default=4, help='Depth of the random model')
+parser.add_argument('--vocab-size', type=int, default=65536, help='Vocab size of the random model')
+parser.add_argument('--sequence-len', type=int, default=2048, help='Sequence length of the random model')
+parser.add_argument('--sync-every', type=int, default=1, help='Engine decode steps per host sync')
+parser.add_argument('--kv-quantize', type=str, default='none', choices=['none', 'int8', 'fp8'], help='KV cache storage of the engine')
+parser.add_argument('--device-type', type=str, default='', choices=['cuda', 'cpu', 'mps'], help='Device type: cuda|cpu|mps. empty => autodetect')
+parser.add_argument('-d', '--dtype', type=str, default='bfloat16', choices=['float32', 'bfloat16'])
+# http target
+parser.add_argument('--url', type=str, default='http://localhost:8000', help='Base URL of a running chat_web server')
+args = parser.parse_args()
+
+# -----------------------------------------------------------------------------
+# Request generation
+
+def parse_length_dist(spec):
+    """Parse a length distribution spec into a function rng -> int (always >= 1)."""
+    kind, *params = spec.split(":")
+    params = [float(p) for p in params]
+    if kind == "fixed":
+        (n,) = params
+        return lambda rng: max(1, int(n))
+    if kind == "uniform":
+        lo, hi = params
+        return lambda rng: max(1, rng.randint(int(lo), int(hi)))
+    if kind == "lognormal":
+        median, sigma = params
+        return lambda rng: max(1, int(round(rng.lognormvariate(math.log(median), sigma))))
+    raise ValueError(f"Unknown length distribution: {spec}")
+
+def build_requests(num_requests, rng):
+    """Returns a list of dicts with arrival time offset, prompt length and max new tokens."""
+    prompt_len = parse_length_dist(args.prompt_len)
+    response_len = parse_length_dist(args.response_len)
+    requests = []
+    t = 0.0
+    for i in range(num_requests):
+        if args.rate > 0:
+            t += rng.expovariate(args.rate)
+        requests.append({
+            "arrival": t,
+            "prompt_len": prompt_len(rng),
+            "max_tokens": response_len(rng),
+            "seed": rng.randint(0, 2**31 - 1),
+        })
+    return requests
+
+# -----------------------------------------------------------------------------
+# Engine target
+
+class RandomTokenizer:
+    """Stand-in tokenizer for the random model: special tokens live at the top of the vocab."""
+
+    def __init__(self, vocab_size):
+        from nanochat.tokenizer import SPECIAL_TOKENS
+        self.vocab_size = vocab_size
+        offset = vocab_size - len(SPECIAL_TOKENS)
+        self.special_tokens = {name: offset + i for i, name in enumerate(SPECIAL_TOKENS)}
+
+    def get_vocab_size(self):
+        return self.vocab_size
+
+    def get_special_tokens(self):
+        return set(self.special_tokens)
+
+    def encode_special(self, text):
+        return self.special_tokens[text]
+
+    def get_bos_token_id(self):
+        return self.special_tokens["<|bos|>"]
+
+    def encode(self, text, *args, **kwargs):
+        return list(text.encode("utf-8"))
+
+    def decode(self, ids):
+        return bytes(i for i in ids if i < 256).decode("utf-8", errors="replace")
+
+def build_engine():
+    """Returns (engine, autocast_ctx_factory, num_ordinary_tokens)."""
+    import torch
+
+    from nanochat.common import autodetect_device_type, compute_init
+    from nanochat.engine import Engine
+    from nanochat.gpt import GPT, GPTConfig
+
+    device_type = autodetect_device_type() if args.device_type == "" else args.device_type
+    ddp, ddp_rank, ddp_local_rank, ddp_world_size, device = compute_init(device_type)
+    ptdtype = torch.float32 if args.dtype == 'float32' else torch.bfloat16
+    make_autocast = lambda: torch.amp.autocast(device_type=device_type, dtype=ptdtype) if device_type == "cuda" else nullcontext()
+    if args.source:
+        from nanochat.checkpoint_manager import load_model
+        model, tokenizer, _ = load_model(args.source, device, phase="eval", model_tag=args.model_tag, step=args.step)
+    else:
+        tokenizer = RandomTokenizer(args.vocab_size)
+        model_dim = args.depth * 64
+        num_heads = max(1, (model_dim + 127) // 128)
+        config = GPTConfig(sequence_len=args.sequence_len, vocab_size=args.vocab_size, n_layer=args.depth,
+                           n_head=num_heads, n_kv_head=num_heads, n_embd=model_dim)
+        with torch.device("meta"):
+            model = GPT(config)
+        model.to_empty(device=device)
+        model.init_weights()
+        model.eval()
+    # prompts are random ordinary tokens, the special tokens sit at the top of the vocab in both tokenizers
+    num_ordinary_tokens = tokenizer.get_vocab_size() - len(tokenizer.get_special_tokens())
+    kv_quantize = None if args.kv_quantize == 'none' else args.kv_quantize
+    return Engine(model, tokenizer, kv_quantize=kv_quantize), make_autocast, num_ordinary_tokens
+
+def make_engine_runner():
+    engine, make_autocast, num_ordinary_tokens = build_engine()
+    assistant_end = engine.tokenizer.encode_special("<|assistant_end|>")
+    bos = engine.tokenizer.get_bos_token_id()
+
+    def run(request):
+        rng = random.Random(request["seed"])
+        tokens = [bos] + [rng.randrange(num_ordinary_tokens) for _ in range(request["prompt_len"] - 1)]
+        token_times = []
+        t_start = time.perf_counter()
+        with make_autocast(): # autocast state is thread-local, so enter it in the worker thread
+            for token_column, token_masks in engine.generate(
+                tokens,
+                num_samples=1,
+                max_tokens=request["max_tokens"],
+                temperature=args.temperature,
+                top_k=args.top_k,
+                seed=request["seed"],
+                sync_every=args.sync_every,
+            ):
+                token_times.append(time.perf_counter())
+                if token_column[0] == assistant_end or token_column[0] == bos:
+                    break
+        return t_start, token_times
+    return run
+
+# -----------------------------------------------------------------------------
+# HTTP target
+
+WORDS = ("the of and to in is was that for on with as by at from his her an were are which this be or has had "
+         "not but what all when can there been one who they more would will their time if about so no out up").split()
+
+def make_http_runner():
+    url = args.url.rstrip("/") + "/chat/completions"
+
+    def run(request):
+        rng = random.Random(request["seed"])
+        # roughly one token per common word
+        content = " ".join(rng.choice(WORDS) for _ in range(request["prompt_len"]))
+        body = json.dumps({
+            "messages": [{"role": "user", "content": content}],
+            "temperature": args.temperature,
+            "top_k": args.top_k,
+            "max_tokens": request["max_tokens"],
+        }).encode("utf-8")
+        http_request = urllib.request.Request(url, data=body, headers={"Content-Type": "application/json"})
+        token_times = []
+        t_start = time.perf_counter()
+        with urllib.request.urlopen(http_request) as response:
+            for line in response:
+                line = line.decode("utf-8").strip()
+                if not line.startswith("data: "):
+                    continue
+                chunk = json.loads(line[len("data: "):])
+                if chunk.get("done"):
+                    break
+                if "token" in chunk:
+                    # note: chat_web may merge a few tokens into one chunk for multi-byte characters
+                    token_times.append(time.perf_counter())
+        return t_start, token_times
+    return run
+
+# -----------------------------------------------------------------------------
+# Driver and statistics
+
+def percentile(values, q):
+    """Linearly interpolated percentile, q in [0, 100]."""
+    if not values:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * q / 100
+    lo, hi = math.floor(k), math.ceil(k)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+def summarize(values):
+    if not values:
+        return None
+    return {
+        "mean": sum(values) / len(values),
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": max(values),
+    }
+
+def run_benchmark(run, requests):
+    """Replay the requests against run() with the configured arrival process and concurrency."""
+    results = [None] * len(requests)
+    lock = threading.Lock()
+
+    def job(i, arrival_abs):
+        t_start, token_times = run(requests[i])
+        t_end = time.perf_counter()
+        with lock:
+            results[i] = {"arrival": arrival_abs, "start": t_start, "end": t_end, "token_times": token_times}
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        t0 = time.perf_counter()
+        futures = []
+        for i, request in enumerate(requests):
+            arrival_abs = t0 + request["arrival"]
+            delay = arrival_abs - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            futures.append(pool.submit(job, i, arrival_abs))
+        for future in futures:
+            future.result() # re-raise any exception from the workers
+        t1 = time.perf_counter()
+    return results, t1 - t0
+
+def main():
+    rng = random.Random(args.seed)
+    run = make_engine_runner() if args.target == "engine" else make_http_runner()
+    # warmup (e.g. CUDA context, allocator, kernel selection), not measured
+    for request in build_requests(args.warmup, rng):
+        run(request)
+    requests = build_requests(args.num_requests, rng)
+    results, duration = run_benchmark(run, requests)
+
+    ttft, itl, e2e, queue_wait = [], [], [], []
+    num_tokens = 0
+    for r in results:
+        times = r["token_times"]
+        queue_wait.append(r["start"] - r["arrival"])
+        e2e.append(r["end"] - r["arrival"])
+        num_tokens += len(times)
+        if times:
+            ttft.append(times[0] - r["start"])
+            itl.extend(t1 - t0 for t0, t1 in zip(times, times[1:]))
+    summary = {
+        "config": vars(args),
+        "num_requests": len(results),
+        "duration_s": duration,
+        "requests_per_s": len(results) / duration,
+        "tokens_per_s": num_tokens / duration,
+        "num_generated_tokens": num_tokens,
+        "ttft_s": summarize(ttft),
+        "inter_token_latency_s": summarize(itl),
+        "queue_wait_s": summarize(queue_wait),
+        "e2e_latency_s": summarize(e2e),
+    }
+    out = json.dumps(summary, indent=2)
+    print(out)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(out + "\n")
+
+if __name__ == "__main__":
+    main()
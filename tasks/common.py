@@ -5,7 +5,7 @@ metadata and often also evaluation criteria.
 Example tasks: MMLU, ARC-Easy, ARC-Challenge, GSM8K, HumanEval, SmolTalk.
 """
 
-import random
+import numpy as np
 
 
 class Task:
@@ -64,15 +64,12 @@ class TaskMixture(Task):
         self.tasks = tasks
         self.lengths = [len(task) for task in self.tasks]
         self.num_conversations = sum(self.lengths)
-        # Build list of all (task_idx, local_idx) pairs
-        self.index_map = []
-        for task_idx, task_length in enumerate(self.lengths):
-            for local_idx in range(task_length):
-                self.index_map.append((task_idx, local_idx))
-        # Deterministically shuffle to mix tasks throughout training
-        rng = random.Random(42)
-        rng.shuffle(self.index_map)
-        # Note: this is not the most elegant or best solution, but it's ok for now
+        # Conversations are numbered by concatenating the tasks, offsets[i] is where task i starts
+        self.offsets = np.cumsum([0] + self.lengths, dtype=np.int64)
+        # Deterministically shuffle to mix tasks throughout training: a seeded permutation of the global
+        # numbers, 4 bytes per conversation (int32) and built in milliseconds, identically on every rank
+        dtype = np.int32 if self.num_conversations < 2**31 else np.int64
+        self.permutation = np.random.default_rng(42).permutation(self.num_conversations).astype(dtype)
 
     def num_examples(self):
         return self.num_conversations
@@ -83,7 +80,9 @@ class TaskMixture(Task):
         This ensures tasks are mixed throughout training, regardless of dataset size.
         """
         assert 0 <= index < self.num_conversations, f"Index {index} out of range for mixture with {self.num_conversations} conversations"
-        task_idx, local_idx = self.index_map[index]
+        global_idx = int(self.permutation[index])
+        task_idx = int(np.searchsorted(self.offsets, global_idx, side="right")) - 1
+        local_idx = global_idx - int(self.offsets[task_idx])
         return self.tasks[task_idx][local_idx]
 
 
@@ -98,16 +97,15 @@ class TaskSequence(Task):
         self.tasks = tasks
         self.lengths = [len(task) for task in self.tasks]
         self.num_conversations = sum(self.lengths)
+        self.offsets = np.cumsum([0] + self.lengths, dtype=np.int64) # offsets[i] is where task i starts
 
     def num_examples(self):
         return self.num_conversations
 
     def get_example(self, index):
         assert 0 <= index < self.num_conversations, f"Index {index} out of range for sequence with {self.num_conversations} conversations"
-        for task_idx, task_length in enumerate(self.lengths):
-            if index < task_length:
-                return self.tasks[task_idx][index]
-            index -= task_length
+        task_idx = int(np.searchsorted(self.offsets, index, side="right")) - 1
+        return self.tasks[task_idx][index - int(self.offsets[task_idx])]
 
 
 def render_mc(question, letters, choices):
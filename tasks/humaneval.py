@@ -8,7 +8,7 @@ import re
 
 from datasets import load_dataset
 
-from nanochat.execution import execute_code
+from nanochat.execution import get_sandbox_pool
 from tasks.common import Task
 
 
@@ -95,6 +95,6 @@ class HumanEval(Task):
             + "\n"
             + f"check({conversation['entry_point']})"
         )
-        result = execute_code(program)
+        result = get_sandbox_pool().execute(program)
         success = result.success
         return success
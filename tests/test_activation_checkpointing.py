@@ -0,0 +1,40 @@
+"""
+Tests for the activation checkpointing policies of GPT (GPTConfig.activation_checkpoint)
+
+python -m pytest tests/test_activation_checkpointing.py -v
+"""
+
+import pytest
+import torch
+
+from nanochat.gpt import GPT, GPTConfig
+
+
+def loss_and_grads(policy, every):
+    torch.manual_seed(0)
+    config = GPTConfig(sequence_len=32, vocab_size=100, n_layer=3, n_head=2, n_kv_head=1, n_embd=32,
+                       activation_checkpoint=policy, checkpoint_every=every)
+    model = GPT(config)
+    model.init_weights()
+    with torch.no_grad():
+        for p in model.parameters():
+            p.normal_(0, 0.1)
+    idx = torch.randint(0, 100, (2, 16))
+    targets = torch.randint(0, 100, (2, 16))
+    loss = model(idx, targets)
+    loss.backward()
+    return loss.detach(), [p.grad for p in model.parameters()]
+
+
+@pytest.mark.parametrize("policy,every", [("block", 1), ("block", 2), ("mlp", 1), ("attn_out", 1)])
+def test_policy_matches_no_checkpointing(policy, every):
+    loss, grads = loss_and_grads(policy, every)
+    expected_loss, expected_grads = loss_and_grads("none", 1)
+    assert torch.allclose(loss, expected_loss)
+    for g, e in zip(grads, expected_grads):
+        assert torch.allclose(g, e, atol=1e-6)
+
+
+def test_unknown_policy():
+    with pytest.raises(AssertionError):
+        GPT(GPTConfig(n_layer=1, n_embd=32, n_head=2, n_kv_head=2, vocab_size=10, activation_checkpoint="everything"))
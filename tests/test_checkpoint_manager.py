@@ -0,0 +1,156 @@
+"""
+Tests for the checkpoint files (flat model files, manifests, async saves) of nanochat/checkpoint_manager.py
+
+python -m pytest tests/test_checkpoint_manager.py -v
+"""
+
+import json
+import os
+import struct
+
+import pytest
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from nanochat.checkpoint_manager import (
+    AsyncCheckpointer,
+    find_last_step,
+    load_checkpoint,
+    load_flat_state_dict,
+    load_model_data,
+    save_checkpoint,
+    save_flat_state_dict,
+)
+from nanochat.gpt import GPT, GPTConfig
+
+
+def test_flat_state_dict_roundtrip(tmp_path):
+    state_dict = {
+        "a": torch.randn(3, 5).bfloat16(), # 2-byte elements first in the dict, written after the 4 and 8 byte ones
+        "b": torch.randn(7),
+        "c": torch.arange(5, dtype=torch.int64),
+        "d": torch.tensor(3.5), # 0-d
+        "e": torch.tensor([True, False, True]),
+        "f": torch.randint(-128, 127, (4, 3), dtype=torch.int8),
+    }
+    path = os.path.join(tmp_path, "model.safetensors")
+    save_flat_state_dict(path, state_dict)
+    loaded = load_flat_state_dict(path, "cpu")
+    assert set(loaded) == set(state_dict)
+    for name, tensor in state_dict.items():
+        assert loaded[name].dtype == tensor.dtype
+        assert torch.equal(loaded[name], tensor)
+    # the header follows the safetensors format
+    with open(path, "rb") as f:
+        header_size = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_size))
+    assert header_size % 8 == 0
+    assert header["a"] == {"dtype": "BF16", "shape": [3, 5], "data_offsets": header["a"]["data_offsets"]}
+    # the loaded tensors are copy-on-write: modifying them leaves the file alone
+    loaded["b"].zero_()
+    assert torch.equal(load_flat_state_dict(path, "cpu")["b"], state_dict["b"])
+
+
+def test_checkpoint_loads_without_init(tmp_path):
+    torch.manual_seed(0)
+    config = GPTConfig(sequence_len=32, vocab_size=100, n_layer=2, n_head=2, n_kv_head=1, n_embd=32)
+    model = GPT(config)
+    model.init_weights()
+    with torch.no_grad():
+        for p in model.parameters():
+            p.normal_(0, 0.1)
+    # keys of a torch.compile'd model
+    model_data = {"_orig_mod." + k: v for k, v in model.state_dict().items()}
+    save_checkpoint(str(tmp_path), 10, model_data, None, {"model_config": config.__dict__})
+    assert os.path.exists(os.path.join(tmp_path, "model_000010.safetensors"))
+    # same as build_model: the loaded tensors are assigned to a meta model, only the rotary buffers are computed
+    with torch.device("meta"):
+        loaded = GPT(config)
+    loaded.load_state_dict(load_model_data(str(tmp_path), 10, "cpu"), strict=True, assign=True)
+    loaded.init_rotary()
+    idx = torch.randint(0, 100, (2, 16))
+    with torch.no_grad():
+        assert torch.equal(loaded(idx), model(idx))
+    # the .pt alone still loads (and the flat file gets written for next time)
+    os.remove(os.path.join(tmp_path, "model_000010.safetensors"))
+    model_data = load_model_data(str(tmp_path), 10, "cpu")
+    assert set(model_data) == set(model.state_dict())
+    assert os.path.exists(os.path.join(tmp_path, "model_000010.safetensors"))
+
+
+def test_async_checkpointer(tmp_path):
+    torch.manual_seed(0)
+    model = torch.nn.Linear(8, 4)
+    optimizer = torch.optim.AdamW(model.parameters())
+    model(torch.randn(2, 8)).sum().backward()
+    optimizer.step()
+    expected = {k: v.clone() for k, v in model.state_dict().items()}
+    checkpointer = AsyncCheckpointer()
+    checkpointer.save(str(tmp_path), 3, model.state_dict(), [optimizer.state_dict()], {"step": 3})
+    # training carries on while the checkpoint is written: the snapshot is not affected
+    with torch.no_grad():
+        model.weight.zero_()
+    checkpointer.wait()
+    with open(os.path.join(tmp_path, "manifest_000003.json")) as f:
+        manifest = json.load(f)
+    assert "optim_000003_rank0.pt" in manifest["files"]
+    assert all(os.path.exists(os.path.join(tmp_path, name)) for name in manifest["files"])
+    model_data, optimizer_data, meta_data = load_checkpoint(str(tmp_path), 3, "cpu", load_optimizer=True)
+    assert meta_data == {"step": 3}
+    for k, v in expected.items():
+        assert torch.equal(model_data[k], v)
+    fresh = torch.optim.AdamW(model.parameters())
+    fresh.load_state_dict(optimizer_data[0])
+    assert torch.equal(fresh.state[model.weight]["exp_avg"], optimizer.state[model.weight]["exp_avg"])
+
+
+def test_incomplete_checkpoints_are_ignored(tmp_path):
+    model = torch.nn.Linear(8, 4)
+    # a step saved before manifests existed
+    save_checkpoint(str(tmp_path), 5, model.state_dict(), None, {"step": 5}, manifest=False)
+    assert find_last_step(str(tmp_path)) == 5
+    files = save_checkpoint(str(tmp_path), 10, model.state_dict(), None, {"step": 10})
+    with open(os.path.join(tmp_path, "manifest_000010.json")) as f:
+        assert json.load(f)["files"] == files
+    assert find_last_step(str(tmp_path)) == 10
+    # a later save that never finished: its files are there, but not its manifest
+    save_checkpoint(str(tmp_path), 20, model.state_dict(), None, {"step": 20}, manifest=False)
+    assert find_last_step(str(tmp_path)) == 10
+    with pytest.raises(FileNotFoundError):
+        load_checkpoint(str(tmp_path), 20, "cpu")
+    # the step from before manifests still loads
+    assert load_checkpoint(str(tmp_path), 5, "cpu")[2] == {"step": 5}
+    assert not any(".tmp" in name for name in os.listdir(tmp_path))
+
+
+
+def run_async_checkpointer_worker(rank, init_file, checkpoint_dir, failing_rank):
+    dist.init_process_group("gloo", init_method=f"file://{init_file}", rank=rank, world_size=2)
+    model = torch.nn.Linear(8, 4)
+    checkpointer = AsyncCheckpointer(shard_timeout=2)
+    if rank != failing_rank: # the failing rank never saves (e.g. it died)
+        checkpointer.save(checkpoint_dir, 3, model.state_dict(), [{"state": {}, "rank": rank}], {"step": 3})
+        if failing_rank is None:
+            checkpointer.wait()
+        else:
+            with pytest.raises(Exception):
+                checkpointer.wait()
+    dist.barrier()
+    dist.destroy_process_group()
+
+
+@pytest.mark.parametrize("failing_rank", [None, 1])
+def test_async_checkpointer_ranks(tmp_path, failing_rank):
+    # the ranks agree on the completion with a collective, not through the files (the directory could be node-local)
+    checkpoint_dir = os.path.join(tmp_path, "checkpoints")
+    mp.spawn(run_async_checkpointer_worker, args=(os.path.join(tmp_path, "init"), checkpoint_dir, failing_rank), nprocs=2)
+    manifest_path = os.path.join(checkpoint_dir, "manifest_000003.json")
+    if failing_rank is not None:
+        assert not os.path.exists(manifest_path)
+        return
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    assert manifest["world_size"] == 2
+    assert {"optim_000003_rank0.pt", "optim_000003_rank1.pt"} <= set(manifest["files"])
+    assert torch.load(os.path.join(checkpoint_dir, "optim_000003_rank1.pt"))[0]["rank"] == 1
@@ -0,0 +1,51 @@
+"""
+Tests for the chunked softcap cross-entropy of GPT.forward (nanochat/gpt.py)
+
+python -m pytest tests/test_chunked_ce.py -v
+"""
+
+import pytest
+import torch
+import torch.nn.functional as F
+
+from nanochat.gpt import softcap_cross_entropy
+
+SOFTCAP = 15
+
+
+def reference_loss(x, weight, targets, reduction):
+    # the original GPT.forward loss: full logits, softcap, fp32 cross-entropy
+    logits = F.linear(x, weight)
+    logits = SOFTCAP * torch.tanh(logits / SOFTCAP)
+    return F.cross_entropy(logits.float(), targets, ignore_index=-1, reduction=reduction)
+
+
+@pytest.mark.parametrize("reduction", ["mean", "sum", "none"])
+def test_matches_full_logits(reduction):
+    torch.manual_seed(0)
+    N, D, V = 37, 16, 50
+    x = torch.randn(N, D, dtype=torch.float64) * 3 # large enough logits for the softcap to matter
+    weight = torch.randn(V, D, dtype=torch.float64)
+    targets = torch.randint(0, V, (N,))
+    targets[::5] = -1 # some ignored tokens
+    x1, w1 = x.clone().requires_grad_(), weight.clone().requires_grad_()
+    x2, w2 = x.clone().requires_grad_(), weight.clone().requires_grad_()
+    loss = softcap_cross_entropy(x1, w1, targets, SOFTCAP, reduction=reduction, chunk_size=8) # N not a multiple of the chunk
+    expected = reference_loss(x2, w2, targets, reduction)
+    assert loss.shape == expected.shape
+    assert torch.allclose(loss.double(), expected.double(), atol=1e-5)
+    # backward, with per-token weights for reduction='none' (as in chat_rl)
+    grad_output = torch.randn(N, dtype=torch.float32) if reduction == "none" else torch.tensor(0.7)
+    loss.backward(grad_output)
+    expected.backward(grad_output.to(expected.dtype))
+    assert torch.allclose(x1.grad, x2.grad, atol=1e-5)
+    assert torch.allclose(w1.grad, w2.grad, atol=1e-5)
+
+
+def test_no_grad():
+    torch.manual_seed(0)
+    x, weight = torch.randn(10, 8), torch.randn(20, 8)
+    targets = torch.randint(0, 20, (10,))
+    with torch.no_grad():
+        loss = softcap_cross_entropy(x, weight, targets, SOFTCAP, reduction="none", chunk_size=3)
+    assert torch.allclose(loss, reference_loss(x, weight, targets, "none"), atol=1e-5)
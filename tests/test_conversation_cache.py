@@ -0,0 +1,47 @@
+"""
+Tests for the rendered conversation cache in nanochat/conversation_cache.py
+
+python -m pytest tests/test_conversation_cache.py -v
+"""
+
+from nanochat.conversation_cache import render_task, task_fingerprint
+from tasks.common import Task, TaskMixture
+
+
+class ListTask(Task):
+
+    def __init__(self, texts, **kwargs):
+        super().__init__(**kwargs)
+        self.texts = texts
+
+    def num_examples(self):
+        return len(self.texts)
+
+    def get_example(self, index):
+        return {"messages": [{"role": "user", "content": self.texts[index]}]}
+
+
+class ByteTokenizer:
+    """Renders a conversation as its bytes, training on every other token."""
+
+    enc = "bytes-v1" # what tokenizer_fingerprint hashes
+
+    def render_conversation(self, conversation):
+        ids = list(conversation["messages"][0]["content"].encode("utf-8"))
+        return ids, [i % 2 for i in range(len(ids))]
+
+
+def test_render_task_roundtrip(tmp_path, monkeypatch):
+    monkeypatch.setenv("NANOCHAT_BASE_DIR", str(tmp_path))
+    tokenizer = ByteTokenizer()
+    mixture = TaskMixture([ListTask(["hello", "", "world!"]), ListTask(["x" * 100])])
+    rendered = render_task(mixture, tokenizer, "test")
+    assert len(rendered) == len(mixture)
+    for i in range(len(mixture)):
+        ids, mask = rendered[i]
+        expected_ids, expected_mask = tokenizer.render_conversation(mixture[i])
+        assert ids.tolist() == expected_ids and mask.tolist() == expected_mask
+    # a second call reuses the artifact, a different task gets its own
+    assert render_task(mixture, tokenizer, "test").offsets.tolist() == rendered.offsets.tolist()
+    assert task_fingerprint(ListTask(["hello"])) != task_fingerprint(ListTask(["hellO"]))
+    assert len(list((tmp_path / "conversation_cache").iterdir())) == 1
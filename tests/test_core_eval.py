@@ -0,0 +1,103 @@
+"""
+Tests for the CORE evaluation in nanochat/core_eval.py
+
+python -m pytest tests/test_core_eval.py -v
+"""
+
+import random
+
+import pytest
+import torch
+
+from nanochat.common import length_bucketed_batches
+from nanochat.core_eval import (
+    evaluate_example,
+    evaluate_examples,
+    forward_model,
+    forward_model_shared_prefix,
+    forward_model_shared_prefixes,
+    stack_sequences,
+)
+from nanochat.gpt import GPT, GPTConfig
+
+
+class CharTokenizer:
+    """Bytes are tokens, bos is 256."""
+
+    def get_bos_token_id(self):
+        return 256
+
+    def __call__(self, prompts, prepend=None):
+        prefix = [prepend] if prepend is not None else []
+        return [prefix + list(p.encode("utf-8")) for p in prompts]
+
+
+def make_model():
+    torch.manual_seed(0)
+    config = GPTConfig(sequence_len=256, vocab_size=257, n_layer=2, n_head=2, n_kv_head=2, n_embd=64)
+    model = GPT(config)
+    model.init_weights()
+    with torch.no_grad():
+        for p in model.parameters():
+            p.normal_(0, 0.1)
+    model.eval()
+    return model
+
+
+def make_data(n):
+    rng = random.Random(0)
+    word = lambda: "".join(rng.choice("abcdefgh") for _ in range(rng.randint(2, 12)))
+    return [{"query": word(), "choices": [word() for _ in range(rng.randint(2, 4))], "gold": 0} for _ in range(n)]
+
+
+def test_length_bucketed_batches():
+    batches = length_bucketed_batches([5, 1, 3, 10, 2], max_tokens=12, sizes=[2, 2, 2, 2, 1])
+    assert batches == [[1, 4], [2], [0], [3]]
+    # every item lands in exactly one batch
+    assert sorted(i for batch in batches for i in batch) == list(range(5))
+
+
+def test_batched_matches_one_at_a_time():
+    model, tokenizer, data = make_model(), CharTokenizer(), make_data(20)
+    task_meta = {"task_type": "multiple_choice", "num_fewshot": 1, "continuation_delimiter": " "}
+    device = torch.device("cpu")
+    expected = {idx: evaluate_example(idx, model, tokenizer, data, device, task_meta) for idx in range(len(data))}
+    for max_batch_tokens in [1, 64, 100000]:
+        assert evaluate_examples(list(range(len(data))), model, tokenizer, data, device, task_meta, max_batch_tokens) == expected
+
+
+def test_shared_prefix_forward_matches_full_forward():
+    model = make_model()
+    prefix = [256] + list(b"the few-shot context and the question:")
+    tokens = [prefix + list(choice) for choice in [b" yes", b" no", b" maybe so"]]
+    input_ids, losses, predictions = forward_model_shared_prefix(model, tokens, len(prefix), 256, torch.device("cpu"))
+    full_losses, full_predictions = forward_model(model, stack_sequences(tokens, 256))
+    for i, row in enumerate(tokens):
+        scored = slice(len(prefix) - 1, len(row) - 1) # the positions that predict the continuation
+        assert torch.allclose(losses[i, scored], full_losses[i, scored], atol=1e-4)
+        assert torch.equal(predictions[i, scored], full_predictions[i, scored])
+
+
+def test_shared_prefixes_of_several_examples():
+    # prefixes of different lengths (left padded together, the padding skipped by the rotary positions) and different numbers of choices
+    model = make_model()
+    prefixes = [[256] + list(b"a short context:"), [256] + list(b"a somewhat longer context, and a question:")]
+    choices = [[b" yes", b" no"], [b" one", b" two", b" three or four"]]
+    examples = [([prefix + list(c) for c in cs], len(prefix)) for prefix, cs in zip(prefixes, choices)]
+    outputs = forward_model_shared_prefixes(model, examples, 256, torch.device("cpu"))
+    for (tokens, prefix_len), (input_ids, losses, predictions) in zip(examples, outputs):
+        expected_losses, expected_predictions = forward_model(model, stack_sequences(tokens, 256))
+        for i, row in enumerate(tokens):
+            scored = slice(prefix_len - 1, len(row) - 1)
+            assert torch.allclose(losses[i, scored], expected_losses[i, scored], atol=1e-4)
+            assert torch.equal(predictions[i, scored], expected_predictions[i, scored])
+
+
+@pytest.mark.parametrize("max_batch_tokens", [1, 512, 100000])
+def test_batched_matches_one_at_a_time_many_shot(max_batch_tokens):
+    # with many shots the multiple choice rows share a long prefix and take the KV cache path
+    model, tokenizer, data = make_model(), CharTokenizer(), make_data(12)
+    task_meta = {"task_type": "multiple_choice", "num_fewshot": 5, "continuation_delimiter": " "}
+    device = torch.device("cpu")
+    expected = {idx: evaluate_example(idx, model, tokenizer, data, device, task_meta) for idx in range(len(data))}
+    assert evaluate_examples(list(range(len(data))), model, tokenizer, data, device, task_meta, max_batch_tokens) == expected
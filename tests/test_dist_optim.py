@@ -0,0 +1,123 @@
+"""
+Tests for the bucketed gradient communication of DistAdamW and DistMuon (nanochat/grad_buckets.py).
+The distributed optimizers run on 2 CPU processes (gloo) and are compared against the
+single process optimizers stepped with the averaged gradients.
+
+python -m pytest tests/test_dist_optim.py -v
+"""
+
+import os
+
+import pytest
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from nanochat.adamw import DistAdamW
+from nanochat.grad_buckets import GradBuckets
+from nanochat.muon import DistMuon, Muon
+
+WORLD_SIZE = 2
+NUM_STEPS = 3
+BUCKET_SIZE_MB = 0.005 # tiny, so that the params are spread over several buckets
+ADAMW_KWARGS = dict(lr=0.01, betas=(0.8, 0.95), eps=1e-10, weight_decay=0.1)
+
+
+def make_params(optimizer_name):
+    torch.manual_seed(0)
+    if optimizer_name == "adamw":
+        shapes = [(16, 8), (8, 8), (32, 8)] # first dim divisible by the world size
+    else:
+        shapes = [(16, 32), (16, 32), (32, 16), (16, 32), (32, 16)] # odd count per shape: padded chunks
+    return [torch.nn.Parameter(torch.randn(shape) * 0.1) for shape in shapes]
+
+def make_optimizer(optimizer_name, params, distributed):
+    if optimizer_name == "adamw":
+        groups = [dict(params=params[:1]), dict(params=params[1:], lr=0.02)]
+        if distributed:
+            return DistAdamW(groups, bucket_size_mb=BUCKET_SIZE_MB, **ADAMW_KWARGS)
+        return torch.optim.AdamW(groups, **ADAMW_KWARGS)
+    if distributed:
+        return DistMuon(params, bucket_size_mb=BUCKET_SIZE_MB)
+    return Muon(params)
+
+def compute_loss(params, step, rank):
+    # every rank sees different data, so the grads differ across ranks
+    generator = torch.Generator().manual_seed(1000 * step + rank)
+    loss = 0.0
+    for p in params:
+        x = torch.randn(4, p.size(1), generator=generator)
+        loss = loss + (x @ p.T).tanh().pow(2).mean()
+    return loss
+
+
+def run_worker(rank, init_file, optimizer_name, armed, result_path, skewed=False):
+    dist.init_process_group("gloo", init_method=f"file://{init_file}", rank=rank, world_size=WORLD_SIZE)
+    params = make_params(optimizer_name)
+    optimizer = make_optimizer(optimizer_name, params, distributed=True)
+    if skewed and rank == 1:
+        # the buckets complete in the opposite order on rank 1: the collectives must still line up
+        completed = optimizer.grad_buckets.completed
+        optimizer.grad_buckets.completed = lambda: iter(list(completed())[::-1])
+    for step in range(NUM_STEPS):
+        if armed:
+            optimizer.overlap_next_backward()
+        compute_loss(params, step, rank).backward()
+        # backward accumulated straight into the gradient buckets
+        for slots in optimizer.grad_buckets.slots:
+            for p, owner, offset, length in slots:
+                assert p.grad.data_ptr() == optimizer.grad_buckets.grad_view(p, owner, offset, length).data_ptr()
+        optimizer.step()
+        optimizer.zero_grad()
+    if rank == 0:
+        torch.save([p.detach() for p in params], result_path)
+    dist.barrier()
+    dist.destroy_process_group()
+
+
+def check_against_single_process(optimizer_name, distributed):
+    # reference: one process, grads averaged over the ranks' data
+    params = make_params(optimizer_name)
+    optimizer = make_optimizer(optimizer_name, params, distributed=False)
+    for step in range(NUM_STEPS):
+        loss = sum(compute_loss(params, step, rank) for rank in range(WORLD_SIZE)) / WORLD_SIZE
+        loss.backward()
+        optimizer.step()
+        for p in params:
+            p.grad = None
+    # Muon's Newton-Schulz runs in bfloat16 (and is batched differently), AdamW places eps slightly differently
+    atol = 1e-2 if optimizer_name == "muon" else 1e-5
+    for p, d in zip(params, distributed):
+        assert torch.allclose(p.detach(), d, atol=atol)
+
+
+@pytest.mark.parametrize("optimizer_name", ["adamw", "muon"])
+@pytest.mark.parametrize("armed", [False, True])
+def test_dist_optimizer_matches_single_process(tmp_path, optimizer_name, armed):
+    result_path = os.path.join(tmp_path, "result.pt")
+    mp.spawn(run_worker, args=(os.path.join(tmp_path, "init"), optimizer_name, armed, result_path), nprocs=WORLD_SIZE)
+    check_against_single_process(optimizer_name, torch.load(result_path))
+
+
+@pytest.mark.parametrize("optimizer_name", ["adamw", "muon"])
+def test_skewed_bucket_completion(tmp_path, optimizer_name):
+    result_path = os.path.join(tmp_path, "result.pt")
+    mp.spawn(run_worker, args=(os.path.join(tmp_path, "init"), optimizer_name, False, result_path, True), nprocs=WORLD_SIZE)
+    check_against_single_process(optimizer_name, torch.load(result_path))
+
+
+def test_plan_layout():
+    params = [torch.zeros(4, 4) for _ in range(5)]
+    # 2 ranks, owner chunks of 2 params, 16 floats each: 3 chunks, 2 chunks fit in 256 bytes
+    buckets = GradBuckets.plan(params, 2, 256 / 1024 / 1024, sharded=False)
+    assert [[(rank, offset, length) for _, rank, offset, length in slots] for slots in buckets] == [
+        [(0, 0, 16), (1, 0, 16), (0, 16, 16), (1, 16, 16)],
+        [(0, 0, 16)],
+    ]
+    assert buckets[1][0][0] is params[4]
+    # sharded: every param gets a bucket of its own, numel / world_size columns (so that its grad can be a view)
+    buckets = GradBuckets.plan(params[:2], 2, 1, sharded=True)
+    assert [[(rank, offset, length) for _, rank, offset, length in slots] for slots in buckets] == [
+        [(None, 0, 8)],
+        [(None, 0, 8)],
+    ]
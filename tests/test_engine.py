@@ -0,0 +1,258 @@
+"""
+Tests for the inference Engine in nanochat/engine.py
+
+python -m pytest tests/test_engine.py -v
+"""
+
+import threading
+from concurrent.futures import Future
+from dataclasses import dataclass
+
+import pytest
+import torch
+
+from nanochat.engine import CalculatorPool, Engine, KVCache, dequantize_kv, quantize_kv
+from nanochat.gpt import GPT, GPTConfig
+
+SPECIAL = ["<|bos|>", "<|python_start|>", "<|python_end|>", "<|output_start|>", "<|output_end|>", "<|assistant_end|>"]
+VOCAB_SIZE = 256 + len(SPECIAL)
+
+
+class ByteTokenizer:
+    """Bytes are tokens 0..255, the special tokens come right after."""
+
+    def encode_special(self, text):
+        return 256 + SPECIAL.index(text)
+
+    def get_bos_token_id(self):
+        return self.encode_special("<|bos|>")
+
+    def encode(self, text):
+        return list(text.encode("utf-8"))
+
+    def decode(self, ids):
+        return bytes(ids).decode("utf-8")
+
+
+@dataclass
+class ScriptedConfig:
+    sequence_len: int = 256
+    n_layer: int = 1
+    n_head: int = 1
+    n_kv_head: int = 1
+    n_embd: int = 1
+
+
+class ScriptedModel:
+    """
+    A fake model whose next token is a deterministic function of the full token history
+    held in the KV cache. It calls the calculator right after the prompt, then emits letters
+    that depend on everything it has seen so far, so a badly rolled back cache changes the output.
+    Rows other than row 0 never close the python block, so they never call the calculator.
+    Masked keys are left out of the history, like attention would.
+    """
+
+    def __init__(self, prompt_len):
+        self.config = ScriptedConfig()
+        self.prompt_len = prompt_len
+        self.tok = ByteTokenizer()
+
+    def get_device(self):
+        return torch.device("cpu")
+
+    def next_token(self, history, row):
+        script = [self.tok.encode_special("<|python_start|>"), *self.tok.encode("1+1"), self.tok.encode_special("<|python_end|>")]
+        t = len(history) - self.prompt_len
+        if row > 0 and t > 0:
+            script = script[:1]
+        if t < len(script):
+            return script[t]
+        if t >= 30:
+            return self.tok.encode_special("<|assistant_end|>")
+        return ord("a") + sum(history) % 26
+
+    def forward(self, ids, kv_cache):
+        B, T = ids.size()
+        x = ids.float().view(B, 1, T, 1)
+        keys, _ = kv_cache.insert_kv(0, x, x)
+        key_mask = kv_cache.get_key_mask(keys.size(2))
+        logits = torch.zeros(B, T, VOCAB_SIZE)
+        for b, history in enumerate(keys[:, 0, :, 0].long().tolist()):
+            if key_mask is not None:
+                history = [tok for tok, valid in zip(history, key_mask[b].tolist()) if valid]
+            logits[b, -1, self.next_token(history, b)] = 1.0
+        return logits
+
+
+class SlowPool:
+    """Stand-in for CalculatorPool whose results take a while to come back."""
+
+    def submit(self, expr):
+        future = Future()
+        threading.Timer(0.2, lambda: future.set_result(eval(expr))).start()
+        return future
+
+
+def test_tool_use_matches_across_sync_every():
+    prompt = [ByteTokenizer().get_bos_token_id()] + list(b"hi")
+    engine = Engine(ScriptedModel(len(prompt)), ByteTokenizer())
+    reference = engine.generate_batch(prompt, num_samples=1, max_tokens=64, temperature=0.0, sync_every=1)
+    results, masks = reference
+    # the calculator result was forced in, with mask 0
+    generated = results[0][len(prompt):]
+    forced = [tok for tok, mask in zip(generated, masks[0][len(prompt):]) if mask == 0]
+    assert forced == [ByteTokenizer().encode_special("<|output_start|>"), ord("2"), ByteTokenizer().encode_special("<|output_end|>")]
+    for sync_every in [2, 3, 8, 64]:
+        assert engine.generate_batch(prompt, num_samples=1, max_tokens=64, temperature=0.0, sync_every=sync_every) == reference
+
+
+def test_paused_row_does_not_block_others():
+    prompt = [ByteTokenizer().get_bos_token_id()] + list(b"hi")
+    pool = CalculatorPool(num_workers=1)
+    try:
+        fast = Engine(ScriptedModel(len(prompt)), ByteTokenizer(), calculator_pool=pool)
+        reference = fast.generate_batch(prompt, num_samples=2, max_tokens=128, temperature=0.0)
+    finally:
+        pool.close()
+    slow = Engine(ScriptedModel(len(prompt)), ByteTokenizer(), calculator_pool=SlowPool())
+    columns = list(slow.generate(prompt, num_samples=2, max_tokens=128, temperature=0.0))
+    # row 1 kept decoding while row 0 waited for its result
+    assert any(token_column[0] is None and token_column[1] is not None for token_column, _ in columns)
+    # and the masked dummy inputs of row 0 did not change what either row generated
+    assert slow.generate_batch(prompt, num_samples=2, max_tokens=128, temperature=0.0) == reference
+
+
+def test_streaming_columns_match_across_sync_every():
+    prompt = [ByteTokenizer().get_bos_token_id()] + list(b"hello")
+    engine = Engine(ScriptedModel(len(prompt)), ByteTokenizer())
+    stream = lambda k: list(engine.generate(prompt, num_samples=1, max_tokens=20, temperature=0.0, sync_every=k))
+    reference = stream(1)
+    assert len(reference) == 20
+    assert stream(5) == reference
+
+
+def test_engine_matches_naive_generate():
+    torch.manual_seed(0)
+    config = GPTConfig(sequence_len=64, vocab_size=VOCAB_SIZE, n_layer=2, n_head=2, n_kv_head=2, n_embd=64)
+    model = GPT(config)
+    model.init_weights()
+    # the default init zeros the output projections, randomize everything so the test means something
+    with torch.no_grad():
+        for p in model.parameters():
+            p.normal_(0, 0.1)
+    model.eval()
+    prompt = [ByteTokenizer().get_bos_token_id()] + list(b"abc")
+    reference = list(model.generate(prompt, max_tokens=16, temperature=0.0))
+    engine = Engine(model, ByteTokenizer())
+    for sync_every in [1, 4]:
+        columns = list(engine.generate(prompt, num_samples=1, max_tokens=16, temperature=0.0, sync_every=sync_every))
+        generated = [token_column[0] for token_column, _ in columns]
+        # the random model may sample special tokens, which the engine acts on: compare up to the first one
+        n = next((i for i, tok in enumerate(reference) if tok >= 256), len(reference))
+        assert generated[:n] == reference[:n]
+
+
+def test_batched_prompts_match_one_at_a_time():
+    torch.manual_seed(0)
+    config = GPTConfig(sequence_len=64, vocab_size=VOCAB_SIZE, n_layer=2, n_head=2, n_kv_head=2, n_embd=64)
+    model = GPT(config)
+    model.init_weights()
+    with torch.no_grad():
+        for p in model.parameters():
+            p.normal_(0, 0.1)
+    model.eval()
+    bos = ByteTokenizer().get_bos_token_id()
+    prompts = [[bos] + list(text) for text in [b"a", b"hello there", b"abc", b"the quick brown fox"]]
+    engine = Engine(model, ByteTokenizer())
+    expected = {}
+    for p, prompt in enumerate(prompts):
+        results, _ = engine.generate_batch(prompt, num_samples=2, max_tokens=12, temperature=0.0)
+        for s, result in enumerate(results):
+            expected[(p, s)] = result[len(prompt):]
+    # prompts of different lengths are left padded into one batch, every row finishes exactly once
+    got = {(p, s): completion for p, s, completion, _ in engine.generate_completions(prompts, num_samples=2, max_tokens=12, temperature=0.0)}
+    assert got == expected
+
+
+def test_left_padding_keeps_positions():
+    # a left padded prompt is computed as if it had no padding (the rotary positions skip the padding)
+    model = make_kv_quant_model()
+    bos = ByteTokenizer().get_bos_token_id()
+    prompts = [[bos] + list(b"hi"), [bos] + list(b"a longer prompt")]
+    prompt_len = max(len(prompt) for prompt in prompts)
+    m = model.config
+    cache = KVCache(batch_size=2, num_heads=m.n_kv_head, seq_len=prompt_len + 1, head_dim=m.n_embd // m.n_head, num_layers=m.n_layer)
+    cache.key_mask = torch.tensor([[False] * (prompt_len - len(prompt)) + [True] * len(prompt) for prompt in prompts])
+    with torch.no_grad():
+        logits = model(torch.tensor([[bos] * (prompt_len - len(prompt)) + prompt for prompt in prompts]), kv_cache=cache)
+        next_logits = model(torch.tensor([[97], [98]]), kv_cache=cache) # a decode step on top
+        for row, prompt in enumerate(prompts):
+            assert torch.allclose(logits[row, -1], model(torch.tensor([prompt]))[0, -1], atol=1e-5)
+            unpadded = model(torch.tensor([prompt + [97 + row]]))[0, -1]
+            assert torch.allclose(next_logits[row, -1], unpadded, atol=1e-5)
+
+
+def make_kv_quant_model():
+    torch.manual_seed(0)
+    config = GPTConfig(sequence_len=64, vocab_size=VOCAB_SIZE, n_layer=2, n_head=2, n_kv_head=1, n_embd=64)
+    model = GPT(config)
+    model.init_weights()
+    with torch.no_grad():
+        for p in model.parameters():
+            p.normal_(0, 0.1)
+    model.eval()
+    return model
+
+
+@pytest.mark.parametrize("mode,tol", [("int8", 0.01), ("fp8", 0.07)])
+def test_quantize_roundtrip(mode, tol):
+    torch.manual_seed(0)
+    x = torch.randn(2, 3, 5, 32)
+    q, scale = quantize_kv(x, mode)
+    assert q.element_size() == 1 and scale.shape == (2, 3, 5, 1)
+    x_hat = dequantize_kv(q, scale, x.dtype)
+    assert ((x_hat - x).abs() <= tol * x.abs().amax(dim=-1, keepdim=True)).all()
+
+
+@pytest.mark.parametrize("mode", ["int8", "fp8"])
+def test_cache_grows_and_prefills(mode):
+    torch.manual_seed(0)
+    cache = KVCache(batch_size=1, num_heads=2, seq_len=4, head_dim=16, num_layers=1, quantize=mode)
+    keys = torch.randn(1, 2, 1100, 16)
+    for t0, t1 in [(0, 3), (3, 1100)]: # the second insert grows the cache past its initial length
+        k, _ = cache.insert_kv(0, keys[:, :, t0:t1], keys[:, :, t0:t1])
+    assert cache.kv_cache.size(4) == (1100 + 1024 + 1023) & ~1023 # the growth rule: + 1024, rounded up to 1024s (3072)
+    assert cache.kv_cache.dtype != keys.dtype
+    assert torch.equal(k[:, :, 3:], keys[:, :, 3:]) # the newly inserted positions are exact
+    assert (k[:, :, :3] - keys[:, :, :3]).abs().max() < 0.1 # the cached ones are close
+    # the cached prefix survived the growth (and carries over into a wider cache)
+    wide = KVCache(batch_size=3, num_heads=2, seq_len=1200, head_dim=16, num_layers=1, quantize=mode)
+    wide.prefill(cache)
+    k_wide, _ = wide.insert_kv(0, keys[:, :, :1].expand(3, -1, -1, -1), keys[:, :, :1].expand(3, -1, -1, -1))
+    for row in range(3):
+        assert torch.equal(k_wide[row, :, :1100], dequantize_kv(cache.kv_cache[0, 0, 0, :, :1100], cache.kv_scales[0, 0, 0, :, :1100], keys.dtype))
+
+
+@pytest.mark.parametrize("mode", ["int8", "fp8"])
+def test_generation_matches_full_precision(mode):
+    model = make_kv_quant_model()
+    bos = ByteTokenizer().get_bos_token_id()
+    prompt = [bos] + list(b"the quick brown fox")
+    reference = Engine(model, ByteTokenizer())
+    quantized = Engine(model, ByteTokenizer(), kv_quantize=mode)
+    # the logits of a decode step barely move with the cache quantized
+    m = model.config
+    ids = torch.tensor([prompt])
+    logits = {}
+    for name, quantize in [("fp", None), ("q", mode)]:
+        cache = KVCache(batch_size=1, num_heads=m.n_kv_head, seq_len=32, head_dim=m.n_embd // m.n_head, num_layers=m.n_layer, quantize=quantize)
+        with torch.no_grad():
+            model(ids[:, :-1], kv_cache=cache)
+            logits[name] = model(ids[:, -1:], kv_cache=cache)
+    assert (logits["q"] - logits["fp"]).abs().max() < 0.05 * logits["fp"].abs().max()
+    # and greedy decoding gives the same tokens (up to the first special token, which the engine acts on)
+    expected, _ = reference.generate_batch(prompt, num_samples=2, max_tokens=12, temperature=0.0)
+    got, _ = quantized.generate_batch(prompt, num_samples=2, max_tokens=12, temperature=0.0)
+    for e, g in zip(expected, got):
+        n = next((i for i, tok in enumerate(e) if tok >= 256), len(e))
+        assert g[:n] == e[:n]
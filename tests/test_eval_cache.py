@@ -0,0 +1,32 @@
+"""
+Tests for the eval result cache in nanochat/eval_cache.py
+
+python -m pytest tests/test_eval_cache.py -v
+"""
+
+from nanochat.eval_cache import EvalCache, file_hash
+
+
+def test_get_or_compute(tmp_path, monkeypatch):
+    monkeypatch.setenv("NANOCHAT_BASE_DIR", str(tmp_path))
+    calls = []
+    compute = lambda: calls.append(1) or 0.5
+    cache = EvalCache("abc", code="v1")
+    assert cache.get_or_compute("CORE/hellaswag", {"num_fewshot": 0}, compute) == 0.5
+    assert cache.get_or_compute("CORE/hellaswag", {"num_fewshot": 0}, compute) == 0.5
+    assert len(calls) == 1 and cache.hits == ["CORE/hellaswag"]
+    # any change of checkpoint, config or code is a miss
+    EvalCache("abd", code="v1").get_or_compute("CORE/hellaswag", {"num_fewshot": 0}, compute)
+    EvalCache("abc", code="v1").get_or_compute("CORE/hellaswag", {"num_fewshot": 10}, compute)
+    EvalCache("abc", code="v2").get_or_compute("CORE/hellaswag", {"num_fewshot": 0}, compute)
+    EvalCache("abc", code="v1", enabled=False).get_or_compute("CORE/hellaswag", {"num_fewshot": 0}, compute)
+    assert len(calls) == 5
+
+
+def test_file_hash_sidecar(tmp_path):
+    path = tmp_path / "model_000001.pt"
+    path.write_bytes(b"weights")
+    digest = file_hash(str(path))
+    assert (tmp_path / "model_000001.pt.sha256").read_text().split()[-1] == digest
+    path.write_bytes(b"other weights")
+    assert file_hash(str(path)) != digest
@@ -0,0 +1,31 @@
+"""
+Tests for the sandboxed code execution in nanochat/execution.py
+
+python -m pytest tests/test_execution.py -v
+"""
+
+from nanochat.execution import SandboxPool, execute_code
+
+
+def test_pool_matches_execute_code():
+    codes = ["print('hello')", "1/0", "import sys\nprint('oops', file=sys.stderr)"]
+    pool = SandboxPool(num_workers=2)
+    try:
+        results = pool.execute_many(codes)
+    finally:
+        pool.close()
+    for code, result in zip(codes, results):
+        expected = execute_code(code)
+        assert (result.success, result.stdout, result.stderr, result.error) == (expected.success, expected.stdout, expected.stderr, expected.error)
+
+
+def test_pool_recovers_from_timeouts_and_recycles_workers():
+    pool = SandboxPool(num_workers=1, max_runs=2)
+    try:
+        assert pool.execute("while True: pass", timeout=0.5).timeout
+        # files written by one snippet are gone for the next one
+        results = pool.execute_many(["open('x.txt', 'w').write('x')", "import os\nprint(os.listdir('.'))", "print(1)"])
+        assert [r.success for r in results] == [True, True, True]
+        assert results[1].stdout == "[]\n"
+    finally:
+        pool.close()
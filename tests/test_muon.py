@@ -0,0 +1,39 @@
+"""
+Tests for the Muon optimizer in nanochat/muon.py
+
+python -m pytest tests/test_muon.py -v
+"""
+
+import torch
+
+from nanochat.muon import Muon, zeropower_via_newtonschulz5
+
+
+def reference_step(params, bufs, lr=0.02, momentum=0.95, ns_steps=5):
+    # the plain one param at a time Muon step (nesterov)
+    for p, buf in zip(params, bufs):
+        g = p.grad.clone()
+        buf.lerp_(g, 1 - momentum)
+        g = g.lerp_(buf, momentum)
+        g = zeropower_via_newtonschulz5(g, steps=ns_steps)
+        p.data.add_(g, alpha=-lr * max(1, p.size(-2) / p.size(-1))**0.5)
+
+
+def test_batched_step_matches_per_param_step():
+    torch.manual_seed(0)
+    # same numel, different shapes (like the MLP c_fc/c_proj), land in the same param group
+    shapes = [(32, 16), (32, 16), (16, 32), (16, 16), (32, 16)]
+    params = [torch.nn.Parameter(torch.randn(shape)) for shape in shapes]
+    reference = [p.detach().clone() for p in params]
+    bufs = [torch.zeros_like(p) for p in params]
+    optimizer = Muon(params)
+    for _ in range(3):
+        grads = [torch.randn(shape) for shape in shapes]
+        for p, r, g in zip(params, reference, grads):
+            p.grad = g.clone()
+            r.grad = g.clone()
+        optimizer.step()
+        reference_step(reference, bufs)
+    for p, r in zip(params, reference):
+        # Newton-Schulz runs in bfloat16, batched and unbatched matmuls may round differently
+        assert torch.allclose(p, r, atol=1e-2)
@@ -0,0 +1,46 @@
+"""
+Tests for packing several sequences into one row (nanochat/common.py pack_sequences, GPT doc_ids)
+
+python -m pytest tests/test_packing.py -v
+"""
+
+import torch
+
+from nanochat.common import pack_sequences
+from nanochat.gpt import GPT, GPTConfig
+
+
+def test_pack_sequences():
+    lengths = [5, 3, 8, 2, 6]
+    rows = pack_sequences(lengths, capacity=8)
+    assert sorted(i for row in rows for i in row) == list(range(len(lengths)))
+    assert all(sum(lengths[i] for i in row) <= 8 for row in rows)
+    assert len(rows) == 3 # 8 | 6+2 | 5+3
+
+
+def test_packed_forward_matches_separate_forwards():
+    torch.manual_seed(0)
+    config = GPTConfig(sequence_len=64, vocab_size=100, n_layer=2, n_head=2, n_kv_head=1, n_embd=64)
+    model = GPT(config)
+    model.init_weights()
+    with torch.no_grad():
+        for p in model.parameters():
+            p.normal_(0, 0.1)
+    sequences = [torch.randint(0, 100, (n,)) for n in [7, 4, 9]]
+    targets = [torch.randint(0, 100, (len(seq),)) for seq in sequences]
+    # two rows: [seq0, seq1, pad] and [seq2, pad]
+    row_len = 12
+    idx = torch.zeros((2, row_len), dtype=torch.long)
+    tgt = torch.full((2, row_len), -1, dtype=torch.long)
+    doc_ids = torch.full((2, row_len), -1, dtype=torch.long)
+    layout = [(0, 0, 0), (1, 0, 7), (2, 1, 0)] # (sequence, row, offset)
+    for i, r, t in layout:
+        n = len(sequences[i])
+        idx[r, t:t+n], tgt[r, t:t+n], doc_ids[r, t:t+n] = sequences[i], targets[i], i
+    packed = model(idx, tgt, loss_reduction='none', doc_ids=doc_ids).view(2, row_len)
+    for i, r, t in layout:
+        n = len(sequences[i])
+        separate = model(sequences[i][None], targets[i][None], loss_reduction='none')
+        assert torch.allclose(packed[r, t:t+n], separate, atol=1e-4)
+    # padding positions are ignored
+    assert (packed[tgt < 0] == 0).all()
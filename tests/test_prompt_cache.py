@@ -0,0 +1,31 @@
+"""
+Tests for the tokenized prompt cache in nanochat/prompt_cache.py
+
+python -m pytest tests/test_prompt_cache.py -v
+"""
+
+from nanochat.prompt_cache import cache_key, load_entry, pack_ragged, save_entry, unpack_ragged
+
+
+def test_ragged_roundtrip():
+    lists = [[1, 2, 3], [], [65535], [7] * 100]
+    values, offsets = pack_ragged(lists)
+    assert offsets.tolist() == [0, 3, 3, 4, 104]
+    assert unpack_ragged(values, offsets) == lists
+
+
+def test_save_load_entry(tmp_path):
+    path = str(tmp_path / "task_abc.npz")
+    ragged = {"rows": [[1, 2], [3, 4, 5]], "prompts": [[9]]}
+    flat = {"starts": [0, 1], "num_rows": [2]}
+    save_entry(path, ragged, flat)
+    assert load_entry(path) == (ragged, flat)
+    # no temporary files left behind
+    assert [p.name for p in tmp_path.iterdir()] == ["task_abc.npz"]
+
+
+def test_cache_key_depends_on_everything():
+    base = dict(label="hellaswag", max_seq_len=2048, tokenizer="abc")
+    assert cache_key(**base) == cache_key(**dict(reversed(list(base.items()))))
+    assert cache_key(**base) != cache_key(**{**base, "max_seq_len": 1024})
+    assert cache_key(**base) != cache_key(**{**base, "tokenizer": "abd"})
@@ -0,0 +1,71 @@
+"""
+Tests for the int8 weight-only quantization in nanochat/quantize.py
+
+python -m pytest tests/test_quantize.py -v
+"""
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from nanochat.gpt import GPT, GPTConfig
+from nanochat.quantize import Int8Linear, model_size_bytes, quantize_model
+
+
+def test_int8_linear_matches_float():
+    torch.manual_seed(0)
+    linear = nn.Linear(64, 32, bias=False)
+    qlinear = Int8Linear.from_linear(linear)
+    x = torch.randn(2, 5, 64)
+    y, qy = linear(x), qlinear(x)
+    assert qy.shape == y.shape
+    # absmax int8 keeps the error around 1% of the output scale
+    assert (qy - y).abs().max() < 0.02 * y.abs().max()
+    # the dequantization fallback path agrees with the fused one
+    assert torch.allclose(nn.functional.linear(x, qlinear.dequantize()), qy, atol=1e-4)
+
+
+def test_quantize_model():
+    torch.manual_seed(0)
+    config = GPTConfig(sequence_len=32, vocab_size=128, n_layer=2, n_head=2, n_kv_head=2, n_embd=64)
+    model = GPT(config)
+    model.init_weights()
+    with torch.no_grad():
+        for p in model.parameters():
+            p.normal_(0, 0.1)
+    model.eval()
+    idx = torch.randint(0, config.vocab_size, (2, 16))
+    with torch.no_grad():
+        logits = model(idx)
+        float_size = model_size_bytes(model)
+        quantize_model(model)
+        qlogits = model(idx)
+    assert isinstance(model.lm_head, Int8Linear)
+    assert isinstance(model.transformer.h[0].mlp.c_fc, Int8Linear)
+    assert model_size_bytes(model) < float_size / 2
+    assert (qlogits.argmax(-1) == logits.argmax(-1)).float().mean() > 0.9
+
+
+def test_quantized_model_loss():
+    # forward with targets (e.g. evaluate_bpb in scripts/quantize_export.py) goes through the dequantized lm_head
+    torch.manual_seed(0)
+    config = GPTConfig(sequence_len=32, vocab_size=128, n_layer=2, n_head=2, n_kv_head=2, n_embd=64)
+    model = GPT(config)
+    model.init_weights()
+    with torch.no_grad():
+        for p in model.parameters():
+            p.normal_(0, 0.1)
+    model.eval()
+    idx = torch.randint(0, config.vocab_size, (2, 16))
+    targets = torch.randint(0, config.vocab_size, (2, 16))
+    targets[0, :4] = -1 # ignored positions
+    with torch.no_grad():
+        loss = model(idx, targets)
+        quantize_model(model)
+        qloss = model(idx, targets)
+        qlosses = model(idx, targets, loss_reduction='none')
+        # same as the loss of the quantized model's logits
+        expected = F.cross_entropy(model(idx).view(-1, config.vocab_size), targets.view(-1), ignore_index=-1, reduction='none')
+    assert torch.allclose(qlosses, expected, atol=1e-3)
+    assert torch.allclose(qloss, qlosses[targets.view(-1) >= 0].mean(), atol=1e-5)
+    assert abs(qloss.item() - loss.item()) < 0.05 * loss.item()
@@ -0,0 +1,72 @@
+"""
+Tests for the growable rotary embeddings (and RoPE scaling) of GPT
+
+python -m pytest tests/test_rotary.py -v
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+from nanochat.gpt import GPT, GPTConfig
+
+
+def make_model(sequence_len, **kwargs):
+    torch.manual_seed(0)
+    config = GPTConfig(sequence_len=sequence_len, vocab_size=100, n_layer=2, n_head=2, n_kv_head=1, n_embd=32, **kwargs)
+    model = GPT(config)
+    model.init_weights()
+    with torch.no_grad():
+        for p in model.parameters():
+            p.normal_(0, 0.1)
+    return model
+
+
+def test_tables_grow_on_demand():
+    model = make_model(sequence_len=8)
+    assert model.cos.size(1) == 8
+    idx = torch.randint(0, 100, (1, 20))
+    with torch.no_grad():
+        logits = model(idx)
+    assert model.cos.size(1) == 20 # max(needed, 2 * 8)
+    # same as a model whose tables covered the whole sequence from the start
+    reference = make_model(sequence_len=32)
+    with torch.no_grad():
+        assert torch.allclose(logits, reference(idx), atol=1e-5)
+    # a little longer: doubles
+    with torch.no_grad():
+        model(torch.randint(0, 100, (1, 21)))
+    assert model.cos.size(1) == 40
+
+
+def test_rope_scaling():
+    model = make_model(sequence_len=16)
+    cos, sin = model.cos.clone(), model.sin.clone()
+    # linear: position p gets the angles of position p / factor
+    model.set_rope_scaling("linear", 2.0)
+    assert torch.equal(model.cos[:, 2::2], cos[:, 1:8])
+    assert torch.equal(model.sin[:, 2::2], sin[:, 1:8])
+    # ntk: the first (highest frequency) channel is unchanged, the others rotate slower
+    # (checked on a mid frequency channel: over 16 positions the lowest ones round to cos = 1 in bfloat16)
+    model.set_rope_scaling("ntk", 4.0)
+    assert torch.equal(model.cos[..., 0], cos[..., 0])
+    mid = model.cos.size(-1) // 4
+    assert not torch.allclose(model.cos[..., mid].float(), cos[..., mid].float(), atol=0.1)
+    model.set_rope_scaling("none")
+    assert torch.equal(model.cos, cos)
+
+
+def test_concurrent_growth():
+    # forwards on several threads (as in chat_web) grow the tables under each other: each one must see a matching cos/sin pair
+    model = make_model(sequence_len=4)
+    reference = make_model(sequence_len=256)
+    inputs = [torch.randint(0, 100, (1, 5 + 7 * i)) for i in range(24)]
+    def run(idx):
+        with torch.no_grad():
+            return model(idx)
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        outputs = list(pool.map(run, inputs))
+    assert model.cos.size(1) == model.sin.size(1) >= 5 + 7 * 23
+    with torch.no_grad():
+        for idx, logits in zip(inputs, outputs):
+            assert torch.allclose(logits, reference(idx), atol=1e-5)
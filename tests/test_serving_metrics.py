@@ -0,0 +1,36 @@
+"""
+Tests for the Prometheus-style serving metrics used by scripts/chat_web.py
+
+python -m pytest tests/test_serving_metrics.py -v
+"""
+
+from nanochat.metrics import Histogram, ServingMetrics, exponential_buckets
+
+
+def test_exponential_buckets():
+    assert exponential_buckets(1, 2, 4) == [1, 2, 4, 8]
+
+
+def test_histogram_cumulative_buckets():
+    h = Histogram("latency_seconds", "test", [0.1, 1.0])
+    for value in [0.05, 0.1, 0.5, 2.0]:
+        h.observe(value)
+    lines = h.render()
+    # 0.1 is on the bucket boundary, and buckets are "less than or equal"
+    assert 'latency_seconds_bucket{le="0.1"} 2' in lines
+    assert 'latency_seconds_bucket{le="1.0"} 3' in lines
+    assert 'latency_seconds_bucket{le="+Inf"} 4' in lines
+    assert "latency_seconds_count 4" in lines
+    assert h.sum == 0.05 + 0.1 + 0.5 + 2.0
+
+
+def test_serving_metrics_render():
+    metrics = ServingMetrics()
+    metrics.requests.inc()
+    metrics.ttft.observe(0.2)
+    metrics.add_gauge("nanochat_busy_workers", "busy", lambda: 3)
+    text = metrics.render()
+    assert text.endswith("\n")
+    assert "# TYPE nanochat_time_to_first_token_seconds histogram" in text
+    assert "nanochat_requests_total 1" in text
+    assert "nanochat_busy_workers 3" in text
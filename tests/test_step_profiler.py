@@ -0,0 +1,58 @@
+"""
+Tests for nanochat/step_profiler.py (wall clock, on CPU)
+
+python -m pytest tests/test_step_profiler.py -v
+"""
+
+import time
+
+from nanochat.step_profiler import StepProfiler, parse_step_range, percentile
+
+
+def test_percentile():
+    assert percentile([3, 1, 2], 50) == 2
+    assert percentile([1, 2, 3, 4], 50) == 2.5
+    assert percentile([5], 90) == 5
+    assert percentile(list(range(101)), 90) == 90
+
+
+def test_parse_step_range():
+    assert parse_step_range("") is None
+    assert parse_step_range("100-105") == (100, 105)
+    assert parse_step_range("7") == (7, 7)
+
+
+def test_phases_nested_and_other():
+    profiler = StepProfiler("cpu", window=3)
+    for step in range(3):
+        profiler.start_step(step)
+        for _ in range(2): # micro-steps: summed per step
+            with profiler.phase("forward"):
+                time.sleep(0.01)
+        with profiler.phase("optim_muon"):
+            with profiler.phase("comm"):
+                time.sleep(0.02)
+        time.sleep(0.01) # not in any phase
+        profiler.end_step()
+    assert profiler.window_ready()
+    stats = profiler.summary()
+    assert not profiler.window_ready()
+    assert list(stats) == ["comm", "forward", "optim_muon", "other", "step"]
+    assert stats["forward"]["p50"] >= 20
+    assert stats["optim_muon"]["p50"] >= stats["comm"]["p50"] >= 20
+    assert stats["other"]["p50"] >= 10
+    # the nested comm is not subtracted twice
+    assert stats["step"]["p50"] < stats["forward"]["p50"] + stats["optim_muon"]["p50"] + stats["other"]["p50"] + 5
+    assert "comm*" in profiler.format(stats)
+    assert "profile/forward_p50_ms" in profiler.wandb_data(stats)
+    assert "Step phase comm (nested)" in profiler.report_data()
+
+
+def test_disabled_is_a_noop():
+    profiler = StepProfiler("cpu", enabled=False)
+    profiler.start_step(0)
+    with profiler.phase("forward"):
+        pass
+    profiler.end_step()
+    assert not profiler.window_ready()
+    assert profiler.report_data() == {}
@@ -0,0 +1,38 @@
+"""
+Tests for TaskMixture and TaskSequence in tasks/common.py
+
+python -m pytest tests/test_task_mixture.py -v
+"""
+
+from tasks.common import Task, TaskMixture, TaskSequence
+
+
+class ListTask(Task):
+
+    def __init__(self, items, **kwargs):
+        super().__init__(**kwargs)
+        self.items = items
+
+    def num_examples(self):
+        return len(self.items)
+
+    def get_example(self, index):
+        return self.items[index]
+
+
+def make_tasks():
+    return [ListTask([f"a{i}" for i in range(5)]), ListTask([]), ListTask([f"b{i}" for i in range(3)]), ListTask(["c0"])]
+
+
+def test_sequence_order():
+    sequence = TaskSequence(make_tasks())
+    assert [sequence[i] for i in range(len(sequence))] == [f"a{i}" for i in range(5)] + ["b0", "b1", "b2", "c0"]
+
+
+def test_mixture_is_a_deterministic_permutation():
+    mixture = TaskMixture(make_tasks())
+    items = [mixture[i] for i in range(len(mixture))]
+    assert sorted(items) == sorted([f"a{i}" for i in range(5)] + ["b0", "b1", "b2", "c0"])
+    assert items == [TaskMixture(make_tasks())[i] for i in range(len(mixture))]
+    # slicing works on top of the shuffled order
+    assert [TaskMixture(make_tasks(), start=2, step=3)[i] for i in range(3)] == items[2::3]